@@ -0,0 +1,109 @@
+"""
+Compares adding files to a tar with tarfile against TarWriter
+
+Run from the repository root with
+
+    python -m benchmarks.bench_archive --directory /scratch --file-mb 512 --files 8
+
+The directory should be on the filesystem the archive is written to in
+production, since whether copy_file_range avoids copying depends on it.
+"""
+import argparse
+import json
+import os
+import tarfile
+import tempfile
+import time
+from src.archive import TarWriter
+
+
+def write_files(directory, count, size):
+    """
+    Writes count files of size random bytes to directory and returns their paths
+    """
+    file_names = []
+    block = os.urandom(2**20)
+
+    for index in range(count):
+        file_names.append(os.path.join(directory, 'sample{}.vcf.gz'.format(index)))
+
+        with open(file_names[-1], 'wb') as sample_file:
+            for _ in range(size // len(block)):
+                sample_file.write(block)
+
+            sample_file.write(block[:size % len(block)])
+
+    return file_names
+
+
+def add_with_tarfile(tar_file_name, file_names):
+    """
+    Adds the files the way the archive was written before TarWriter
+    """
+    with tarfile.open(tar_file_name, 'a') as tar:
+        for name in file_names:
+            tar.add(name, arcname=os.path.basename(name), recursive=False)
+
+
+def add_with_tar_writer(tar_file_name, file_names):
+    """
+    Adds the files with TarWriter
+    """
+    with TarWriter(tar_file_name) as tar:
+        for name in file_names:
+            tar.add(name, arcname=os.path.basename(name))
+
+
+def time_archive(add_files, directory, file_names, repeats):
+    """
+    Returns the best time of repeats runs of add_files, with the page cache
+    flushed to disk before each run
+    """
+    times = []
+
+    for _ in range(repeats):
+        tar_file_name = os.path.join(directory, 'bench.tar')
+        os.sync()
+        start_time = time.perf_counter()
+        add_files(tar_file_name, file_names)
+        os.sync()
+        times.append(time.perf_counter() - start_time)
+        os.remove(tar_file_name)
+
+    return min(times)
+
+
+def run(directory, files, file_size, repeats):
+    """
+    Runs both ways of writing the archive and returns their timings
+    """
+    with tempfile.TemporaryDirectory(dir=directory) as temp_dir:
+        file_names = write_files(temp_dir, files, file_size)
+        total_bytes = files * file_size
+        results = {'files': files, 'file_bytes': file_size}
+
+        for (name, add_files) in (('tarfile', add_with_tarfile), ('tar_writer', add_with_tar_writer)):
+            seconds = time_archive(add_files, temp_dir, file_names, repeats)
+            results[name] = {'seconds': round(seconds, 3), 'mb_per_second': round(total_bytes / 2**20 / seconds, 1)}
+
+        results['speedup'] = round(results['tarfile']['seconds'] / results['tar_writer']['seconds'], 2)
+
+    return results
+
+
+def main():
+    """
+    Parses the arguments and prints the results as JSON
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--directory', default=tempfile.gettempdir(), help='where to write the files and archive')
+    parser.add_argument('--files', type=int, default=4, help='number of files to archive')
+    parser.add_argument('--file-mb', type=float, default=256, help='size of each file in MiB')
+    parser.add_argument('--repeats', type=int, default=3, help='runs of each method, the best is reported')
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.directory, args.files, int(args.file_mb * 2**20), args.repeats), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+"""
+Times the BAM, VCF, tar and XML processing steps on synthetic files
+
+Run from the repository root with
+
+    python -m benchmarks.bench_processing --output results.json
+    python -m benchmarks.bench_processing --baseline results.json
+
+Nothing is read from or sent to AWS or NCBI: S3 streams are replaced by the
+local files, and the steps that would call SQS or ascp are not timed. With
+--baseline, each step is compared against the stored results and the run
+exits with status 1 if any step is slower by more than the tolerance. The
+synthetic files are generated from a fixed seed, so runs with the same
+arguments process the same data.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+import pysam
+from src.archive import tar_and_remove_files
+from src.bams import process_bam, process_bam_from_s3
+from src.compute import COMPUTE_POOL
+from src.vcfs import WHITELISTED_ANNOTATIONS, process_header, trim_and_compress_vcf, trim_vcf
+from src.workspace import Workspace
+from src.xml_utils import create_and_tar_batch_xml, create_and_tar_xml, create_xml_library
+
+SECRET = {'accession': 'phs001232', 'accession_version': 'v4'}
+
+BASES = 'ACGT'
+
+# annotations that are removed when a VCF is trimmed
+EXTRA_ANNOTATIONS = ['ExcessHet', 'HaplotypeScore', 'MLEAC', 'MLEAF', 'RAW_MQ', 'SOR_RAW', 'DS', 'END']
+
+
+def make_bam(path, reads, read_length, read_groups, seed=0):
+    """
+    Writes a coordinate sorted BAM of reads random paired reads spread over
+    read_groups read groups, with an @PG line, to path
+    """
+    rng = random.Random(seed)
+    header = {
+        'HD': {'VN': '1.6', 'SO': 'coordinate'},
+        'SQ': [{'SN': 'chr{}'.format(chromosome), 'LN': 250000000} for chromosome in range(1, 23)],
+        'RG': [{'ID': 'lane{}.flowcell'.format(group), 'SM': 'participant', 'PL': 'ILLUMINA', 'LB': 'lib1'}
+               for group in range(read_groups)],
+        'PG': [{'ID': 'bwa', 'PN': 'bwa', 'CL': 'bwa mem /home/someone/participant.fq'}]
+    }
+
+    with pysam.AlignmentFile(path, 'wb', header=header) as bam_file:
+        position = 0
+
+        for index in range(reads):
+            position += rng.randint(0, 20)
+            segment = pysam.AlignedSegment(bam_file.header)
+            segment.query_name = 'read{}'.format(index // 2)
+            segment.flag = 99 if index % 2 == 0 else 147
+            segment.reference_id = 0
+            segment.reference_start = position
+            segment.mapping_quality = 60
+            segment.cigartuples = [(0, read_length)]
+            segment.next_reference_id = 0
+            segment.next_reference_start = position
+            segment.template_length = read_length
+            segment.query_sequence = ''.join(rng.choice(BASES) for _ in range(read_length))
+            segment.query_qualities = pysam.qualitystring_to_array(
+                ''.join(chr(33 + rng.randint(2, 40)) for _ in range(read_length)))
+            segment.set_tag('RG', 'lane{}.flowcell'.format(index % read_groups))
+            bam_file.write(segment)
+
+
+def make_vcf(path, records, samples, info_width, seed=0):
+    """
+    Writes a VCF of records variants and samples genotype columns to path,
+    bgzipped if path ends in .gz
+
+    Each record has info_width INFO annotations, alternating between ones that
+    are kept and ones that are trimmed.
+    """
+    rng = random.Random(seed)
+    kept = sorted(WHITELISTED_ANNOTATIONS)
+    annotations = list(dict.fromkeys(
+        (kept if index % 2 == 0 else EXTRA_ANNOTATIONS)[index // 2 % len(kept if index % 2 == 0 else EXTRA_ANNOTATIONS)]
+        for index in range(info_width)))
+    lines = ['##fileformat=VCFv4.2', '##source=SomeCaller --input /home/someone/participant.bam']
+    lines.extend('##INFO=<ID={},Number=1,Type=String,Description="{}">'.format(name, name)
+                 for name in sorted(set(annotations)))
+    lines.append('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">')
+    lines.extend('##contig=<ID={},length=250000000>'.format(chromosome) for chromosome in range(1, 23))
+    lines.append('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] +
+                           ['sample{}'.format(sample) for sample in range(samples)]))
+    text = '\n'.join(lines) + '\n'
+    body = []
+    records_per_chromosome = max(records // 22, 1)
+
+    for index in range(records):
+        chromosome = min(index // records_per_chromosome, 21)
+        position = (index - chromosome * records_per_chromosome) * 100 + 1
+        (ref, alt) = rng.sample(BASES, 2)
+        info = ';'.join('{}={:.3f}'.format(name, rng.random()) for name in annotations) or '.'
+        genotypes = '\t'.join(rng.choice(('0/0', '0/1', '1/1')) for _ in range(samples))
+        body.append('{}\t{}\t.\t{}\t{}\t50\tPASS\t{}\tGT\t{}\n'.format(
+            chromosome + 1, position, ref, alt, info, genotypes))
+
+    if path.endswith('.gz'):
+        with pysam.BGZFile(path, 'wb') as vcf_file:
+            vcf_file.write(text.encode())
+            vcf_file.write(''.join(body).encode())
+    else:
+        with open(path, 'w') as vcf_file:
+            vcf_file.write(text)
+            vcf_file.writelines(body)
+
+
+def make_libraries(count):
+    """
+    Returns count XML libraries for BAMs of different samples
+    """
+    return [create_xml_library(
+        'blood', 'uuid{}'.format(index), 'Illumina HiSeq 2500', '0' * 32, '150,150', 'GRCh38',
+        'sample{}'.format(index), SECRET, index % 3 + 2, 'uuid{}.bam'.format(index)) for index in range(count)]
+
+
+class LocalStream:
+    """
+    Stands in for an S3 object body by reading a local file
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+
+    def read(self, size=-1):
+        """
+        Reads up to size bytes of the file, closing it at the end
+        """
+        data = self.file.read(size)
+
+        if not data:
+            self.file.close()
+
+        return data
+
+
+def time_step(step, setup, repeats):
+    """
+    Returns the times of repeats runs of step, each given the result of a
+    fresh call to setup, which is not timed
+    """
+    times = []
+
+    for _ in range(repeats):
+        argument = setup()
+        start_time = time.perf_counter()
+        step(argument)
+        times.append(time.perf_counter() - start_time)
+
+    return times
+
+
+def run(directory, args):
+    """
+    Generates the synthetic files in directory and times each step on them
+    """
+    steps = {}
+    source_bam = os.path.join(directory, 'source.bam')
+    source_vcf = os.path.join(directory, 'source.vcf.gz')
+    make_bam(source_bam, args.bam_reads, args.read_length, args.read_groups)
+    make_vcf(source_vcf, args.vcf_records, args.vcf_samples, args.info_width)
+    vcf_lines = []
+
+    with pysam.BGZFile(source_vcf, 'rb') as vcf_file:
+        for line in vcf_file:
+            vcf_lines.append(line.decode())
+
+            if line.startswith(b'#CHROM'):
+                break
+
+    workspaces = []
+
+    def new_workspace():
+        workspaces.append(Workspace(directory))
+
+        return workspaces[-1]
+
+    def bam_workspace():
+        workspace = new_workspace()
+        shutil.copyfile(source_bam, workspace.path('md5'))
+
+        return workspace
+
+    def tar_workspace():
+        workspace = new_workspace()
+        names = []
+
+        for index in range(args.tar_files):
+            names.append(workspace.path('sample{}.vcf.gz'.format(index)))
+            shutil.copyfile(source_vcf, names[-1])
+
+        return (workspace, names)
+
+    libraries = make_libraries(args.xml_libraries)
+    bam_size = os.path.getsize(source_bam)
+    vcf_size = os.path.getsize(source_vcf)
+
+    with patch('src.bams.get_s3_object_stream', side_effect=lambda bucket, key: LocalStream(source_bam)):
+        timed = [
+            ('bam_reheader', bam_size, bam_workspace,
+             lambda workspace: process_bam('NEW_SAMPLE', 'upload.bam', workspace.path('md5'), None, workspace)),
+            ('bam_stream_reheader', bam_size, new_workspace,
+             lambda workspace: process_bam_from_s3('NEW_SAMPLE', 'upload.bam', 'bucket', 'key', None, workspace)),
+            ('vcf_trim', vcf_size, new_workspace,
+             lambda workspace: trim_vcf(source_vcf, workspace.path('trimmed.vcf'), 'NEW_SAMPLE')),
+            ('vcf_header', None, lambda: vcf_lines,
+             lambda lines: [process_header(line, ('NEW_SAMPLE',)) for _ in range(100) for line in lines]),
+            ('vcf_compress_index', vcf_size, new_workspace,
+             lambda workspace: trim_and_compress_vcf(source_vcf, workspace.path('upload.vcf.gz'), 'NEW_SAMPLE')),
+            ('tar', vcf_size * args.tar_files, tar_workspace,
+             lambda files: tar_and_remove_files('archive', files[0].directory, files[1], None)),
+            ('xml', None, new_workspace,
+             lambda workspace: create_and_tar_xml(
+                 'blood', 'uuid', 'Illumina HiSeq 2500', '0' * 32, '150,150', 'GRCh38', 'sample', SECRET, 3,
+                 'uuid.bam', None, workspace)),
+            ('xml_batch', None, new_workspace,
+             lambda workspace: create_and_tar_batch_xml(libraries, 'xml_batch', None, workspace))
+        ]
+
+        for (name, size, setup, step) in timed:
+            if args.steps and name not in args.steps:
+                continue
+
+            times = time_step(step, setup, args.repeats)
+
+            while workspaces:
+                workspaces.pop().cleanup()
+
+            steps[name] = {'seconds': round(min(times), 4), 'median_seconds': round(statistics.median(times), 4)}
+
+            if size is not None:
+                steps[name]['bytes'] = size
+                steps[name]['mb_per_second'] = round(size / 2**20 / min(times), 1)
+
+    return steps
+
+
+def compare(steps, baseline, tolerance):
+    """
+    Returns the steps that took more than tolerance longer than in baseline
+    """
+    regressions = {}
+
+    for (name, result) in steps.items():
+        previous = baseline.get('steps', {}).get(name)
+
+        if previous and result['seconds'] > previous['seconds'] * (1 + tolerance):
+            regressions[name] = {
+                'seconds': result['seconds'],
+                'baseline_seconds': previous['seconds'],
+                'slowdown': round(result['seconds'] / previous['seconds'], 2)
+            }
+
+    return regressions
+
+
+def main():
+    """
+    Parses the arguments, runs the benchmarks and prints the results as JSON
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--directory', default=tempfile.gettempdir(), help='where to write the synthetic files')
+    parser.add_argument('--bam-reads', type=int, default=200000, help='reads in the synthetic BAM')
+    parser.add_argument('--read-length', type=int, default=150, help='length of each read')
+    parser.add_argument('--read-groups', type=int, default=4, help='read groups in the BAM header')
+    parser.add_argument('--vcf-records', type=int, default=200000, help='variants in the synthetic VCF')
+    parser.add_argument('--vcf-samples', type=int, default=1, help='genotype columns in the VCF')
+    parser.add_argument('--info-width', type=int, default=12, help='INFO annotations on each variant')
+    parser.add_argument('--tar-files', type=int, default=4, help='copies of the VCF added to the tar')
+    parser.add_argument('--xml-libraries', type=int, default=100, help='BAMs described by the batched XML')
+    parser.add_argument('--compute-processes', type=int, default=0,
+                        help='compute pool processes, 0 to time the steps in this process')
+    parser.add_argument('--repeats', type=int, default=3, help='runs of each step, the best is compared')
+    parser.add_argument('--steps', nargs='*', help='only run these steps')
+    parser.add_argument('--output', help='file to write the results to')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction a step may be slower than the baseline before it is flagged')
+    args = parser.parse_args()
+
+    COMPUTE_POOL.processes = args.compute_processes
+
+    # the steps' log lines would be mixed in with the results
+    with tempfile.TemporaryDirectory(dir=args.directory) as temp_dir, open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        results = {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'parameters': {name: value for (name, value) in vars(args).items()
+                           if name not in ('directory', 'output', 'baseline', 'steps')},
+            'steps': run(temp_dir, args)
+        }
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        differing = sorted(name for (name, value) in results['parameters'].items()
+                           if name not in ('repeats', 'tolerance') and baseline['parameters'].get(name) != value)
+
+        if differing:
+            print("Warning: the baseline was run with different {}".format(', '.join(differing)), file=sys.stderr)
+
+        results['regressions'] = compare(results['steps'], baseline, args.tolerance)
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if results.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
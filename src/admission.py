@@ -0,0 +1,144 @@
+"""
+Admission control that keeps the files being processed from filling /scratch
+"""
+import os
+import shutil
+import threading
+from src.utilities import write_to_logs
+
+# scratch space to leave free for everything else, such as logs
+SCRATCH_RESERVE_BYTES = int(float(os.environ.get('UPS_SCRATCH_RESERVE_GB', '10')) * 2**30)
+
+# total scratch space the files being processed may use, by default what is
+# free when the container starts less the reserve
+SCRATCH_BUDGET_BYTES = (int(float(os.environ['UPS_SCRATCH_BUDGET_GB']) * 2**30)
+                        if os.environ.get('UPS_SCRATCH_BUDGET_GB') else None)
+
+# peak scratch use as a multiple of the source object's size, keyed by file
+# type and whether the file is streamed from S3:
+#   * a downloaded BAM is on disk next to its reheadered copy
+#   * a downloaded VCF is on disk next to its bgzipped copy, which is then
+#     copied into the VCF archive
+SCRATCH_FOOTPRINT = {
+    ('BAM', False): 2.0,
+    ('BAM', True): 1.0,
+    ('VCF', False): 3.0,
+    ('VCF', True): 2.0
+}
+
+# allowance for the XML, tabix index and headers on top of the above
+FOOTPRINT_OVERHEAD_BYTES = 2**30
+
+# seconds between checks of free space while waiting for room in the budget
+ADMISSION_POLL_INTERVAL = 10
+
+
+def estimate_scratch_footprint(file_type, object_size, streaming=False):
+    """
+    Returns the most scratch space processing an object of object_size bytes
+    is expected to use at once
+    """
+    return int(object_size * SCRATCH_FOOTPRINT[(file_type, streaming)]) + FOOTPRINT_OVERHEAD_BYTES
+
+
+class ScratchSpaceError(Exception):
+    """
+    Raised when a file needs more scratch space than it could ever be given
+    """
+
+
+class DiskBudget:
+    """
+    Hands out reservations of scratch space so a file is only downloaded once
+    there is room for everything it will write
+
+    usage_functions return the bytes used by files that outlive the message
+    that wrote them, such as cached output and VCF archives, which count
+    against the budget alongside the reservations. evict_functions are given
+    the bytes a waiting reservation is short by and free what they can of
+    that, such as cached output no message is using.
+    """
+
+    def __init__(self, path='/scratch', budget_bytes=SCRATCH_BUDGET_BYTES, reserve_bytes=SCRATCH_RESERVE_BYTES,
+                 usage_functions=(), evict_functions=(), logger=None):
+        self.path = path
+        self.reserve_bytes = reserve_bytes
+        self.usage_functions = list(usage_functions)
+        self.evict_functions = list(evict_functions)
+        self.logger = logger
+        self.reserved = 0
+        self.condition = threading.Condition()
+
+        if budget_bytes is None:
+            # files already counted by usage_functions take up space that is
+            # not free at startup but is part of the budget
+            budget_bytes = max(shutil.disk_usage(path).free - reserve_bytes + self.used_bytes(), 0)
+
+        self.budget_bytes = budget_bytes
+
+    def used_bytes(self):
+        """
+        Returns the bytes used by files counted by usage_functions
+        """
+        return sum(usage() for usage in self.usage_functions)
+
+    def free_bytes(self):
+        """
+        Returns the space free on the scratch volume less the reserve
+        """
+        return shutil.disk_usage(self.path).free - self.reserve_bytes
+
+    def fits(self, size):
+        """
+        Returns whether size bytes fit in both the budget and the free space
+        """
+        return self.reserved + self.used_bytes() + size <= self.budget_bytes and size <= self.free_bytes()
+
+    def shortfall(self, size):
+        """
+        Returns how many bytes would have to be freed for size bytes to fit
+        """
+        return max(self.reserved + self.used_bytes() + size - self.budget_bytes, size - self.free_bytes())
+
+    def reserve(self, size, name):
+        """
+        Blocks until size bytes fit and reserves them for name, evicting what
+        evict_functions can free while it waits
+
+        Raises ScratchSpaceError if the file is larger than the whole budget,
+        since waiting would then never end. Cached output and VCF archives
+        are freed as their messages complete, so anything smaller waits.
+        """
+        with self.condition:
+            if size > self.budget_bytes:
+                raise ScratchSpaceError(
+                    "Admission: {} needs {} bytes of scratch space but the budget is {}".format(
+                        name, size, self.budget_bytes))
+
+            while not self.fits(size):
+                for evict in self.evict_functions:
+                    evict(self.shortfall(size))
+
+                if not self.fits(size):
+                    self.condition.wait(ADMISSION_POLL_INTERVAL)
+
+            self.reserved += size
+            write_to_logs("Admission: Reserved {} bytes for {} ({})".format(size, name, self.usage()), self.logger)
+
+        return size
+
+    def release(self, size, name):
+        """
+        Returns size bytes reserved for name to the budget
+        """
+        with self.condition:
+            self.reserved -= size
+            self.condition.notify_all()
+            write_to_logs("Admission: Released {} bytes for {} ({})".format(size, name, self.usage()), self.logger)
+
+    def usage(self):
+        """
+        Returns the budget usage as a log line
+        """
+        return "reserved={} used={} budget={} free={}".format(
+            self.reserved, self.used_bytes(), self.budget_bytes, self.free_bytes())
@@ -1,21 +1,184 @@
 """
 Code to tar files for sending to dbGaP
 """
+import errno
+import fcntl
 import os
 import tarfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from src.utilities import silent_remove, write_to_logs
 
+# largest number of bytes passed to one copy_file_range or sendfile call
+COPY_CHUNK_SIZE = 2**30
 
-def tar_and_remove_files(tar_file_name, tar_file_path, files_to_tar, logger):
+# bytes read at a time when neither copy_file_range nor sendfile can be used
+COPY_BUFFER_SIZE = 2**20
+
+# errors from copy_file_range or sendfile meaning the pair of files is not
+# supported, in which case the next way of copying is tried
+ZERO_COPY_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+
+def copy_file_payload(source_fd, destination_fd, size):
+    """
+    Copies size bytes from the current position of source_fd to the current
+    position of destination_fd inside the kernel
+
+    copy_file_range is tried first, since on filesystems that support it the
+    data may not be copied at all, then sendfile, then a copy through user
+    space for filesystems or kernels that support neither.
+    """
+    remaining = size
+
+    for copy in (lambda count: os.copy_file_range(source_fd, destination_fd, count),
+                 lambda count: os.sendfile(destination_fd, source_fd, None, count),
+                 lambda count: write_all(destination_fd, os.read(source_fd, min(count, COPY_BUFFER_SIZE)))):
+        try:
+            while remaining:
+                copied = copy(min(remaining, COPY_CHUNK_SIZE))
+
+                if copied == 0:
+                    raise Exception("File shrank while being copied, {} bytes missing".format(remaining))
+
+                remaining -= copied
+
+            return
+        except (AttributeError, OSError) as exc:
+            # a call that fails with these copies nothing, so the next way of
+            # copying carries on from the same position
+            if isinstance(exc, OSError) and exc.errno not in ZERO_COPY_UNSUPPORTED:
+                raise
+
+    raise Exception("Could not copy {} bytes into the tar".format(remaining))
+
+
+def write_all(fd, data):
+    """
+    Writes all of data to fd and returns its length
+    """
+    view = memoryview(data)
+
+    while view:
+        view = view[os.write(fd, view):]
+
+    return len(data)
+
+
+class TarWriter:
+    """
+    Writes a tar file the way tarfile does, but copies member payloads with
+    copy_file_range or sendfile instead of reading them into Python
+
+    If the file already exists, its members are read once and new members are
+    appended after them, like tarfile's "a" mode. The tar is locked with flock
+    until it is closed, so no other writer, even on another host sharing the
+    volume, appends to or truncates it meanwhile. Unless wait is set,
+    BlockingIOError is raised if another writer has it open.
+    """
+
+    def __init__(self, tar_file_name, wait=True):
+        self.name = tar_file_name
+        self.offset = 0
+        self.fd = os.open(tar_file_name, os.O_WRONLY | os.O_CREAT, 0o644)
+
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+            if os.fstat(self.fd).st_size:
+                with tarfile.open(tar_file_name) as existing:
+                    existing.getmembers()
+                    self.offset = existing.offset
+
+            os.ftruncate(self.fd, self.offset)
+            os.lseek(self.fd, self.offset, os.SEEK_SET)
+        except BaseException:
+            os.close(self.fd)
+            self.fd = None
+            raise
+
+    def write(self, data):
+        """
+        Writes data at the end of the tar
+        """
+        self.offset += write_all(self.fd, data)
+
+    def add(self, name, arcname=None):
+        """
+        Adds the regular file name to the tar as arcname
+
+        If adding the file fails, whatever was written of it is cut off so the
+        tar still ends after its last complete member.
+        """
+        start = self.offset
+
+        try:
+            with open(name, 'rb') as source:
+                stat = os.fstat(source.fileno())
+                tarinfo = tarfile.TarInfo((name if arcname is None else arcname).replace(os.sep, '/').lstrip('/'))
+                tarinfo.size = stat.st_size
+                tarinfo.mtime = stat.st_mtime
+                tarinfo.mode = stat.st_mode & 0o7777
+                tarinfo.uid = stat.st_uid
+                tarinfo.gid = stat.st_gid
+
+                self.write(tarinfo.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape'))
+                copy_file_payload(source.fileno(), self.fd, tarinfo.size)
+                self.offset += tarinfo.size
+
+            remainder = tarinfo.size % tarfile.BLOCKSIZE
+
+            if remainder:
+                self.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        except BaseException:
+            os.ftruncate(self.fd, start)
+            os.lseek(self.fd, start, os.SEEK_SET)
+            self.offset = start
+            raise
+
+    def close(self):
+        """
+        Writes the end of archive marker and closes the tar
+
+        offset is left at the end of the last member, where the next member
+        would be written.
+        """
+        if self.fd is None:
+            return
+
+        end_of_archive = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+        remainder = (self.offset + len(end_of_archive)) % tarfile.RECORDSIZE
+
+        if remainder:
+            end_of_archive += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+
+        write_all(self.fd, end_of_archive)
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def tar_and_remove_files(tar_file_name, tar_file_path, files_to_tar, logger, arcname_dir=None):
     """
     Tars the XML files
+
+    If arcname_dir is provided the files are stored under that directory in the
+    tar instead of under their full path on disk
     """
     tar_file_name = os.path.join(tar_file_path, '{}.tar'.format(tar_file_name))
-    with tarfile.open(tar_file_name, "a") as tar:
+    with TarWriter(tar_file_name) as tar:
         for name in files_to_tar:
             write_to_logs("Step 2 - Processing File: Adding {} to tar file".format(name))
             try:
-                tar.add(name, arcname=name, recursive=False)
+                arcname = name if arcname_dir is None else os.path.join(arcname_dir, os.path.basename(name))
+                tar.add(name, arcname=arcname)
                 silent_remove(name)
             except Exception as exc:
                 error_message = "Step 2 - Processing File: Error adding {} to tar file".format(name)
@@ -23,3 +186,211 @@ def tar_and_remove_files(tar_file_name, tar_file_path, files_to_tar, logger):
                 raise Exception(error_message) from exc
 
     return tar_file_name
+
+
+class RollingArchiveWriter:
+    """
+    Appends files to a tar that stays open between files, starting a new tar
+    once it reaches max_bytes
+
+    Reopening a tar in "a" mode reads every member header before appending,
+    which gets slower as the archive grows. Keeping it open avoids that and
+    lets the size be tracked in memory. Files are copied in by TarWriter, so
+    their contents never pass through Python. A full archive is renamed to a unique
+    name and passed to on_rollover in a background thread, so the next archive
+    fills while the previous one uploads. on_rollover removes the archive once
+    it is uploaded, so a rolled over archive still on disk is passed to it
+    again the next time the archive is rolled over in the background.
+    """
+
+    def __init__(self, directory, name, max_bytes, on_rollover=None, arcname_dir=None, logger=None):
+        self.directory = directory
+        self.name = name
+        self.max_bytes = max_bytes
+        self.on_rollover = on_rollover
+        self.arcname_dir = arcname_dir
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.tar = None
+        self.uploading = set()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archive-upload')
+
+    @property
+    def path(self):
+        """
+        Returns the path of the archive currently being filled
+        """
+        return os.path.join(self.directory, '{}.tar'.format(self.name))
+
+    @property
+    def size(self):
+        """
+        Returns the size of the archive currently being filled
+        """
+        with self.lock:
+            return self.current_size()
+
+    def current_size(self):
+        """
+        Returns the size of the open archive, or of one left on disk by an
+        earlier process, without taking the lock
+        """
+        if self.tar is not None:
+            return self.tar.offset
+
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def rolled_over_archives(self):
+        """
+        Returns the paths of rolled over archives still on disk, without
+        taking the lock
+        """
+        prefix = '{}_'.format(self.name)
+
+        return sorted(entry.path for entry in os.scandir(self.directory)
+                      if entry.name.startswith(prefix) and entry.name.endswith('.tar') and entry.is_file())
+
+    def disk_usage(self):
+        """
+        Returns the bytes used by the archive being filled and by rolled over
+        archives still on disk
+        """
+        with self.lock:
+            rolled_over = 0
+
+            for path in self.rolled_over_archives():
+                try:
+                    rolled_over += os.path.getsize(path)
+                except OSError:
+                    pass
+
+            return self.current_size() + rolled_over
+
+    def add(self, files_to_add):
+        """
+        Adds files_to_add to the archive and removes them, rolling the archive
+        over once it reaches max_bytes
+        """
+        with self.lock:
+            if self.tar is None:
+                # an archive left by an earlier process is appended to, which
+                # needs one scan of its members
+                self.tar = TarWriter(self.path)
+
+            for name in files_to_add:
+                write_to_logs("Step 2 - Processing File: Adding {} to tar file".format(name))
+
+                try:
+                    arcname = name if self.arcname_dir is None else os.path.join(
+                        self.arcname_dir, os.path.basename(name))
+                    self.tar.add(name, arcname=arcname)
+                    silent_remove(name)
+                except Exception as exc:
+                    error_message = "Step 2 - Processing File: Error adding {} to tar file".format(name)
+                    write_to_logs(error_message, self.logger)
+                    raise Exception(error_message) from exc
+
+            # rolled over before the lock is released, so no other worker
+            # can add to a full archive or roll it over a second time
+            if self.tar.offset < self.max_bytes:
+                return
+
+            write_to_logs("Step 3 - File Upload: Archive {} reached {} bytes, rolling over".format(
+                self.path, self.max_bytes), self.logger)
+            rolled_over = self.close_and_rename()
+
+        self.upload_in_background(rolled_over)
+
+    def adopt(self, path):
+        """
+        Renames an archive left behind by another writer to a rolled over
+        archive of this one, so it is uploaded with this writer's, returning
+        the new path
+
+        The archive is closed first, in case its writer stopped part way
+        through, which raises BlockingIOError if the writer still has it open.
+        """
+        with TarWriter(path, wait=False):
+            pass
+
+        with self.lock:
+            adopted = os.path.join(self.directory, '{}_{}.tar'.format(self.name, uuid.uuid1()))
+            os.rename(path, adopted)
+
+        return adopted
+
+    def roll_over_in_background(self):
+        """
+        Rolls the archive over and passes it to on_rollover in the background
+        thread, along with any earlier rolled over archive that is still on
+        disk and not being uploaded, returning the future of on_rollover for
+        the archive just rolled over, or None if there was no archive
+        """
+        rolled_over = self.roll_over()
+
+        with self.lock:
+            leftovers = [path for path in self.rolled_over_archives()
+                         if path != rolled_over and path not in self.uploading]
+
+        for path in leftovers:
+            write_to_logs("Step 3 - File Upload: Retrying upload of rolled over archive {}".format(path), self.logger)
+            self.upload_in_background(path)
+
+        return self.upload_in_background(rolled_over)
+
+    def upload_in_background(self, rolled_over):
+        """
+        Passes the rolled over archive to on_rollover in the background
+        thread, returning its future, or None if there is nothing to upload
+        """
+        if rolled_over is None or self.on_rollover is None:
+            return None
+
+        with self.lock:
+            self.uploading.add(rolled_over)
+
+        future = self.executor.submit(self.on_rollover, rolled_over)
+        future.add_done_callback(partial(self.finish_upload, rolled_over))
+
+        return future
+
+    def roll_over(self):
+        """
+        Closes the current archive and renames it to a unique name, returning
+        the new path, or None if there is no archive
+        """
+        with self.lock:
+            return self.close_and_rename()
+
+    def close_and_rename(self):
+        """
+        Closes the current archive and renames it to a unique name without
+        taking the lock, returning the new path, or None if there is no archive
+        """
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+
+        if not os.path.exists(self.path):
+            return None
+
+        rolled_over = os.path.join(self.directory, '{}_{}.tar'.format(self.name, uuid.uuid1()))
+        os.rename(self.path, rolled_over)
+
+        return rolled_over
+
+    def finish_upload(self, rolled_over, future):
+        """
+        Lets the rolled over archive be uploaded again and logs an error
+        raised by on_rollover in the background
+        """
+        with self.lock:
+            self.uploading.discard(rolled_over)
+
+        if future.exception() is not None:
+            write_to_logs(
+                "[ERROR] Step 3 - File Upload: Failed to upload rolled over archive {}, keeping it to retry, "
+                "with error {}".format(rolled_over, future.exception()), self.logger)
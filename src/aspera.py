@@ -0,0 +1,296 @@
+"""
+Utilities for uploading files with Aspera
+"""
+import asyncio
+import collections
+import os
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from src.utilities import write_to_logs
+
+ASCP_PATH = '/home/aspera/.aspera/connect/bin/ascp'
+
+# total rate shared by every ascp session in the container, in megabits per second
+ASPERA_BANDWIDTH_MBPS = int(os.environ.get('UPS_ASPERA_BANDWIDTH_MBPS', '5000'))
+ASPERA_MAX_SESSIONS = int(os.environ.get('UPS_ASPERA_MAX_SESSIONS', '2'))
+
+# seconds between progress log lines for each transfer
+PROGRESS_LOG_INTERVAL = 30
+
+# ascp progress lines look like "file.bam   45%  450MB  981Mb/s  00:12 ETA"
+PROGRESS_PATTERN = re.compile(
+    rb'(?P<percent>\d+)%\s+(?P<transferred>\d+(?:\.\d+)?[KMGT]?B)\s+'
+    rb'(?P<rate>\d+(?:\.\d+)?)(?P<rate_unit>[KMG]?)b/s\s+(?P<eta>\d+:\d+(?::\d+)?)')
+
+RATE_UNITS = {b'': 1e-6, b'K': 1e-3, b'M': 1, b'G': 1e3}
+
+
+def parse_progress(line):
+    """
+    Returns the percent complete, rate in megabits per second and ETA of an
+    ascp progress line, or None if the line does not report progress
+    """
+    match = PROGRESS_PATTERN.search(line)
+
+    if match is None:
+        return None
+
+    return {
+        'percent': int(match.group('percent')),
+        'transferred': match.group('transferred').decode(),
+        'rate_mbps': float(match.group('rate')) * RATE_UNITS[match.group('rate_unit')],
+        'eta': match.group('eta').decode()
+    }
+
+
+class AsperaTransferManager:
+    """
+    Runs up to max_sessions ascp sessions at a time, each limited to an equal
+    share of bandwidth_mbps
+
+    Submitting a transfer blocks while every session is busy, so workers can
+    carry on processing the next file while theirs uploads but cannot queue
+    up more uploads than there is bandwidth for. Once loop is set to a
+    running asyncio event loop, sessions run as subprocesses of that loop
+    instead of each holding a thread.
+    """
+
+    def __init__(self, ascp_path=ASCP_PATH, bandwidth_mbps=ASPERA_BANDWIDTH_MBPS,
+                 max_sessions=ASPERA_MAX_SESSIONS, logger=None):
+        self.ascp_path = ascp_path
+        self.session_rate_mbps = max(bandwidth_mbps // max_sessions, 1)
+        self.logger = logger
+        self.sessions = threading.BoundedSemaphore(max_sessions)
+        self.executor = ThreadPoolExecutor(max_workers=max_sessions, thread_name_prefix='ascp')
+        self.loop = None
+        self.progress = {}
+
+    def command(self, file_name, destination, key_file, ascp_args=()):
+        """
+        Returns the ascp command to upload file_name to destination
+        """
+        return ([self.ascp_path, '-i', key_file] + list(ascp_args) +
+                ['-l', '{}m'.format(self.session_rate_mbps), file_name, destination])
+
+    def run(self, file_name, destination, key_file, ascp_args=(), password=None):
+        """
+        Uploads file_name with ascp, logging its progress, and returns the last
+        progress it reported
+        """
+        command = self.command(file_name, destination, key_file, ascp_args)
+        transfer = self.start_transfer(file_name, destination)
+
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              env=ascp_environment(password)) as process:
+            for line in iter_output_lines(process.stdout):
+                self.record_output(file_name, line, transfer)
+
+        return self.finish_transfer(file_name, process.returncode, transfer)
+
+    async def run_async(self, file_name, destination, key_file, ascp_args=(), password=None):
+        """
+        Uploads file_name with an ascp subprocess of the running event loop,
+        logging its progress, and returns the last progress it reported
+
+        Cancelling the upload kills the subprocess.
+        """
+        command = self.command(file_name, destination, key_file, ascp_args)
+        transfer = self.start_transfer(file_name, destination)
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=ascp_environment(password))
+
+        try:
+            async for line in iter_output_lines_async(process.stdout):
+                self.record_output(file_name, line, transfer)
+
+            await process.wait()
+        except asyncio.CancelledError:
+            # a cancelled upload must not leave ascp running on its own
+            process.kill()
+            await process.wait()
+            self.progress.pop(file_name, None)
+            raise
+
+        return self.finish_transfer(file_name, process.returncode, transfer)
+
+    def start_transfer(self, file_name, destination):
+        """
+        Logs the start of an upload and returns what is tracked while it runs
+        """
+        write_to_logs("Step 3 - File Upload: Attempting to upload file {} via Aspera - {}".format(
+            file_name, destination), self.logger)
+
+        start_time = time.monotonic()
+
+        return {'output_tail': collections.deque(maxlen=20), 'start_time': start_time, 'last_logged': start_time}
+
+    def record_output(self, file_name, line, transfer):
+        """
+        Keeps a line of ascp output, logging the progress it reports every
+        PROGRESS_LOG_INTERVAL seconds
+        """
+        transfer['output_tail'].append(line)
+        progress = parse_progress(line)
+
+        if progress is None:
+            return
+
+        self.progress[file_name] = progress
+
+        if time.monotonic() - transfer['last_logged'] >= PROGRESS_LOG_INTERVAL:
+            transfer['last_logged'] = time.monotonic()
+            write_to_logs("Step 3 - File Upload: {} {}% sent at {:.0f} Mb/s, ETA {}".format(
+                os.path.basename(file_name), progress['percent'], progress['rate_mbps'],
+                progress['eta']), self.logger)
+
+    def finish_transfer(self, file_name, returncode, transfer):
+        """
+        Raises if ascp failed, otherwise logs the upload's throughput and
+        returns the last progress it reported
+        """
+        progress = self.progress.pop(file_name, None)
+
+        if returncode != 0:
+            raise Exception("ascp exited with {} uploading {}: {}".format(
+                returncode, file_name, b'\n'.join(transfer['output_tail']).decode('utf-8', 'replace')))
+
+        elapsed = max(time.monotonic() - transfer['start_time'], 1e-6)
+        size = os.path.getsize(file_name)
+        write_to_logs("Step 3 - File Upload: Aspera sent {} ({} bytes) in {:.1f}s ({:.1f} MB/s)".format(
+            file_name, size, elapsed, size / elapsed / 2**20), self.logger)
+
+        return progress
+
+    def submit(self, file_name, destination, key_file, ascp_args=(), password=None):
+        """
+        Starts uploading file_name once a session is free and returns a future
+        for the upload
+        """
+        self.sessions.acquire()
+
+        try:
+            if self.loop is not None:
+                future = asyncio.run_coroutine_threadsafe(
+                    self.run_async(file_name, destination, key_file, ascp_args, password), self.loop)
+            else:
+                future = self.executor.submit(self.run, file_name, destination, key_file, ascp_args, password)
+        except Exception:
+            self.sessions.release()
+            raise
+
+        future.add_done_callback(lambda _: self.sessions.release())
+
+        return future
+
+    def upload_files(self, file_names, destination, key_file, ascp_args=(), password=None):
+        """
+        Uploads each of file_names in its own session and returns a future that
+        completes when all of them are uploaded, or fails with the first error
+
+        password, if given, is passed to each ascp in its own environment
+        rather than set in this process's, which other threads read while
+        they start sessions.
+        """
+        return gather([self.submit(file_name, destination, key_file, ascp_args, password)
+                       for file_name in file_names])
+
+
+def ascp_environment(password=None):
+    """
+    Returns the environment to run ascp in, this process's with
+    ASPERA_SCP_FILEPASS set to password, or None to inherit it unchanged
+    """
+    if password is None:
+        return None
+
+    return dict(os.environ, ASPERA_SCP_FILEPASS=password)
+
+
+def split_output(remainder, chunk):
+    """
+    Splits the output remainder followed by chunk on either newlines or
+    carriage returns, since ascp redraws its progress line with carriage
+    returns, and returns the non-empty complete lines and what is left over
+    """
+    lines = re.split(rb'[\r\n]', remainder + chunk)
+    remainder = lines.pop()
+
+    return [line for line in lines if line.strip()], remainder
+
+
+def iter_output_lines(stream, chunk_size=4096):
+    """
+    Yields the non-empty lines of stream
+    """
+    remainder = b''
+
+    for chunk in iter(lambda: stream.read1(chunk_size), b''):
+        (lines, remainder) = split_output(remainder, chunk)
+        yield from lines
+
+    if remainder.strip():
+        yield remainder
+
+
+async def iter_output_lines_async(stream, chunk_size=4096):
+    """
+    Yields the non-empty lines of an asyncio stream
+    """
+    remainder = b''
+
+    while True:
+        chunk = await stream.read(chunk_size)
+
+        if not chunk:
+            break
+
+        (lines, remainder) = split_output(remainder, chunk)
+
+        for line in lines:
+            yield line
+
+    if remainder.strip():
+        yield remainder
+
+
+def gather(futures):
+    """
+    Returns a future that completes once every one of futures has, with their
+    results or the first exception raised, or cancelled if any of them was
+    """
+    combined = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+
+            if remaining[0] > 0:
+                return
+
+        if any(future.cancelled() for future in futures):
+            combined.set_exception(CancelledError())
+            return
+
+        errors = [future.exception() for future in futures if future.exception() is not None]
+
+        if errors:
+            combined.set_exception(errors[0])
+        else:
+            combined.set_result([future.result() for future in futures])
+
+    if not futures:
+        combined.set_result([])
+
+    for future in futures:
+        future.add_done_callback(on_done)
+
+    return combined
+
+
+# shared by every worker so the bandwidth budget covers the whole container
+TRANSFER_MANAGER = AsperaTransferManager()
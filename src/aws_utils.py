@@ -3,71 +3,278 @@ Utilities for interacting with AWS
 """
 import boto3
 import botocore
-import sys
+import os
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from src.utilities import write_to_logs
 
 ENDPOINT_URL = "https://secretsmanager.us-east-1.amazonaws.com"
 REGION_NAME = "us-east-1"
 
-SESSION = boto3.session.Session()
-SECRETS_CLIENT = SESSION.client(
-    service_name='secretsmanager', region_name=REGION_NAME, endpoint_url=ENDPOINT_URL)
+# S3 connections kept open by the shared client, which should cover every
+# concurrent part transfer across all workers
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('UPS_S3_MAX_POOL_CONNECTIONS', '64'))
+
+# seconds a secret is used before it is fetched again, so rotated secrets are picked up
+SECRETS_TTL_SECONDS = float(os.environ.get('UPS_SECRETS_TTL_SECONDS', '3600'))
+
+# seconds an expired secret keeps being used after fetching it again failed,
+# before the fetch is retried
+SECRETS_RETRY_SECONDS = 60
+
+# secrets the worker needs before it starts polling
+STARTUP_SECRET_IDS = ['ups-prod', 'ups-prod-aspera-key', 'ups-prod-aspera-vcf-key']
+
+ASPERA_KEY_FILES = {
+    'ups-prod-aspera-key': '/aspera/aspera.pk',
+    'ups-prod-aspera-vcf-key': '/aspera/aspera_vcf.pk'
+}
+
+_SESSION = None
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the boto3 session shared by every client in this process,
+    creating it on first use
+    """
+    global _SESSION
+
+    with _CLIENTS_LOCK:
+        if _SESSION is None:
+            _SESSION = boto3.session.Session()
+
+    return _SESSION
+
+
+def get_client(service_name, client_name=None, **kwargs):
+    """
+    Returns the client for service_name shared by this process, creating it on
+    first use
+
+    Nothing is created when the module is imported, so only the clients a
+    worker uses are built. Creating clients from one session is not thread
+    safe, so they are created under a lock, but the clients themselves are.
+    A client_name keeps a second client of the same service, such as one for
+    another endpoint, apart from the default one.
+    """
+    session = get_session()
+    client_name = client_name or service_name
+
+    with _CLIENTS_LOCK:
+        if client_name not in _CLIENTS:
+            _CLIENTS[client_name] = session.client(service_name, **kwargs)
+
+    return _CLIENTS[client_name]
+
+
+def get_secrets_client():
+    """
+    Returns the shared Secrets Manager client
+    """
+    return get_client('secretsmanager', region_name=REGION_NAME, endpoint_url=ENDPOINT_URL)
 
 
 def get_queue_by_name(name):
     """
     Returns the SQS queue associated with the name provided
     """
-    sqs = boto3.resource('sqs')
+    session = get_session()
+
+    with _CLIENTS_LOCK:
+        sqs = session.resource('sqs')
+
     return sqs.get_queue_by_name(QueueName=name)
 
 
-def get_s3_client():
+def get_s3_transfer_client():
     """
-    Returns an S3 client
+    Returns the S3 client shared by every transfer in this process
+
+    Unlike resources, clients are thread safe, so one client with a connection
+    pool sized for concurrent transfers is created and reused
     """
-    return boto3.resource('s3')
+    return get_client('s3', config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
 
 
-def get_secret_from_secrets_manager(secret_id):
+def get_s3_object_stream(bucket, key):
+    """
+    Returns a stream of the object's contents so it can be processed without
+    first downloading it to disk
+    """
+    return get_s3_transfer_client().get_object(Bucket=bucket, Key=key)['Body']
+
+
+def get_s3_object_metadata(bucket, key):
+    """
+    Returns the object's metadata, including its size (ContentLength), its
+    ETag, which changes whenever the object is replaced, and the checksum it
+    was uploaded with, if any
+    """
+    return get_s3_transfer_client().head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+
+
+def get_s3_object_part_size(bucket, key, part_number=1):
+    """
+    Returns the size of a part of an object uploaded in parts, by default
+    the first
     """
-    Returns the secret string from Secrets Manager
+    return get_s3_transfer_client().head_object(Bucket=bucket, Key=key, PartNumber=part_number)['ContentLength']
 
-    If unable to retrieve the secret it kills the running process
+
+def fetch_secret(secret_id):
+    """
+    Returns the secret string and version ID from Secrets Manager
+
+    Raises if unable to retrieve the secret, since this may run in a worker
+    thread where exiting would only end that thread
     """
     try:
-        secret_response = SECRETS_CLIENT.get_secret_value(SecretId=secret_id)
+        secret_response = get_secrets_client().get_secret_value(SecretId=secret_id)
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == 'ResourceNotFoundException':
-            print("The requested secret " + secret_id + " was not found")
+            reason = "was not found"
         elif e.response['Error']['Code'] == 'InvalidRequestException':
-            print("The request was invalid due to:", e)
+            reason = "request was invalid"
         elif e.response['Error']['Code'] == 'InvalidParameterException':
-            print("The request had invalid params:", e)
-        print('Fatal error. Stopping program.')
-        sys.exit()
+            reason = "request had invalid params"
+        else:
+            reason = "could not be retrieved"
+        raise Exception("The requested secret {} {}: {}".format(secret_id, reason, e)) from e
     else:
         if 'SecretString' in secret_response:
-            return json.loads(secret_response['SecretString'])
+            return json.loads(secret_response['SecretString']), secret_response.get('VersionId')
         elif 'SecretBinary' in secret_response:
-            return secret_response['SecretBinary']
+            return secret_response['SecretBinary'], secret_response.get('VersionId')
         else:
-            print('Fatal error. Unexpected secret type.')
-            sys.exit()
+            raise Exception("Unexpected type for secret {}".format(secret_id))
+
+
+class SecretCache:
+    """
+    Keeps secrets in memory for ttl_seconds so they are fetched once rather
+    than on every use
+
+    An expired secret is fetched again on its next use, which picks up a
+    rotated secret within ttl_seconds. The version a secret was fetched at is
+    kept, and a new entry is only made when it changes, so callers can tell
+    when a secret has been rotated. Each secret has its own
+    lock, so threads asking for the same secret wait for one fetch while
+    different secrets are fetched at the same time. If fetching an expired
+    secret fails, the error is logged and the old value is used for another
+    retry_seconds, so a brief Secrets Manager outage does not fail messages.
+    """
+
+    def __init__(self, ttl_seconds=SECRETS_TTL_SECONDS, fetch=fetch_secret, retry_seconds=SECRETS_RETRY_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.fetch = fetch
+        self.retry_seconds = retry_seconds
+        self.lock = threading.Lock()
+        self.secret_locks = {}
+        self.secrets = {}
+
+    def get_entry(self, secret_id):
+        """
+        Returns the cached value, version ID and fetch time of the secret,
+        fetching it if it is missing or expired
+        """
+        with self.lock:
+            secret_lock = self.secret_locks.setdefault(secret_id, threading.Lock())
+
+        with secret_lock:
+            entry = self.secrets.get(secret_id)
+
+            if entry is None or time.monotonic() - entry['fetched'] >= self.ttl_seconds:
+                try:
+                    (value, version_id) = self.fetch(secret_id)
+                except Exception as exc:
+                    if entry is None:
+                        raise
+
+                    write_to_logs(
+                        "[ERROR] Could not refresh secret {}, using the cached value: {}".format(secret_id, exc))
+                    # expires again once retry_seconds have passed
+                    entry['fetched'] = time.monotonic() - self.ttl_seconds + self.retry_seconds
+
+                    return entry
+
+                if entry is not None and entry['version_id'] == version_id:
+                    entry.update(value=value, fetched=time.monotonic())
+                else:
+                    if entry is not None:
+                        write_to_logs("Secret {} was rotated to version {}".format(secret_id, version_id))
+
+                    entry = {'value': value, 'version_id': version_id, 'fetched': time.monotonic()}
+                    self.secrets[secret_id] = entry
+
+        return entry
+
+    def get(self, secret_id):
+        """
+        Returns the secret, fetching it if it is missing or expired
+        """
+        return self.get_entry(secret_id)['value']
+
+    def get_many(self, secret_ids):
+        """
+        Returns a dict of the secrets, fetching the ones that are missing or
+        expired at the same time
+        """
+        with ThreadPoolExecutor(max_workers=max(len(secret_ids), 1), thread_name_prefix='secrets') as executor:
+            values = list(executor.map(self.get, secret_ids))
+
+        return dict(zip(secret_ids, values))
+
+    def invalidate(self, secret_id=None):
+        """
+        Forgets secret_id, or every secret, so it is fetched on its next use
+        """
+        with self.lock:
+            if secret_id is None:
+                self.secrets.clear()
+            else:
+                self.secrets.pop(secret_id, None)
+
+
+# shared by every worker so each secret is fetched once per TTL
+SECRET_CACHE = SecretCache()
+
+_ASPERA_KEY_LOCK = threading.Lock()
+
+
+def get_secret_from_secrets_manager(secret_id):
+    """
+    Returns the secret string from Secrets Manager, from the cache if it was
+    fetched within the TTL
+
+    Raises if unable to retrieve a secret that is not cached
+    """
+    return SECRET_CACHE.get(secret_id)
 
 
 def write_aspera_secrets_to_disk():
     """
-    Fetches Aspera secrets from Secrets Manager and writes them to disk
+    Writes the Aspera keys from Secrets Manager to disk
+
+    A key file is only rewritten when its secret has been rotated, and is
+    replaced in one step so a running ascp never reads a partial key
     """
-    aspera_key_secret = get_secret_from_secrets_manager('ups-prod-aspera-key')
-    aspera_file = open("/aspera/aspera.pk", "wb")
-    aspera_file.write(aspera_key_secret)
-    aspera_file.flush()
-    aspera_file.close()
+    for (secret_id, key_file) in ASPERA_KEY_FILES.items():
+        entry = SECRET_CACHE.get_entry(secret_id)
+
+        with _ASPERA_KEY_LOCK:
+            if entry.get('written') and os.path.exists(key_file):
+                continue
+
+            temp_key_file = '{}.tmp'.format(key_file)
+
+            with open(temp_key_file, "wb") as aspera_file:
+                aspera_file.write(entry['value'])
 
-    aspera_vcf_key_secret = get_secret_from_secrets_manager('ups-prod-aspera-vcf-key')
-    aspera_vcf_file = open("/aspera/aspera_vcf.pk", "wb")
-    aspera_vcf_file.write(aspera_vcf_key_secret)
-    aspera_vcf_file.flush()
-    aspera_vcf_file.close()
+            os.replace(temp_key_file, key_file)
+            entry['written'] = True
@@ -1,27 +1,26 @@
 """
 Utilities for processing BAM files
 """
-import hashlib
+import io
 import os
-from subprocess import call, check_output, CalledProcessError
-from utilities import write_to_logs
+import struct
+from src.aws_utils import get_s3_object_stream
+from src.bgzf import BGZF_EOF, BgzfWriter, block_data, iter_blocks
+from src.checksums import verify_checksums
+from src.compute import COMPUTE_POOL
+from src.streaming import HashingReader, HashingWriter
+from src.utilities import write_to_logs
 
+BAM_MAGIC = b'BAM\x01'
 
-def process_bam(sample_id, upload_file_name, temp_file, logger):
-    """
-    Process the BAM - clean up headers and MD5
-    """
-    bam_headers = list()
-    write_to_logs("Step 2 - Processing File: Running samtools on BAM")
+STREAM_BUFFER_SIZE = 2**20
 
-    try:
-        bam_headers = check_output(['samtools', 'view', '-H', temp_file]).decode('ascii').split('\n')
-    except CalledProcessError as exc:
-        error_message = "[ERROR] Step 2 - Processing File: Unable to retrieve headers from BAM file {} with error {}".format(
-            upload_file_name, exc)
-        write_to_logs(error_message, logger)
-        raise Exception(error_message) from exc
 
+def rewrite_bam_headers(bam_headers, sample_id):
+    """
+    Returns the BAM header lines with the read groups replaced by a single
+    anonymous read group for sample_id and the @PG lines removed
+    """
     output_headers = list()
     for header in bam_headers:
         if header.startswith('@RG'):
@@ -39,43 +38,189 @@ def process_bam(sample_id, upload_file_name, temp_file, logger):
         else:
             output_headers.append(header)
 
-    with open('/scratch/new_headers.sam', 'w') as new_headers:
-        new_headers.write('\n'.join(output_headers))
+    return output_headers
 
-    with open('/scratch/md5_reheader', 'wb') as reheader:
-        try:
-            call(['samtools', 'reheader', '-P', '/scratch/new_headers.sam', temp_file], stdout=reheader)
-        except CalledProcessError as exc:
-            error_message = "[ERROR] Step 2 - Processing File: Unable to run samtools reheader command on BAM file {} with error {}".format(
-                upload_file_name, exc)
-            write_to_logs(error_message, logger)
-            raise Exception(error_message) from exc
 
-    os.rename('/scratch/md5_reheader', os.path.join('/scratch', upload_file_name))
+def parse_bam_header(data):
+    """
+    Parses the header at the start of uncompressed BAM data
 
-    write_to_logs("Step 2 - Processing File: Completed reheader now calling quickcheck")
+    Returns a tuple of the SAM header text, the encoded reference sequence
+    list and the total length of the header, or None if data does not yet
+    contain the whole header
+    """
+    if len(data) < 12:
+        return None
 
-    quickcheck_result = call('samtools quickcheck -v {} && exit 0 || exit 1'.format(temp_file), shell=True)
+    if data[:4] != BAM_MAGIC:
+        raise ValueError("File is not a BAM")
 
-    if quickcheck_result == 0:
-        write_to_logs("Step 2 - Processing File: Quickcheck completed successfully now attempting MD5")
-    else:
-        error_message = "[ERROR] Step 2 - Processing File: Quickcheck failed on reheadered BAM {}".format(
-            upload_file_name)
-        write_to_logs(error_message, logger)
-        raise Exception(error_message)
+    (text_length,) = struct.unpack_from('<i', data, 4)
+    offset = 8 + text_length
+
+    if len(data) < offset + 4:
+        return None
+
+    text = data[8:offset].decode('ascii').rstrip('\0')
+    references_start = offset
+    (reference_count,) = struct.unpack_from('<i', data, offset)
+    offset += 4
+
+    for _ in range(reference_count):
+        if len(data) < offset + 4:
+            return None
+
+        (name_length,) = struct.unpack_from('<i', data, offset)
+        offset += 4 + name_length + 4
+
+        if len(data) < offset:
+            return None
+
+    return text, data[references_start:offset], offset
+
+
+def encode_bam_header(text, references):
+    """
+    Returns the binary BAM header for the SAM header text and encoded reference list
+    """
+    encoded_text = text.encode('ascii')
+
+    return BAM_MAGIC + struct.pack('<i', len(encoded_text)) + encoded_text + references
+
+
+def reheader_bam(input_file, output_file, sample_id):
+    """
+    Copies a BAM from input_file to output_file with rewritten headers in a single pass
+
+    Only the blocks holding the header are decompressed, the rest of the
+    compressed blocks are copied as they are. The output is MD5'd from the same
+    buffers as it is written and the input must end with the BGZF EOF marker.
+
+    Returns the MD5 of the output
+    """
+    blocks = iter_blocks(input_file)
+    header_data = b''
+    parsed_header = None
+
+    for block in blocks:
+        header_data += block_data(block)
+        parsed_header = parse_bam_header(header_data)
+
+        if parsed_header is not None:
+            break
+
+    if parsed_header is None:
+        raise ValueError("BAM ended before the end of its header")
+
+    (text, references, header_length) = parsed_header
+    new_text = '\n'.join(line for line in rewrite_bam_headers(text.split('\n'), sample_id) if line) + '\n'
+
+    output = HashingWriter(output_file)
+    writer = BgzfWriter(output)
+
+    writer.write(encode_bam_header(new_text, references))
+    writer.flush()
+
+    # alignments that shared the last header block
+    writer.write(header_data[header_length:])
+    writer.flush()
+
+    last_block = None
 
-    md5_hash = hashlib.md5()
+    for block in blocks:
+        if last_block is not None:
+            writer.write_raw_block(last_block)
 
-    with open('/scratch/' + upload_file_name, 'rb') as upload_file:
-        while True:
-            buf = upload_file.read(2**20)
+        last_block = block
 
-            if not buf:
-                break
+    if last_block != BGZF_EOF:
+        raise ValueError("BAM is truncated, it does not end with the BGZF EOF marker")
 
-            md5_hash.update(buf)
+    writer.close()
+
+    return output.hexdigest()
+
+
+def reheader_bam_file(input_path, output_path, sample_id):
+    """
+    Reheaders the BAM at input_path into output_path and returns the MD5 of
+    the output. Run in a compute process.
+    """
+    with open(input_path, 'rb') as input_file, open(output_path, 'wb') as output_file:
+        return reheader_bam(input_file, output_file, sample_id)
+
+
+def process_bam(sample_id, upload_file_name, temp_file, logger, workspace):
+    """
+    Process the BAM - clean up headers and MD5
+
+    The reheadering and MD5 run in the compute pool. All intermediate and
+    output files are written to the workspace
+    """
+    write_to_logs("Step 2 - Processing File: Reheadering BAM")
+
+    md5_checksum = reheader_output(
+        upload_file_name,
+        lambda reheader_file: COMPUTE_POOL.run(reheader_bam_file, temp_file, reheader_file, sample_id),
+        logger, workspace)
 
     write_to_logs("Step 2 - Processing File: MD5 completed successfully")
 
-    return md5_hash.hexdigest()
+    return md5_checksum
+
+
+def process_bam_from_s3(sample_id, upload_file_name, bucket, key, logger, workspace, expected=None):
+    """
+    Process the BAM while it streams in from S3, so the original is never
+    stored on disk
+
+    If expected checksums are given, the streamed object is checked against
+    them once it has been read
+    """
+    write_to_logs("Step 2 - Processing File: Streaming BAM from S3 and reheadering")
+
+    source = HashingReader(get_s3_object_stream(bucket, key), expected and expected['part_size'])
+    input_file = io.BufferedReader(source, STREAM_BUFFER_SIZE)
+
+    def reheader(reheader_file):
+        with open(reheader_file, 'wb') as output_file:
+            return reheader_bam(input_file, output_file, sample_id)
+
+    md5_checksum = reheader_output(upload_file_name, reheader, logger, workspace)
+
+    write_to_logs("Step 2 - Processing File: Streamed {} bytes with source MD5 {}".format(
+        source.bytes_read, source.hexdigest()))
+
+    if expected is not None:
+        try:
+            verify_checksums(source.checksums.result(), expected, upload_file_name)
+        except Exception as exc:
+            error_message = "[ERROR] Step 2 - Processing File: Streamed BAM {}".format(exc)
+            write_to_logs(error_message, logger)
+            raise Exception(error_message) from exc
+
+    write_to_logs("Step 2 - Processing File: MD5 completed successfully")
+
+    return md5_checksum
+
+
+def reheader_output(upload_file_name, reheader, logger, workspace):
+    """
+    Calls reheader with the path to write the reheadered BAM to, then moves
+    it to upload_file_name in the workspace and returns the MD5 reheader
+    returned
+    """
+    reheader_file = workspace.path('md5_reheader')
+    output_file = workspace.path(upload_file_name)
+
+    try:
+        md5_checksum = reheader(reheader_file)
+    except Exception as exc:
+        error_message = "[ERROR] Step 2 - Processing File: Unable to reheader BAM file {} with error {}".format(
+            upload_file_name, exc)
+        write_to_logs(error_message, logger)
+        raise Exception(error_message) from exc
+
+    os.rename(reheader_file, output_file)
+
+    return md5_checksum
@@ -0,0 +1,283 @@
+"""
+Utilities for reading and writing BGZF, the blocked gzip format used by BAM
+files and tabix indexed VCF files
+"""
+import struct
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+BGZF_HEADER_SIZE = 18
+BGZF_FOOTER_SIZE = 8
+BGZF_MAX_BLOCK_SIZE = 0x10000
+
+# uncompressed bytes per block, the same value htslib uses so a block always compresses under 64 KiB
+BGZF_BLOCK_DATA_SIZE = 0xff00
+
+# the empty block every BGZF file must end with
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+BGZF_HEADER = struct.Struct('<4BI2BH2BHH')
+
+
+def compress_block(data, level=6):
+    """
+    Returns data compressed into a single BGZF block
+
+    data must not be longer than BGZF_BLOCK_DATA_SIZE
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    block_size = BGZF_HEADER_SIZE + len(cdata) + BGZF_FOOTER_SIZE
+
+    if block_size > BGZF_MAX_BLOCK_SIZE:
+        raise ValueError("BGZF block of {} bytes does not fit in 64 KiB once compressed".format(len(data)))
+
+    header = BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, block_size - 1)
+    footer = struct.pack('<2I', zlib.crc32(data), len(data))
+
+    return header + cdata + footer
+
+
+def read_block(fileobj):
+    """
+    Reads the next raw (still compressed) BGZF block from fileobj
+
+    Returns b'' at the end of the file
+    """
+    header = _read_exactly(fileobj, BGZF_HEADER_SIZE)
+
+    if not header:
+        return b''
+
+    block_size = parse_block_size(header)
+    rest = _read_exactly(fileobj, block_size - BGZF_HEADER_SIZE)
+
+    if len(rest) != block_size - BGZF_HEADER_SIZE:
+        raise ValueError("Truncated BGZF block")
+
+    return header + rest
+
+
+def parse_block_size(header):
+    """
+    Returns the total size of the BGZF block starting with header
+    """
+    if len(header) < BGZF_HEADER_SIZE:
+        raise ValueError("Truncated BGZF block header")
+
+    fields = BGZF_HEADER.unpack_from(header)
+
+    if fields[:4] != (31, 139, 8, 4) or fields[7:11] != (6, 66, 67, 2):
+        raise ValueError("Not a BGZF block")
+
+    return fields[11] + 1
+
+
+def block_data(block):
+    """
+    Returns the uncompressed contents of a raw BGZF block
+    """
+    data = zlib.decompress(block[BGZF_HEADER_SIZE:-BGZF_FOOTER_SIZE], -15)
+    crc, size = struct.unpack('<2I', block[-BGZF_FOOTER_SIZE:])
+
+    if size != len(data) or crc != zlib.crc32(data):
+        raise ValueError("BGZF block failed its CRC check")
+
+    return data
+
+
+def iter_blocks(fileobj):
+    """
+    Yields the raw BGZF blocks in fileobj
+    """
+    while True:
+        block = read_block(fileobj)
+
+        if not block:
+            return
+
+        yield block
+
+
+def _read_exactly(fileobj, size):
+    """
+    Reads size bytes from fileobj, which may be a stream returning short reads
+    """
+    chunks = []
+    remaining = size
+
+    while remaining:
+        chunk = fileobj.read(remaining)
+
+        if not chunk:
+            break
+
+        chunks.append(chunk)
+        remaining -= len(chunk)
+
+    return b''.join(chunks)
+
+
+class BgzfWriter:
+    """
+    Writes data to fileobj as BGZF blocks, finishing with the EOF block on close
+    """
+
+    def __init__(self, fileobj, level=6):
+        self.fileobj = fileobj
+        self.level = level
+        self.buffer = bytearray()
+        self.compressed_offset = 0
+
+    def write(self, data):
+        """
+        Buffers data, writing out each block as it fills
+        """
+        self.buffer.extend(data)
+
+        while len(self.buffer) >= BGZF_BLOCK_DATA_SIZE:
+            self._write_block(bytes(self.buffer[:BGZF_BLOCK_DATA_SIZE]))
+            del self.buffer[:BGZF_BLOCK_DATA_SIZE]
+
+    def write_raw_block(self, block):
+        """
+        Copies an already compressed block to the output after any buffered data
+        """
+        self.flush()
+        self.fileobj.write(block)
+        self.compressed_offset += len(block)
+
+    def tell(self):
+        """
+        Returns the BGZF virtual offset of the next byte written
+        """
+        return (self.compressed_offset << 16) | len(self.buffer)
+
+    def flush(self):
+        """
+        Writes any buffered data as a (possibly short) block
+        """
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer.clear()
+
+    def close(self):
+        """
+        Flushes buffered data and writes the EOF block, leaving fileobj open
+        """
+        self.flush()
+        self.fileobj.write(BGZF_EOF)
+        self.compressed_offset += len(BGZF_EOF)
+
+    def _write_block(self, data):
+        block = compress_block(data, self.level)
+        self.fileobj.write(block)
+        self.compressed_offset += len(block)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class ParallelBgzfWriter:
+    """
+    Writes data to fileobj as BGZF blocks compressed across a pool of threads
+
+    zlib releases the GIL while compressing, so blocks compress in parallel
+    while they are still written to fileobj in order. The start of every
+    block is recorded so uncompressed offsets can be turned into virtual
+    offsets, e.g. for building an index, once the file is closed.
+    """
+
+    def __init__(self, fileobj, threads=1, level=6):
+        self.fileobj = fileobj
+        self.level = level
+        self.buffer = bytearray()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = threads * 4
+        self.pending = deque()
+        self.submitted_offset = 0
+        self.uncompressed_offset = 0
+        self.compressed_offset = 0
+        self.block_uncompressed_starts = array('Q')
+        self.block_compressed_starts = array('Q')
+
+    def write(self, data):
+        """
+        Buffers data, handing each block to the pool as it fills
+        """
+        self.buffer.extend(data)
+
+        while len(self.buffer) >= BGZF_BLOCK_DATA_SIZE:
+            self._submit_block(bytes(self.buffer[:BGZF_BLOCK_DATA_SIZE]))
+            del self.buffer[:BGZF_BLOCK_DATA_SIZE]
+
+    def tell(self):
+        """
+        Returns the uncompressed offset of the next byte written
+        """
+        return self.submitted_offset + len(self.buffer)
+
+    def virtual_offset(self, uncompressed_offset):
+        """
+        Returns the BGZF virtual offset of an uncompressed offset that has
+        already been written out, which is everything once the writer is closed
+        """
+        index = bisect_right(self.block_uncompressed_starts, uncompressed_offset) - 1
+
+        return ((self.block_compressed_starts[index] << 16) |
+                (uncompressed_offset - self.block_uncompressed_starts[index]))
+
+    def close(self):
+        """
+        Compresses buffered data, writes the EOF block and shuts down the pool,
+        leaving fileobj open
+        """
+        if self.buffer:
+            self._submit_block(bytes(self.buffer))
+            self.buffer.clear()
+
+        while self.pending:
+            self._write_next_block()
+
+        self.executor.shutdown()
+
+        # the end of the data points at the EOF block
+        self.block_uncompressed_starts.append(self.uncompressed_offset)
+        self.block_compressed_starts.append(self.compressed_offset)
+
+        self.fileobj.write(BGZF_EOF)
+        self.compressed_offset += len(BGZF_EOF)
+
+    def _submit_block(self, data):
+        self.submitted_offset += len(data)
+        self.pending.append((len(data), self.executor.submit(compress_block, data, self.level)))
+
+        if len(self.pending) > self.max_pending:
+            self._write_next_block()
+
+    def _write_next_block(self):
+        (size, future) = self.pending.popleft()
+        block = future.result()
+
+        self.block_uncompressed_starts.append(self.uncompressed_offset)
+        self.block_compressed_starts.append(self.compressed_offset)
+
+        self.fileobj.write(block)
+        self.uncompressed_offset += size
+        self.compressed_offset += len(block)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(cancel_futures=True)
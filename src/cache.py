@@ -0,0 +1,176 @@
+"""
+An on-disk cache of processed files so a redelivered message can skip
+straight to uploading them
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from src.utilities import write_to_logs
+
+CACHE_DIR = '/scratch/cache'
+CACHE_MAX_BYTES = int(float(os.environ.get('UPS_CACHE_MAX_GB', '250')) * 2**30)
+
+METADATA_FILE = 'metadata.json'
+
+
+def cache_key(*parts):
+    """
+    Returns the cache key for the given parts, for example the source bucket,
+    key and ETag and the sample ID
+    """
+    return hashlib.sha256('\x00'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+class OutputCache:
+    """
+    Keeps the processed files of a message until it completes
+
+    Each entry is a directory holding the files, with their original names,
+    and a metadata file. Entries are evicted least recently used first when the
+    cache grows past max_bytes, except for entries a worker is still using.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, logger=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.in_use = set()
+
+    def entry_dir(self, key):
+        """
+        Returns the directory of the entry for key
+        """
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """
+        Returns the metadata of the entry for key, with the full path of each
+        of its files, or None if there is no complete entry
+
+        The entry is kept from eviction until it is released
+        """
+        with self.lock:
+            metadata_file = os.path.join(self.entry_dir(key), METADATA_FILE)
+
+            try:
+                with open(metadata_file) as metadata_handle:
+                    metadata = json.load(metadata_handle)
+            except (OSError, ValueError):
+                return None
+
+            files = {name: os.path.join(self.entry_dir(key), file_name)
+                     for (name, file_name) in metadata['files'].items()}
+
+            if not all(os.path.exists(path) for path in files.values()):
+                return None
+
+            # the metadata file's modification time orders entries for eviction
+            os.utime(metadata_file)
+            self.in_use.add(key)
+
+        metadata['files'] = files
+
+        return metadata
+
+    def put(self, key, files, metadata=None):
+        """
+        Moves files, a dict of name to path, into the entry for key along with
+        metadata and returns the entry as get() would
+
+        The entry is kept from eviction until it is released
+        """
+        temp_dir = '{}.tmp'.format(self.entry_dir(key))
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(temp_dir)
+
+        for path in files.values():
+            shutil.move(path, os.path.join(temp_dir, os.path.basename(path)))
+
+        metadata = dict(metadata or {})
+        metadata['files'] = {name: os.path.basename(path) for (name, path) in files.items()}
+        metadata['created'] = time.time()
+
+        with open(os.path.join(temp_dir, METADATA_FILE), 'w') as metadata_handle:
+            json.dump(metadata, metadata_handle)
+
+        with self.lock:
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            os.rename(temp_dir, self.entry_dir(key))
+            self.in_use.add(key)
+
+        self.evict()
+
+        return self.get(key)
+
+    def release(self, key):
+        """
+        Lets the entry for key be evicted again
+        """
+        with self.lock:
+            self.in_use.discard(key)
+
+    def remove(self, key):
+        """
+        Removes the entry for key
+        """
+        with self.lock:
+            self.in_use.discard(key)
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+
+    def entry_sizes(self):
+        """
+        Returns the last use time, key and size of each complete entry,
+        without taking the lock
+        """
+        entries = []
+
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self.entry_dir(key)
+            metadata_file = os.path.join(entry_dir, METADATA_FILE)
+
+            # skip entries that are still being written
+            if key.endswith('.tmp') or not os.path.exists(metadata_file):
+                continue
+
+            size = sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+            entries.append((os.path.getmtime(metadata_file), key, size))
+
+        return entries
+
+    def size(self):
+        """
+        Returns the bytes used by the cache's entries
+        """
+        with self.lock:
+            if not os.path.isdir(self.cache_dir):
+                return 0
+
+            return sum(size for (_, _, size) in self.entry_sizes())
+
+    def evict(self, needed_bytes=0):
+        """
+        Removes least recently used entries until the cache fits in max_bytes
+        and, when scratch space is short, until needed_bytes have been freed
+        """
+        with self.lock:
+            if not os.path.isdir(self.cache_dir):
+                return
+
+            entries = self.entry_sizes()
+            total_size = sum(size for (_, _, size) in entries)
+            target_size = min(self.max_bytes, total_size - needed_bytes)
+
+            for (_, key, size) in sorted(entries):
+                if total_size <= target_size:
+                    break
+
+                if key in self.in_use:
+                    continue
+
+                write_to_logs("Evicting cached files {} ({} bytes)".format(key, size), self.logger)
+                shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+                total_size -= size
@@ -0,0 +1,229 @@
+"""
+Checksums of files and streams, and checks that they match the S3 object
+they came from
+"""
+import base64
+import hashlib
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import botocore
+from src.aws_utils import get_s3_object_part_size
+from src.utilities import write_to_logs
+
+# bytes read into the reused buffer at a time
+CHECKSUM_BUFFER_SIZE = 8 * 2**20
+
+# check downloaded and streamed files against the size, ETag and SHA-256 S3 has for them
+VERIFY_DOWNLOADS = os.environ.get('UPS_VERIFY_DOWNLOADS', 'true').lower() == 'true'
+
+
+class Checksums:
+    """
+    Computes the MD5, SHA-256 and S3 ETag of data in one pass
+
+    With a part_size the ETag is the one S3 gives an object uploaded in parts
+    of that size, the MD5 of the parts' MD5s followed by the number of parts.
+    part_size can also be a list of the size of each part, for an object
+    uploaded in parts of different sizes. Without one it is the MD5. If executor is given the SHA-256 is computed
+    in it while this thread computes the MD5s, since hashlib releases the GIL.
+    """
+
+    def __init__(self, part_size=None, executor=None):
+        self.part_size = part_size
+        self.executor = executor
+        self.md5_hash = hashlib.md5()
+        self.sha256_hash = hashlib.sha256()
+        self.part_hash = hashlib.md5()
+        self.part_digests = []
+        self.part_bytes = 0
+        self.size = 0
+
+    def update(self, data):
+        """
+        Adds data to the checksums
+        """
+        sha256_update = self.executor.submit(self.sha256_hash.update, data) if self.executor else None
+
+        if sha256_update is None:
+            self.sha256_hash.update(data)
+
+        self.md5_hash.update(data)
+        self.size += len(data)
+
+        if self.part_size:
+            view = memoryview(data)
+
+            while view:
+                if self.part_bytes == self.current_part_size():
+                    self.part_digests.append(self.part_hash.digest())
+                    self.part_hash = hashlib.md5()
+                    self.part_bytes = 0
+
+                piece = view[:self.current_part_size() - self.part_bytes]
+                self.part_hash.update(piece)
+                self.part_bytes += len(piece)
+                view = view[len(piece):]
+
+        if sha256_update is not None:
+            sha256_update.result()
+
+    def current_part_size(self):
+        """
+        Returns the size of the part being hashed, the rest of the data if it
+        is past the last of a list of part sizes
+        """
+        if not isinstance(self.part_size, list):
+            return self.part_size
+
+        index = len(self.part_digests)
+
+        return self.part_size[index] if index < len(self.part_size) else sys.maxsize
+
+    def etag(self):
+        """
+        Returns the ETag S3 would give the data
+        """
+        if not self.part_size:
+            return self.md5_hash.hexdigest()
+
+        digests = self.part_digests + ([self.part_hash.digest()] if self.part_bytes or not self.part_digests else [])
+
+        return '{}-{}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+    def hexdigest(self):
+        """
+        Returns the MD5 of the data
+        """
+        return self.md5_hash.hexdigest()
+
+    def result(self):
+        """
+        Returns the size and checksums of the data
+        """
+        return {
+            'size': self.size,
+            'md5': self.md5_hash.hexdigest(),
+            'sha256': self.sha256_hash.hexdigest(),
+            'etag': self.etag()
+        }
+
+
+def file_checksums(file_name, part_size=None, buffer_size=CHECKSUM_BUFFER_SIZE):
+    """
+    Returns the size, MD5, SHA-256 and S3 ETag of a file
+
+    The file is read with readinto into one buffer that is reused for the
+    whole file, and the SHA-256 is computed in a second thread alongside the
+    MD5s.
+    """
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+
+    with ThreadPoolExecutor(max_workers=1) as executor, open(file_name, 'rb', buffering=0) as input_file:
+        checksums = Checksums(part_size, executor)
+
+        while True:
+            size = input_file.readinto(buffer)
+
+            if not size:
+                break
+
+            checksums.update(view[:size])
+
+    return checksums.result()
+
+
+def expected_checksums(bucket, key, object_metadata):
+    """
+    Returns what S3 says the object's size, ETag and SHA-256 are, from its
+    HeadObject response
+
+    The ETag is left out when it is not derived from the contents, which is
+    the case for objects encrypted with KMS or customer keys. The SHA-256 is
+    only included when the object was uploaded with a full-object SHA-256
+    checksum. For an ETag of an object uploaded in parts, the size of its
+    first part is looked up, since the ETag depends on it. If the object
+    cannot have been uploaded in parts of that size followed by a smaller
+    last part, the size of each part is looked up instead, and if that
+    fails the ETag is left out, since it cannot be reproduced.
+    """
+    expected = {'size': object_metadata['ContentLength'], 'part_size': None}
+    etag = object_metadata['ETag'].strip('"')
+    sha256 = object_metadata.get('ChecksumSHA256')
+
+    if object_metadata.get('ServerSideEncryption') != 'aws:kms' and not object_metadata.get('SSECustomerAlgorithm'):
+        expected['etag'] = etag
+
+        if '-' in etag:
+            expected['part_size'] = multipart_part_sizes(bucket, key, expected['size'], int(etag.split('-')[1]))
+
+            if expected['part_size'] is None:
+                del expected['etag']
+
+    if sha256 and '-' not in sha256:
+        expected['sha256'] = base64.b64decode(sha256).hex()
+
+    return expected
+
+
+def multipart_part_sizes(bucket, key, size, part_count):
+    """
+    Returns the size of the first part of an object of size bytes uploaded in
+    part_count parts if every other part but the last could be that size,
+    otherwise a list of the size of each part, or None if they do not add up
+    to size or cannot be looked up
+    """
+    part_size = get_s3_object_part_size(bucket, key)
+
+    if part_size and -(-size // part_size) == part_count:
+        return part_size
+
+    try:
+        part_sizes = [part_size] + [get_s3_object_part_size(bucket, key, part_number)
+                                    for part_number in range(2, part_count + 1)]
+    except botocore.exceptions.ClientError as exc:
+        write_to_logs(
+            "Step 1 - File Retrieval: Not checking the ETag of {}, its part sizes could not be read: {}".format(
+                key, exc))
+
+        return None
+
+    if sum(part_sizes) != size:
+        write_to_logs(
+            "Step 1 - File Retrieval: Not checking the ETag of {}, its {} parts do not add up to {} bytes".format(
+                key, part_count, size))
+
+        return None
+
+    return part_sizes
+
+
+def verify_checksums(checksums, expected, name):
+    """
+    Raises an exception if the checksums of a file differ from the expected ones
+    """
+    for field in ('size', 'etag', 'sha256'):
+        if field in expected and checksums[field] != expected[field]:
+            raise Exception("{} does not match S3: its {} is {} but S3 has {}".format(
+                name, field, checksums[field], expected[field]))
+
+
+def verify_file(file_name, expected, name, logger=None):
+    """
+    Checksums a downloaded file, raises an exception if it does not match
+    the expected checksums and returns its checksums
+    """
+    checksums = file_checksums(file_name, expected['part_size'])
+
+    try:
+        verify_checksums(checksums, expected, name)
+    except Exception as exc:
+        error_message = "[ERROR] Step 1 - File Retrieval: Downloaded {}".format(exc)
+        write_to_logs(error_message, logger)
+        raise Exception(error_message) from exc
+
+    write_to_logs("Step 1 - File Retrieval: Verified {} against S3 (size {}, MD5 {}, SHA-256 {})".format(
+        name, checksums['size'], checksums['md5'], checksums['sha256']), logger)
+
+    return checksums
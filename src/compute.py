@@ -0,0 +1,88 @@
+"""
+A pool of processes for the CPU-heavy steps, so they do not hold the GIL
+that the poller, heartbeats and transfers need
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from src.utilities import write_to_logs
+
+# processes that reheader BAMs and trim and compress VCFs, 0 runs them in the
+# calling thread instead
+COMPUTE_PROCESSES = int(os.environ.get('UPS_COMPUTE_PROCESSES', '2'))
+
+
+class ComputePool:
+    """
+    Runs functions in a pool of worker processes
+
+    Functions are given file paths rather than file contents, so a task only
+    pickles its arguments and result and the data never crosses between
+    processes. The calling thread blocks without holding the GIL until the
+    result is back.
+
+    Workers are forked from a forkserver, a single-threaded process started
+    with the pool, never from the calling process. So a worker started after
+    a worker dies does not inherit locks held by the calling process's
+    threads, such as logging's or the AWS clients'. The server imports the
+    main module, which must only start the service under
+    `if __name__ == '__main__':`. start() starts the server and workers up
+    front so the first file does not wait for them.
+    """
+
+    def __init__(self, processes=COMPUTE_PROCESSES, logger=None):
+        self.processes = processes
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def start(self):
+        """
+        Starts the worker processes, if there are any, and returns self
+        """
+        if self.processes:
+            self.get_executor().submit(os.getpid).result()
+
+        return self
+
+    def get_executor(self):
+        """
+        Returns the process pool, creating it if it does not exist
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.processes, multiprocessing.get_context('forkserver'))
+
+            return self.executor
+
+    def run(self, function, *args):
+        """
+        Calls function with args in a worker process and returns its result
+
+        function must be defined at the top level of a module. If a worker
+        dies, the pool is replaced and the call raises.
+        """
+        if not self.processes:
+            return function(*args)
+
+        executor = self.get_executor()
+
+        try:
+            return executor.submit(function, *args).result()
+        except BrokenProcessPool as exc:
+            write_to_logs("[ERROR] Compute: A worker process died running {}, restarting the pool".format(
+                function.__name__), self.logger)
+
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = None
+
+            executor.shutdown(wait=False)
+
+            raise Exception("Compute: Worker process died running {}".format(function.__name__)) from exc
+
+
+# shared by every worker thread in the container
+COMPUTE_POOL = ComputePool()
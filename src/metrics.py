@@ -0,0 +1,213 @@
+"""
+Timers and counters for each step of the workflow, logged as JSON lines and
+optionally published in the Prometheus text format
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src.utilities import write_to_logs
+
+# file the metrics are written to in the Prometheus text format after each
+# message, for example for node_exporter's textfile collector
+METRICS_FILE = os.environ.get('UPS_METRICS_FILE')
+
+# port serving the metrics in the Prometheus text format on /metrics
+METRICS_PORT = int(os.environ['UPS_METRICS_PORT']) if os.environ.get('UPS_METRICS_PORT') else None
+
+# prefix of every metric name in the Prometheus output
+METRICS_NAMESPACE = 'ups'
+
+
+class MessageSummary:
+    """
+    Collects the time spent and bytes handled in each step of one message
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.file_type = None
+        self.start_time = time.monotonic()
+        self.steps = {}
+
+    def add(self, step, seconds, size=None):
+        """
+        Adds the time and bytes of a step, adding to earlier runs of the same step
+        """
+        record = self.steps.setdefault(step, {'seconds': 0.0, 'bytes': 0})
+        record['seconds'] += seconds
+        record['bytes'] += size or 0
+
+    def record(self, outcome):
+        """
+        Returns the summary as a dict
+        """
+        return {
+            'event': 'message_summary',
+            'file': self.name,
+            'file_type': self.file_type,
+            'outcome': outcome,
+            'seconds': round(time.monotonic() - self.start_time, 3),
+            'steps': {step: {'seconds': round(record['seconds'], 3), 'bytes': record['bytes']}
+                      for (step, record) in self.steps.items()}
+        }
+
+
+class Metrics:
+    """
+    Aggregates timings and counts in memory and logs each timing as a JSON line
+
+    Timings are kept per step name and labels, such as the file type, as a
+    count, total seconds and total bytes, from which averages and throughput
+    can be derived. Labels should have few distinct values, so file names go
+    in the JSON lines and message summaries only.
+    """
+
+    def __init__(self, logger=None, metrics_file=METRICS_FILE):
+        self.logger = logger
+        self.metrics_file = metrics_file
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def increment(self, name, value=1, **labels):
+        """
+        Adds value to the counter name
+        """
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, size=None, summary=None, **labels):
+        """
+        Records that step name took seconds and handled size bytes, adds it to
+        the message summary if there is one and logs it
+        """
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            timing = self.timings.setdefault(key, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+            timing['count'] += 1
+            timing['seconds'] += seconds
+            timing['bytes'] += size or 0
+
+        record = {'event': 'timing', 'step': name, 'seconds': round(seconds, 3)}
+        record.update(labels)
+
+        if size is not None:
+            record['bytes'] = size
+            record['mb_per_second'] = round(size / max(seconds, 1e-6) / 2**20, 1)
+
+        if summary is not None:
+            summary.add(name, seconds, size)
+            record['file'] = summary.name
+
+        write_to_logs(json.dumps(record), self.logger)
+
+    @contextmanager
+    def timer(self, name, summary=None, **labels):
+        """
+        Times the block inside the with statement as step name
+
+        The block can set 'bytes' in the yielded dict to record throughput.
+        A block that raises is recorded with outcome "error".
+        """
+        timing = {'bytes': None}
+        start_time = time.monotonic()
+        outcome = 'ok'
+
+        try:
+            yield timing
+        except BaseException:
+            outcome = 'error'
+            raise
+        finally:
+            self.observe(name, time.monotonic() - start_time, timing['bytes'], summary, outcome=outcome, **labels)
+
+    def summarize(self, summary, outcome):
+        """
+        Logs the summary of a message that has left the pipeline, counts it and
+        writes the metrics file if there is one
+        """
+        self.increment('messages', file_type=summary.file_type, outcome=outcome)
+        write_to_logs(json.dumps(summary.record(outcome)), self.logger)
+
+        if self.metrics_file:
+            self.write_prometheus_file(self.metrics_file)
+
+    def prometheus_text(self):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            timings = {key: dict(value) for (key, value) in self.timings.items()}
+
+        samples = [('{}_total'.format(name), labels, value) for ((name, labels), value) in counters.items()]
+
+        for ((name, labels), timing) in timings.items():
+            samples.append(('{}_count'.format(name), labels, timing['count']))
+            samples.append(('{}_seconds_total'.format(name), labels, timing['seconds']))
+            samples.append(('{}_bytes_total'.format(name), labels, timing['bytes']))
+
+        lines = []
+
+        for (metric, labels, value) in samples:
+            label_text = ','.join('{}="{}"'.format(label, str(label_value).replace('"', '\\"'))
+                                  for (label, label_value) in labels if label_value is not None)
+            lines.append('{}_{}{} {}'.format(
+                METRICS_NAMESPACE, metric, '{' + label_text + '}' if label_text else '', value))
+
+        return '\n'.join(sorted(lines)) + '\n'
+
+    def write_prometheus_file(self, path):
+        """
+        Writes the metrics to path in the Prometheus text format, replacing it
+        in one step so a reader never sees a partial file
+        """
+        temp_path = '{}.tmp'.format(path)
+
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(self.prometheus_text())
+
+        os.replace(temp_path, path)
+
+    def serve(self, port, address=''):
+        """
+        Serves the metrics on /metrics at port from a background thread and
+        returns the server
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            """
+            Answers GET /metrics with the metrics
+            """
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = metrics.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        server = ThreadingHTTPServer((address, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True, name='metrics').start()
+        write_to_logs("Serving metrics on port {}".format(server.server_address[1]), self.logger)
+
+        return server
+
+
+# shared by every module in the container
+METRICS = Metrics()
@@ -0,0 +1,160 @@
+"""
+A pipeline of stages that each run in their own worker threads, so different
+files can be downloaded, processed and uploaded at the same time
+"""
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from functools import partial
+from src.utilities import write_to_logs
+
+# seconds between checks of free disk space while a stage is waiting for it
+FREE_SPACE_POLL_INTERVAL = 10
+
+
+class Stage:
+    """
+    A step of the pipeline
+
+    function is called with each item and stages pass results on by updating
+    the item. If function returns a future, the worker moves on and the item
+    is handed to the next stage once the future completes, so a stage can wait
+    on something slow, such as a batch filling up, without holding a worker.
+    Other return values are ignored. Up to workers items are in the stage at a
+    time and up to queue_size wait for it. If min_free_bytes is set,
+    the stage does not start an item while free space on free_space_path is
+    below it.
+    """
+
+    def __init__(self, name, function, workers=1, queue_size=None, min_free_bytes=0, free_space_path='/scratch'):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size or workers)
+        self.min_free_bytes = min_free_bytes
+        self.free_space_path = free_space_path
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy_seconds = 0.0
+
+    def wait_for_free_space(self, logger=None):
+        """
+        Blocks until there is at least min_free_bytes free on free_space_path
+        """
+        logged = False
+
+        while self.min_free_bytes and shutil.disk_usage(self.free_space_path).free < self.min_free_bytes:
+            if not logged:
+                write_to_logs("Stage {} waiting for {} bytes free on {}".format(
+                    self.name, self.min_free_bytes, self.free_space_path), logger)
+                logged = True
+
+            time.sleep(FREE_SPACE_POLL_INTERVAL)
+
+    def record(self, seconds):
+        """
+        Records that an item spent seconds in the stage
+        """
+        with self.lock:
+            self.items += 1
+            self.busy_seconds += seconds
+
+
+class Pipeline:
+    """
+    Passes each submitted item through the stages in order
+
+    Queues between stages are bounded, so a slow stage holds back the stages
+    in front of it instead of letting work pile up on disk, and throughput
+    approaches that of the slowest stage rather than the sum of all of them.
+    An item that raises in a stage skips the rest of the pipeline and its
+    future gets the exception. Cancelling an item's future skips the stages
+    it has not started yet.
+    """
+
+    def __init__(self, stages, logger=None):
+        self.stages = stages
+        self.logger = logger
+
+        for (index, stage) in enumerate(stages):
+            next_stage = stages[index + 1] if index + 1 < len(stages) else None
+
+            for worker in range(stage.workers):
+                threading.Thread(
+                    target=self.run_stage, args=(stage, next_stage), daemon=True,
+                    name='{}-{}'.format(stage.name, worker)).start()
+
+    def submit(self, item):
+        """
+        Adds item to the first stage, blocking while its queue is full, and
+        returns a future that completes when item leaves the pipeline
+        """
+        future = Future()
+        self.stages[0].queue.put((item, future))
+
+        return future
+
+    def run_stage(self, stage, next_stage):
+        """
+        Runs items through stage and hands them on to next_stage
+        """
+        while True:
+            (item, future) = stage.queue.get()
+
+            if future.cancelled():
+                continue
+
+            stage.wait_for_free_space(self.logger)
+            start_time = time.monotonic()
+
+            try:
+                result = stage.function(item)
+            except BaseException as exc:
+                # anything raised, including SystemExit, fails the item rather
+                # than ending the worker and leaving its futures unresolved
+                self.complete(future, exc=exc)
+                continue
+            finally:
+                stage.record(time.monotonic() - start_time)
+
+            if isinstance(result, Future):
+                result.add_done_callback(partial(self.hand_on, item, future, next_stage))
+            else:
+                self.hand_on(item, future, next_stage)
+
+    @staticmethod
+    def hand_on(item, future, next_stage, stage_future=None):
+        """
+        Passes item to next_stage, or completes its future after the last
+        stage, unless the future the stage returned failed
+        """
+        if stage_future is not None and stage_future.exception() is not None:
+            Pipeline.complete(future, exc=stage_future.exception())
+        elif next_stage is None:
+            Pipeline.complete(future, item)
+        else:
+            next_stage.queue.put((item, future))
+
+    @staticmethod
+    def complete(future, item=None, exc=None):
+        """
+        Completes the item's future with item, or fails it with exc, unless it
+        was cancelled while the item was in a stage
+        """
+        try:
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(item)
+        except InvalidStateError:
+            if not future.cancelled():
+                raise
+
+    def summary(self):
+        """
+        Returns the items, busy time and queue depth of each stage as a log line
+        """
+        return ' '.join('{}: items={} busy_seconds={:.1f} queued={}'.format(
+            stage.name, stage.items, stage.busy_seconds, stage.queue.qsize()) for stage in self.stages)
@@ -3,197 +3,637 @@
 """
 Main workflow for sending files to dbGaP
 """
+import asyncio
+import logging
 import os
-import sys
+import threading
 import time
-from subprocess import check_output
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import botocore
 
-from aws_utils import get_queue_by_name, get_s3_client, get_secret_from_secrets_manager, write_aspera_secrets_to_disk
-from bams import process_bam
-from udn_gateway import call_udngateway_mark_complete
-from utilities import setup_logger, silent_remove, write_to_logs
-from vcfs import process_vcf, upload_vcf_archive
-from xml_utils import create_and_tar_xml
+from src.admission import DiskBudget, ScratchSpaceError, estimate_scratch_footprint
+from src.aspera import TRANSFER_MANAGER
+from src.aws_utils import (
+    SECRET_CACHE, STARTUP_SECRET_IDS, get_queue_by_name, get_s3_object_metadata, get_secret_from_secrets_manager,
+    write_aspera_secrets_to_disk)
+from src.bams import process_bam, process_bam_from_s3
+from src.cache import OutputCache, cache_key
+from src.checksums import VERIFY_DOWNLOADS, expected_checksums, verify_file
+from src.compute import COMPUTE_POOL
+from src.metrics import METRICS, METRICS_PORT, MessageSummary
+from src.pipeline import Pipeline, Stage
+from src.s3_transfers import download_file_from_s3, upload_file_to_s3
+from src.sqs_utils import poll_queue_async, stop_on_signals
+from src.udn_gateway import GATEWAY_SHUTDOWN_SECONDS, GatewayClient
+from src.utilities import setup_logger, write_to_logs
+from src.vcfs import (
+    VCF_ARCHIVE, adopt_stale_vcf_archives, process_vcf, process_vcf_from_s3, upload_vcf_archive,
+    upload_vcf_archive_file)
+from src.workspace import Workspace, remove_stale_workspaces
+from src.xml_batch import XML_BATCH_PREFIX, XML_BATCH_SIZE, XmlBatch
+from src.xml_utils import create_and_tar_xml, create_xml_library
+
+STARTUP_TIME = time.monotonic()
+
+# main() adds the log file, so importing this module, as the compute pool's
+# server process does, has no side effects
+LOGGER = logging.getLogger('ups')
+
+SECRET_ID = 'ups-prod'
+QUEUE_NAME = 'ups'
+
+
+def fetch_secrets_and_queue():
+    """
+    Fetches the secrets, writes the Aspera keys and looks up the queue, all
+    at the same time, and returns the worker's secret and the queue
+    """
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='startup') as executor:
+        queue = executor.submit(get_queue_by_name, QUEUE_NAME)
+        secrets = SECRET_CACHE.get_many(STARTUP_SECRET_IDS)
+        write_aspera_secrets_to_disk()
+
+        return secrets[SECRET_ID], queue.result()
 
-LOGGER = setup_logger('ups')
 
-SECRET = get_secret_from_secrets_manager("ups-prod")
-write_aspera_secrets_to_disk()
+# set by main()
+SQS_QUEUE = None
 
 # If testing, do not upload files to dbGaP, but instead save the processed file to a special S3 bucket
-if SECRET['status'] == 'test':
-    TESTING = True
-    TESTING_BUCKET = 'gateway-participant-sequencing-files-' + SECRET['sequencing-bucket']
-    TESTING_FOLDER = 'ups-testing'
-
-    print("[DEBUG] TEST mode. All files uploaded to {}".format(TESTING_BUCKET), flush=True)
-else:
-    TESTING = False
-    TESTING_BUCKET = None
-    TESTING_FOLDER = None
-    ASPERA_LOCATION_CODE = SECRET['aspera-location-code']
-    ASPERA_PASS = SECRET['aspera-pass']
-    ASPERA_VCF_LOCATION_CODE = SECRET['aspera-location-code-vcf']
-    os.environ["ASPERA_SCP_FILEPASS"] = ASPERA_PASS
+TESTING = False
+TESTING_BUCKET = None
+TESTING_FOLDER = None
+ASPERA_LOCATION_CODE = None
+ASPERA_VCF_LOCATION_CODE = None
+
+
+def configure_destination(secret):
+    """
+    Sets where files are uploaded to from the worker's secret
+    """
+    global TESTING, TESTING_BUCKET, TESTING_FOLDER, ASPERA_LOCATION_CODE, ASPERA_VCF_LOCATION_CODE
+
+    if secret['status'] == 'test':
+        TESTING = True
+        TESTING_BUCKET = 'gateway-participant-sequencing-files-' + secret['sequencing-bucket']
+        TESTING_FOLDER = 'ups-testing'
+        ASPERA_VCF_LOCATION_CODE = None
+
+        print("[DEBUG] TEST mode. All files uploaded to {}".format(TESTING_BUCKET), flush=True)
+    else:
+        TESTING = False
+        TESTING_BUCKET = None
+        TESTING_FOLDER = None
+        ASPERA_LOCATION_CODE = secret['aspera-location-code']
+        ASPERA_VCF_LOCATION_CODE = secret['aspera-location-code-vcf']
+
+
+MESSAGE_ATTRIBUTE_NAMES = [
+    'dna_data', 'exportfile_id', 'file_type', 'file_url', 'fileservice_uuid', 'instrument_model',
+    'read_lengths', 'sample_id', 'sequence_type', 'udn_id']
+
+SCRATCH_ROOT = '/scratch'
+
+# process files while they stream in from S3 instead of downloading them to scratch first
+STREAMING_INGEST = os.environ.get('UPS_STREAMING_INGEST', 'false').lower() == 'true'
+
+# processed BAMs and their XML are kept here until their message completes
+OUTPUT_CACHE = OutputCache(logger=LOGGER)
+
+# scratch space is reserved for each file before it is downloaded, less what
+# the output cache and the VCF archives already use; cached output no message
+# is using is evicted when a file is waiting for room. Created by main()
+DISK_BUDGET = None
+
+# seconds a message whose file is larger than the scratch budget is hidden for,
+# instead of being received again straight away; with a redrive policy on
+# the queue it moves to the dead-letter queue once its receives run out
+UNFITTABLE_VISIBILITY_TIMEOUT = int(os.environ.get('UPS_UNFITTABLE_VISIBILITY_SECONDS', '3600'))
+
+
+# completions are sent to the UDN Gateway in the background, from an outbox
+# that survives restarts, and a rejected token is fetched again before they
+# are retried
+GATEWAY = GatewayClient(lambda: get_secret_from_secrets_manager(SECRET_ID),
+                        on_unauthorized=lambda: SECRET_CACHE.invalidate(SECRET_ID), logger=LOGGER)
+
+# BAM XML is sent in batches described by a single submission instead of
+# with each BAM
+BATCH_XML = XML_BATCH_SIZE > 1
+XML_BATCH = XmlBatch(root=SCRATCH_ROOT, logger=LOGGER)
+
+# hands messages to the pipeline one at a time, waiting while its first stage is full
+SUBMITTER = ThreadPoolExecutor(max_workers=1, thread_name_prefix='submit')
+
+# workers in each stage of the pipeline
+RETRIEVAL_WORKERS = int(os.environ.get('UPS_RETRIEVAL_WORKERS', '1'))
+PROCESSING_WORKERS = int(os.environ.get('UPS_PROCESSING_WORKERS', '1'))
+UPLOAD_WORKERS = int(os.environ.get('UPS_UPLOAD_WORKERS', '1'))
+COMPLETE_WORKERS = int(os.environ.get('UPS_COMPLETE_WORKERS', '1'))
+
+# retrieval and processing wait while /scratch has less than this free
+MIN_FREE_SCRATCH_BYTES = int(float(os.environ.get('UPS_MIN_FREE_SCRATCH_GB', '10')) * 2**30)
+
+# number of messages in the pipeline at the same time, by default enough to
+# keep every stage busy while a batch of XML fills up
+MAX_WORKERS = int(os.environ.get(
+    'UPS_MAX_WORKERS', RETRIEVAL_WORKERS + PROCESSING_WORKERS + UPLOAD_WORKERS + COMPLETE_WORKERS +
+    (XML_BATCH_SIZE if BATCH_XML else 0)))
+
+
+async def process_message(message):
+    """
+    Runs a single message, wrapped in its visibility heartbeat, through the
+    pipeline in its own workspace
+
+    The message waits for the pipeline as a task of the event loop, not in a
+    thread of its own.
+    """
+    loop = asyncio.get_running_loop()
+
+    if message.message_attributes is None:
+        write_to_logs(
+            "[ERROR] Step 1 - File Retrieval: Message failed to provide all required attributes {}".format(message))
+        await loop.run_in_executor(None, partial(message.change_visibility, VisibilityTimeout=0))
+        return
+
+    job = {
+        'message': message,
+        'workspace': Workspace(SCRATCH_ROOT),
+        'output_key': None,
+        'reserved_bytes': 0,
+        'summary': MessageSummary(),
+        # guards the job being cancelled against its message being deleted
+        'lock': threading.Lock(),
+        'future': None,
+        'cancelled': False,
+        'completed': False
+    }
+    error = None
+
+    try:
+        # submitting blocks while the first stage is full, and a shutdown
+        # never cancels a file part way through a stage
+        future = await loop.run_in_executor(SUBMITTER, submit_job, job)
+        await asyncio.shield(asyncio.wrap_future(future))
+    except asyncio.CancelledError:
+        # the message is released at shutdown, unless the file was already
+        # marked complete
+        if await loop.run_in_executor(None, cancel_job, job):
+            raise
+    except Exception as exc:
+        error = exc
+
+    await loop.run_in_executor(None, finish_message, job, error)
+
+
+def submit_job(job):
+    """
+    Adds the job to the pipeline and returns its future, cancelled if the job
+    was cancelled while it waited to be added
+    """
+    future = PIPELINE.submit(job)
+
+    with job['lock']:
+        job['future'] = future
+
+        if job['cancelled']:
+            future.cancel()
+
+    return future
+
+
+def cancel_job(job):
+    """
+    Stops the job from marking its file complete or deleting its message and
+    skips the stages it has not started, returning False if it was too late
+    """
+    with job['lock']:
+        if job['completed']:
+            return False
+
+        write_to_logs("Shutting down: cancelling the rest of the pipeline for {}".format(
+            job.get('upload_file_name', job['message'].message_id)), LOGGER)
+        job['cancelled'] = True
+
+        if job['future'] is not None:
+            job['future'].cancel()
+
+    return True
+
+
+def finish_message(job, error):
+    """
+    Releases the message if it failed and cleans up after it
+    """
+    outcome = 'failed' if error is not None else 'complete'
+
+    try:
+        if error is not None:
+            write_to_logs("[ERROR] {}".format(error), LOGGER)
+
+            if job['output_key'] is not None:
+                OUTPUT_CACHE.release(job['output_key'])
+
+            if isinstance(error, ScratchSpaceError):
+                write_to_logs("[ERROR] {} is larger than the scratch budget, hiding its message for {} seconds".format(
+                    job.get('upload_file_name'), UNFITTABLE_VISIBILITY_TIMEOUT), LOGGER)
+                job['message'].change_visibility(VisibilityTimeout=UNFITTABLE_VISIBILITY_TIMEOUT)
+            else:
+                job['message'].change_visibility(VisibilityTimeout=0)
+    finally:
+        job['workspace'].cleanup()
+        job['message'].stop()
+
+        if job['reserved_bytes']:
+            DISK_BUDGET.release(job['reserved_bytes'], job['upload_file_name'])
+
+        METRICS.summarize(job['summary'], outcome)
+
+
+def retrieve_file(job):
+    """
+    Step 1: reads the message and downloads its file to the job's scratch
+    directory, unless it is streamed during processing or was already
+    processed by an earlier attempt
+    """
+    message = job['message']
+    attributes = {name: (message.message_attributes.get(name) or {}).get('StringValue')
+                  for name in MESSAGE_ATTRIBUTE_NAMES}
+
+    (dna_source, _, reference_genome) = (attributes['dna_data'] or '').partition('|')
+    file_type = attributes['file_type']
+    file_url_pieces = (attributes['file_url'] or '').split('/')
+    file_bucket = file_url_pieces[2] if len(file_url_pieces) > 2 else None
+    file_key = '/'.join(file_url_pieces[3:])
+    filename_extension = {'BAM': '.bam', 'VCF': '.vcf'}.get(file_type)
+
+    if not (all(attributes.values()) and dna_source and reference_genome and
+            file_bucket and file_key and filename_extension):
+        raise Exception("Step 1 - File Retrieval: Message failed to provide all required attributes {}".format(
+            message.message_attributes))
+
+    upload_file_name = "%s%s" % (attributes['fileservice_uuid'], filename_extension)
+    job['summary'].name = upload_file_name
+    job['summary'].file_type = file_type
+
+    job.update(attributes)
+    job.update({
+        'dna_source': dna_source,
+        'reference_genome': reference_genome,
+        'sequence_type': int(attributes['sequence_type']),
+        'file_bucket': file_bucket,
+        'file_key': file_key,
+        'upload_file_name': upload_file_name,
+        'temp_file': job['workspace'].path('md5'),
+        'cached_output': None,
+        'expected_checksums': None,
+        'file_size': None
+    })
+
+    write_to_logs(
+        "Step 1 - File Retrieval: Processing file {} for participant {}".format(
+            upload_file_name, attributes['udn_id']), LOGGER)
+
+    try:
+        object_metadata = get_s3_object_metadata(file_bucket, file_key)
+        job['file_size'] = object_metadata['ContentLength']
+
+        if file_type == "BAM":
+            job['output_key'] = cache_key(
+                file_bucket, file_key, object_metadata['ETag'], attributes['sample_id'], upload_file_name)
+            job['cached_output'] = OUTPUT_CACHE.get(job['output_key'])
+
+            # entries written while XML was batched have no tar of their own
+            if job['cached_output'] is not None and not BATCH_XML and 'tar' not in job['cached_output']['files']:
+                OUTPUT_CACHE.release(job['output_key'])
+                job['cached_output'] = None
+
+        if job['cached_output'] is None:
+            if VERIFY_DOWNLOADS:
+                job['expected_checksums'] = expected_checksums(file_bucket, file_key, object_metadata)
+
+            # wait for room for everything the file will write before downloading it
+            job['reserved_bytes'] = DISK_BUDGET.reserve(
+                estimate_scratch_footprint(file_type, object_metadata['ContentLength'], STREAMING_INGEST),
+                upload_file_name)
+
+        if job['cached_output'] is not None:
+            write_to_logs(
+                "Step 1 - File Retrieval: Using the processed files of an earlier attempt for {}".format(
+                    upload_file_name), LOGGER)
+        elif STREAMING_INGEST:
+            write_to_logs(
+                "Step 1 - File Retrieval: Streaming file {} from bucket {}".format(file_key, file_bucket))
+        else:
+            write_to_logs(
+                "Step 1 - File Retrieval: Downloading file {} from bucket {}".format(file_key, file_bucket))
+
+            with METRICS.timer('download', job['summary'], file_type=file_type) as timing:
+                download_file_from_s3(file_bucket, file_key, job['temp_file'], LOGGER)
+                timing['bytes'] = job['file_size']
+
+        if job['expected_checksums'] is not None and not STREAMING_INGEST:
+            # fail before processing a corrupt download rather than when NCBI finds it
+            with METRICS.timer('verify', job['summary'], file_type=file_type) as timing:
+                COMPUTE_POOL.run(verify_file, job['temp_file'], job['expected_checksums'], upload_file_name)
+                timing['bytes'] = job['file_size']
+    except botocore.exceptions.ClientError as exc:
+        raise Exception("Step 1 - File Retrieval: Error retrieving file from S3: {}".format(exc)) from exc
+
+
+def process_file(job):
+    """
+    Step 2: runs the BAM or VCF handler on the job's file
+    """
+    try:
+        with METRICS.timer('process', job['summary'], file_type=job['file_type']) as timing:
+            FILE_PROCESSORS[job['file_type']](job)
+            timing['bytes'] = job['file_size']
+    except Exception as exc:
+        raise Exception("Processing {} - {}".format(job['file_type'], exc)) from exc
+
+
+def process_bam_file(job):
+    """
+    Reheaders the BAM, writes its XML and moves both into the output cache
+    """
+    if job['cached_output'] is not None:
+        return
+
+    if STREAMING_INGEST:
+        md5_checksum = process_bam_from_s3(
+            job['sample_id'], job['upload_file_name'], job['file_bucket'], job['file_key'], LOGGER,
+            job['workspace'], job['expected_checksums'])
+    else:
+        md5_checksum = process_bam(
+            job['sample_id'], job['upload_file_name'], job['temp_file'], LOGGER, job['workspace'])
+
+    output_files = {'bam': job['workspace'].path(job['upload_file_name'])}
+
+    # batched XML is written when the batch is sent
+    if not BATCH_XML:
+        with METRICS.timer('xml', job['summary']):
+            output_files['tar'] = create_and_tar_xml(
+                job['dna_source'], job['fileservice_uuid'], job['instrument_model'], md5_checksum,
+                job['read_lengths'], job['reference_genome'], job['sample_id'],
+                get_secret_from_secrets_manager(SECRET_ID), job['sequence_type'], job['upload_file_name'], LOGGER,
+                job['workspace'])
+
+    # keep the processed files in case the upload or the gateway call fails
+    job['cached_output'] = OUTPUT_CACHE.put(job['output_key'], output_files, {'md5_checksum': md5_checksum})
+    release_cached_reservation(job)
+
+
+def release_cached_reservation(job):
+    """
+    Returns the share of the job's reservation taken by its output to the
+    budget, since the output cache's size now counts it
+    """
+    cached_bytes = min(sum(os.path.getsize(path) for path in job['cached_output']['files'].values()),
+                       job['reserved_bytes'])
+
+    if cached_bytes:
+        DISK_BUDGET.release(cached_bytes, job['upload_file_name'])
+        job['reserved_bytes'] -= cached_bytes
+
+
+def process_vcf_file(job):
+    """
+    Trims the VCF and adds it to the VCF archive
+    """
+    if STREAMING_INGEST:
+        processed = process_vcf_from_s3(
+            job['sample_id'], job['upload_file_name'], job['file_bucket'], job['file_key'], LOGGER,
+            job['workspace'], job['expected_checksums'])
+    else:
+        processed = process_vcf(job['sample_id'], job['upload_file_name'], job['temp_file'], LOGGER, job['workspace'])
 
-QUEUE_NAME = 'ups'
-SQS_QUEUE = get_queue_by_name(QUEUE_NAME)
+    if not processed:
+        raise Exception("VCF {} was not added to the archive".format(job['upload_file_name']))
 
-S3_CLIENT = get_s3_client()
 
-write_to_logs('Starting to Poll', LOGGER)
+FILE_PROCESSORS = {
+    'BAM': process_bam_file,
+    'VCF': process_vcf_file
+}
 
-while True:
-    write_to_logs("Step 1 - File Retrieval: Retrieving messages from queue - '{}'".format(QUEUE_NAME))
 
-    messages = SQS_QUEUE.receive_messages(MaxNumberOfMessages=1, MessageAttributeNames=[
-        'dna_data', 'exportfile_id', 'file_type', 'file_url', 'fileservice_uuid', 'instrument_model',
-        'read_lengths', 'sample_id', 'sequence_type', 'udn_id'])
+def upload_files(job):
+    """
+    Step 3: sends the BAM and its XML
+
+    VCFs are sent with the rest of the VCF archive once it fills up or the
+    queue is empty. When XML is batched, the BAM is sent on its own and the
+    returned future completes once its batch of XML has been sent.
+    """
+    if job['file_type'] == "VCF":
+        # full archives are rolled over and uploaded in the background
+        write_to_logs(
+            "Step 3 - File Upload: Current archive size: {}".format(VCF_ARCHIVE.size))
+
+        return
+
+    upload_file_name = job['upload_file_name']
+    bam_file = job['cached_output']['files']['bam']
+
+    fingerprints = {bam_file: job['cached_output']['md5_checksum']}
+
+    if BATCH_XML:
+        send_files([bam_file], fingerprints, job['summary'])
+
+        return XML_BATCH.add(create_xml_library(
+            job['dna_source'], job['fileservice_uuid'], job['instrument_model'],
+            job['cached_output']['md5_checksum'], job['read_lengths'], job['reference_genome'], job['sample_id'],
+            get_secret_from_secrets_manager(SECRET_ID), job['sequence_type'], upload_file_name))
+
+    tar_file_name = job['cached_output']['files']['tar']
 
-    write_to_logs("Step 1 - File Retrieval: Found {} messages".format(len(messages)))
+    send_files([bam_file, tar_file_name], fingerprints, job['summary'])
 
-    if len(messages) == 0:
-        upload_vcf_archive(ASPERA_VCF_LOCATION_CODE, TESTING, TESTING_BUCKET, TESTING_FOLDER)
+    return None
+
+
+def send_files(file_names, fingerprints=None, summary=None):
+    """
+    Sends processed BAM files and XML tars to dbGaP, or to the testing bucket,
+    timing the upload in the message summary if there is one
+
+    fingerprints maps file names to the checksums that identify their
+    contents for resuming an interrupted upload to the testing bucket
+    """
+    with METRICS.timer('upload', summary, destination='s3' if TESTING else 'aspera') as timing:
+        timing['bytes'] = sum(os.path.getsize(name) for name in file_names)
+        upload_files_to_destination(file_names, fingerprints)
+
+
+def upload_files_to_destination(file_names, fingerprints):
+    """
+    Uploads the files to the testing bucket when testing, otherwise to dbGaP with Aspera
+    """
+    if TESTING:
+        print("[TESTING] Step 3 - File Upload: Attempting to copy {} to S3 bucket for storage under {}".format(
+            ', '.join(os.path.basename(name) for name in file_names), TESTING_FOLDER), flush=True)
+
+        for name in file_names:
+            upload_file_to_s3(
+                name, TESTING_BUCKET, os.path.join(TESTING_FOLDER, os.path.basename(name)),
+                (fingerprints or {}).get(name))
     else:
-        for message in messages:
-            CONTINUE_AND_DELETE = True
-
-            if message.message_attributes is not None:
-                dna_data = message.message_attributes.get('dna_data').get('StringValue')
-                exportfile_id = message.message_attributes.get('exportfile_id').get('StringValue')
-                file_type = message.message_attributes.get('file_type').get('StringValue')
-                file_url = message.message_attributes.get('file_url').get('StringValue')
-                fileservice_uuid = message.message_attributes.get('fileservice_uuid').get('StringValue')
-                instrument_model = message.message_attributes.get('instrument_model').get('StringValue')
-                read_lengths = message.message_attributes.get('read_lengths').get('StringValue')
-                sample_id = message.message_attributes.get('sample_id').get('StringValue')
-                sequence_type = int(message.message_attributes.get('sequence_type').get('StringValue'))
-                udn_id = message.message_attributes.get('udn_id').get('StringValue')
-
-                (dna_source, reference_genome) = dna_data.split('|')
-
-                if file_type == 'BAM':
-                    FILENAME_EXTENSION = '.bam'
-                elif file_type == 'VCF':
-                    FILENAME_EXTENSION = '.vcf'
-
-                file_url_pieces = file_url.split('/')
-                file_bucket = file_url_pieces[2]
-                FILE_KEY = '/'.join(file_url_pieces[3:])
-
-                upload_file_name = "%s%s" % (fileservice_uuid, FILENAME_EXTENSION)
-
-                if (dna_source and exportfile_id and file_type and file_url and fileservice_uuid and
-                    instrument_model and read_lengths and reference_genome and sample_id and sequence_type and
-                        udn_id and file_bucket and FILE_KEY and upload_file_name):
-                    write_to_logs(
-                        "Step 1 - File Retrieval: Processing file {} for participant {}".format(
-                            upload_file_name, udn_id), LOGGER)
-                    write_to_logs(
-                        "Step 1 - File Retrieval: Downloading file {} from bucket {}".format(FILE_KEY, file_bucket))
-
-                    try:
-                        TEMP_FILE = "/scratch/md5"
-                        retrieveBucket = S3_CLIENT.Bucket(file_bucket)
-                        retrieveBucket.download_file(FILE_KEY, TEMP_FILE)
-                    except botocore.exceptions.ClientError as exc:
-                        silent_remove(TEMP_FILE)
-                        write_to_logs(
-                            "[ERROR] Step 1 - File Retrieval: Error retrieving file from S3: {}".format(exc), LOGGER)
-                        CONTINUE_AND_DELETE = False
-                        message.change_visibility(VisibilityTimeout=0)
-                        continue
-
-                    if file_type == "BAM" and CONTINUE_AND_DELETE:
-                        try:
-                            MD5_CHECKSUM = process_bam(sample_id, upload_file_name, TEMP_FILE, LOGGER)
-
-                            tar_file_name = create_and_tar_xml(
-                                dna_source, fileservice_uuid, instrument_model, MD5_CHECKSUM, read_lengths,
-                                reference_genome, sample_id, SECRET, sequence_type, upload_file_name, LOGGER)
-
-                            if TESTING:
-                                bam_file_path = os.path.join(TESTING_FOLDER, upload_file_name)
-
-                                print("[TESTING] Step 3 - File Upload: Attempting to copy files (BAM and XML tar) for {} to S3 bucket for storage under {}".format(
-                                    upload_file_name, TESTING_FOLDER), flush=True)
-                                testing_s3 = get_s3_client()
-                                testing_s3.meta.client.upload_file(
-                                    os.path.join("/scratch", upload_file_name), TESTING_BUCKET, bam_file_path)
-                                testing_s3.meta.client.upload_file(
-                                    os.path.join("/scratch", tar_file_name), TESTING_BUCKET, tar_file_name)
-                            else:
-                                try:
-                                    write_to_logs(
-                                        "Step 3 - File Upload: Attempting to upload file {} via Aspera - asp-hms-cc@gap-submit.ncbi.nlm.nih.gov:{}".format(
-                                            upload_file_name, ASPERA_LOCATION_CODE))
-                                    upload_output = check_output(
-                                        ["/home/aspera/.aspera/connect/bin/ascp -i /aspera/aspera.pk -Q -l 5000m -k 1 /scratch/" +
-                                         upload_file_name + " asp-hms-cc@gap-submit.ncbi.nlm.nih.gov:" + ASPERA_LOCATION_CODE], shell=True)
-                                    write_to_logs("Step 3 - File Upload: Aspera returned {}", format(upload_output))
-
-                                    write_to_logs(
-                                        "Step 3 - File Upload: Attempting to upload file {} via Aspera - asp-hms-cc@gap-submit.ncbi.nlm.nih.gov:{}".format(
-                                            tar_file_name, ASPERA_LOCATION_CODE))
-                                    upload_output = check_output(
-                                        ["/home/aspera/.aspera/connect/bin/ascp -i /aspera/aspera.pk -Q -l 5000m -k 1 " +
-                                         tar_file_name + " asp-hms-cc@gap-submit.ncbi.nlm.nih.gov:" + ASPERA_LOCATION_CODE], shell=True)
-                                    write_to_logs("Step 3 - File Upload: Aspera returned {}", format(upload_output))
-
-                                except Exception:
-                                    write_to_logs(
-                                        "[ERROR] Step 3 - File Upload: Error sending files via Aspera {}".format(sys.exc_info()[:2]), LOGGER)
-                                    message.change_visibility(VisibilityTimeout=0)
-                                    CONTINUE_AND_DELETE = False
-                        except Exception:
-                            write_to_logs("[ERROR] Processing BAM {}".format(sys.exc_info()[:2]), LOGGER)
-                            CONTINUE_AND_DELETE = False
-                            message.change_visibility(VisibilityTimeout=0)
-                            continue
-                        finally:
-                            silent_remove("/scratch/md5")
-                            silent_remove("/scratch/header.sam")
-                            silent_remove(tar_file_name)
-                    elif file_type == "VCF" and CONTINUE_AND_DELETE:
-                        try:
-                            CONTINUE_AND_DELETE = process_vcf(sample_id, upload_file_name, TEMP_FILE, LOGGER)
-
-                            try:
-                                ARCHIVE_SIZE = os.path.getsize('/scratch/vcf_archive.tar')
-                                write_to_logs(
-                                    "Step 3 - File Upload: Current archive size: {}".format(ARCHIVE_SIZE))
-                            except OSError:
-                                ARCHIVE_SIZE = 0
-                                write_to_logs(
-                                    "Step 3 - File Upload: Current archive size: {}".format(ARCHIVE_SIZE))
-
-                            if ARCHIVE_SIZE > 250*1024**3:  # 250GB
-                                write_to_logs("Step 3 - File Upload:")
-                                upload_vcf_archive(ASPERA_VCF_LOCATION_CODE, TESTING, TESTING_BUCKET, TESTING_FOLDER)
-                        except Exception:
-                            write_to_logs("[ERROR] Processing VCF - {}".format(sys.exc_info()[:2]), LOGGER)
-                            CONTINUE_AND_DELETE = False
-                            message.change_visibility(VisibilityTimeout=0)
-                            continue
-                        finally:
-                            silent_remove("/scratch/md5")
-                            silent_remove("/scratch/header.sam")
-
-                    silent_remove(TEMP_FILE)
-                    silent_remove("/scratch/" + upload_file_name)
-
-                    if CONTINUE_AND_DELETE:
-                        call_udngateway_mark_complete(exportfile_id, SECRET, LOGGER)
-                        message.delete()
-                    else:
-                        message.change_visibility(VisibilityTimeout=0)
-
-                else:
-                    write_to_logs(
-                        "[ERROR] Step 1 - File Retrieval: Message failed to provide all required attributes {}".format(
-                            message))
-                    message.change_visibility(VisibilityTimeout=0)
-                    continue
-
-    time.sleep(10)
+        password = refresh_aspera_credentials()
+
+        try:
+            # the files upload in separate sessions at the same time
+            TRANSFER_MANAGER.upload_files(
+                file_names, "asp-hms-cc@gap-submit.ncbi.nlm.nih.gov:" + ASPERA_LOCATION_CODE,
+                '/aspera/aspera.pk', ['-Q', '-k', '1'], password).result()
+        except Exception as exc:
+            raise Exception("Step 3 - File Upload: Error sending files via Aspera {}".format(exc)) from exc
+
+
+def refresh_aspera_credentials():
+    """
+    Rewrites the Aspera keys if their secrets have been rotated and returns
+    the current Aspera password, which is passed to each ascp session
+    """
+    write_aspera_secrets_to_disk()
+
+    if TESTING:
+        return None
+
+    return get_secret_from_secrets_manager(SECRET_ID)['aspera-pass']
+
+
+def upload_rolled_over_archive(archive_file):
+    """
+    Uploads a rolled over VCF archive, in the archive's background thread
+    """
+    password = refresh_aspera_credentials()
+    upload_vcf_archive_file(
+        archive_file, ASPERA_VCF_LOCATION_CODE, TESTING, TESTING_BUCKET, TESTING_FOLDER, password)
+
+
+def mark_complete(job):
+    """
+    Step 4: records the file as complete, to be sent to the UDN Gateway in
+    the background, and deletes the message
+    """
+    with job['lock']:
+        # once the job is cancelled its message may already be with another worker
+        if job['cancelled']:
+            raise Exception("Step 4: Mark File Complete: {} was cancelled at shutdown".format(job['upload_file_name']))
+
+        with METRICS.timer('complete', job['summary']):
+            GATEWAY.mark_complete(job['exportfile_id'])
+
+        job['message'].delete()
+        job['completed'] = True
+
+    if job['output_key'] is not None:
+        OUTPUT_CACHE.remove(job['output_key'])
+        job['output_key'] = None
+
+
+def create_pipeline():
+    """
+    Returns the pipeline of stages each message goes through, with its
+    worker threads started
+    """
+    return Pipeline([
+        Stage('retrieval', retrieve_file, RETRIEVAL_WORKERS, min_free_bytes=MIN_FREE_SCRATCH_BYTES,
+              free_space_path=SCRATCH_ROOT),
+        Stage('processing', process_file, PROCESSING_WORKERS, min_free_bytes=MIN_FREE_SCRATCH_BYTES,
+              free_space_path=SCRATCH_ROOT),
+        Stage('upload', upload_files, UPLOAD_WORKERS),
+        Stage('complete', mark_complete, COMPLETE_WORKERS)
+    ], LOGGER)
+
+
+# created by main()
+PIPELINE = None
+
+
+def on_queue_empty():
+    """
+    Logs how busy each stage of the pipeline has been and starts uploading
+    the VCF archive and any batched XML
+
+    Both are sent in background threads, so receiving carries on while they
+    upload.
+    """
+    write_to_logs("Pipeline: {}".format(PIPELINE.summary()))
+
+    if BATCH_XML:
+        XML_BATCH.flush()
+
+    upload_vcf_archive()
+
+
+async def poll():
+    """
+    Processes messages from the queue on the event loop until the container
+    is asked to stop, flushing the VCF archive whenever the queue is empty
+
+    Receives, heartbeats and Aspera sessions all run on the loop, while
+    downloads, processing and other blocking work run in the pipeline's
+    stage threads and the compute pool.
+    """
+    write_to_logs("Step 1 - File Retrieval: Retrieving messages from queue - '{}'".format(QUEUE_NAME))
+
+    stopping = asyncio.Event()
+    stop_on_signals(stopping, LOGGER)
+    TRANSFER_MANAGER.loop = asyncio.get_running_loop()
+
+    await poll_queue_async(
+        SQS_QUEUE, process_message, on_queue_empty, MAX_WORKERS, MESSAGE_ATTRIBUTE_NAMES, LOGGER, stopping=stopping)
+
+    write_to_logs("Stopped polling", LOGGER)
+
+
+def main():
+    """
+    Starts the compute pool, metrics and UDN Gateway client, fetches the
+    secrets, cleans up after earlier runs and processes messages until the
+    container is asked to stop
+    """
+    global SQS_QUEUE, DISK_BUDGET, PIPELINE
+
+    setup_logger('ups')
+
+    # start the server the compute pool's workers are forked from before any threads start
+    COMPUTE_POOL.logger = LOGGER
+    COMPUTE_POOL.start()
+
+    METRICS.logger = LOGGER
+
+    # the same manager uploads BAMs here and VCF archives in vcfs
+    TRANSFER_MANAGER.logger = LOGGER
+
+    if METRICS_PORT is not None:
+        METRICS.serve(METRICS_PORT)
+
+    (secret, SQS_QUEUE) = fetch_secrets_and_queue()
+    configure_destination(secret)
+
+    DISK_BUDGET = DiskBudget(SCRATCH_ROOT, usage_functions=[OUTPUT_CACHE.size, VCF_ARCHIVE.disk_usage],
+                             evict_functions=[OUTPUT_CACHE.evict], logger=LOGGER)
+    XML_BATCH.on_flush = lambda tar_file_name: send_files([tar_file_name])
+    VCF_ARCHIVE.on_rollover = upload_rolled_over_archive
+
+    remove_stale_workspaces(SCRATCH_ROOT, logger=LOGGER)
+    remove_stale_workspaces(SCRATCH_ROOT, XML_BATCH_PREFIX, LOGGER)
+    adopt_stale_vcf_archives(LOGGER)
+    PIPELINE = create_pipeline()
+    GATEWAY.start()
+    METRICS.observe('startup', time.monotonic() - STARTUP_TIME)
+    write_to_logs('Starting to Poll with {} messages in the pipeline'.format(MAX_WORKERS), LOGGER)
+
+    asyncio.run(poll())
+
+    if not GATEWAY.wait(GATEWAY_SHUTDOWN_SECONDS):
+        write_to_logs("Stopped with completions left in the outbox, they are sent after the restart", LOGGER)
+
+
+if __name__ == '__main__':
+    main()
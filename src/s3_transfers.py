@@ -0,0 +1,216 @@
+"""
+Utilities for transferring large files to and from S3
+"""
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import botocore
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from src.aws_utils import S3_MAX_POOL_CONNECTIONS, get_client, get_s3_transfer_client
+from src.utilities import silent_remove, write_to_logs
+
+UPLOAD_JOURNAL_DIR = '/scratch/upload_journal'
+UPLOAD_PART_SIZE = int(os.environ.get('UPS_UPLOAD_PART_SIZE_MB', '64')) * 2**20
+UPLOAD_CONCURRENCY = int(os.environ.get('UPS_UPLOAD_CONCURRENCY', '4'))
+
+DOWNLOAD_PART_SIZE = int(os.environ.get('UPS_DOWNLOAD_PART_SIZE_MB', '64')) * 2**20
+DOWNLOAD_CONCURRENCY = int(os.environ.get('UPS_DOWNLOAD_CONCURRENCY', '16'))
+
+# shared by every download, the ranged GETs of one file run across
+# DOWNLOAD_CONCURRENCY threads on the pooled client
+DOWNLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=DOWNLOAD_PART_SIZE,
+    multipart_chunksize=DOWNLOAD_PART_SIZE,
+    max_concurrency=min(DOWNLOAD_CONCURRENCY, S3_MAX_POOL_CONNECTIONS))
+
+# lets testing uploads go to an S3 compatible store such as MinIO
+S3_ENDPOINT_URL = os.environ.get('UPS_S3_ENDPOINT_URL')
+
+# S3 limits on multipart uploads
+MIN_PART_SIZE = 5 * 2**20
+MAX_PARTS = 10000
+
+
+class ResumableUploader:
+    """
+    Uploads files to S3 as multipart uploads, recording every completed part
+    in a journal on local disk
+
+    If the upload of a file is interrupted (the worker dies, the message is
+    retried), the next upload of the same file to the same key picks up the
+    journal and only sends the parts S3 does not already have.
+    """
+
+    def __init__(self, s3_client, journal_dir=UPLOAD_JOURNAL_DIR, part_size=UPLOAD_PART_SIZE,
+                 max_concurrency=UPLOAD_CONCURRENCY):
+        self.s3_client = s3_client
+        self.journal_dir = journal_dir
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.max_concurrency = max_concurrency
+
+    def upload_file(self, file_name, bucket, key, fingerprint=None):
+        """
+        Uploads file_name to bucket/key, resuming an earlier attempt if there is one
+
+        fingerprint identifies the file's contents (for example its MD5) so an
+        identical file regenerated after a restart can still be resumed. It
+        defaults to the file's size and modification time.
+        """
+        file_size = os.path.getsize(file_name)
+
+        if fingerprint is None:
+            fingerprint = '{}:{}'.format(file_size, os.path.getmtime(file_name))
+
+        if file_size <= self.part_size:
+            with open(file_name, 'rb') as upload_file:
+                self.s3_client.put_object(Bucket=bucket, Key=key, Body=upload_file)
+            return
+
+        part_size = max(self.part_size, math.ceil(file_size / MAX_PARTS))
+        journal_file = self.journal_path(bucket, key)
+        journal = self.load_journal(journal_file, bucket, key, fingerprint, part_size)
+
+        if journal is None:
+            response = self.s3_client.create_multipart_upload(Bucket=bucket, Key=key)
+            journal = {
+                'bucket': bucket,
+                'key': key,
+                'fingerprint': fingerprint,
+                'part_size': part_size,
+                'upload_id': response['UploadId'],
+                'parts': {}
+            }
+            self.save_journal(journal_file, journal)
+        else:
+            write_to_logs("Step 3 - File Upload: Resuming upload of {} to {}/{} with {} parts already sent".format(
+                file_name, bucket, key, len(journal['parts'])))
+
+        part_count = math.ceil(file_size / part_size)
+        missing_parts = [number for number in range(1, part_count + 1) if str(number) not in journal['parts']]
+        journal_lock = threading.Lock()
+
+        def upload_part(part_number):
+            with open(file_name, 'rb') as upload_file:
+                upload_file.seek((part_number - 1) * part_size)
+                data = upload_file.read(part_size)
+
+            response = self.s3_client.upload_part(
+                Bucket=bucket, Key=key, UploadId=journal['upload_id'], PartNumber=part_number, Body=data)
+
+            with journal_lock:
+                journal['parts'][str(part_number)] = response['ETag']
+                self.save_journal(journal_file, journal)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            # list() so the first failed part is raised here
+            list(executor.map(upload_part, missing_parts))
+
+        self.s3_client.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=journal['upload_id'],
+            MultipartUpload={'Parts': [
+                {'PartNumber': number, 'ETag': journal['parts'][str(number)]}
+                for number in range(1, part_count + 1)]})
+
+        silent_remove(journal_file)
+
+    def journal_path(self, bucket, key):
+        """
+        Returns the path of the journal for an upload to bucket/key
+        """
+        name = hashlib.sha1('{}/{}'.format(bucket, key).encode()).hexdigest()
+
+        return os.path.join(self.journal_dir, '{}.json'.format(name))
+
+    def load_journal(self, journal_file, bucket, key, fingerprint, part_size):
+        """
+        Returns the journal of an earlier upload of the same file that can be
+        resumed, reconciled with the parts S3 actually has, or None
+        """
+        try:
+            with open(journal_file) as journal_handle:
+                journal = json.load(journal_handle)
+        except (OSError, ValueError):
+            return None
+
+        if (journal.get('bucket'), journal.get('key'), journal.get('fingerprint'), journal.get('part_size')) != (
+                bucket, key, fingerprint, part_size):
+            self.abort(journal)
+            return None
+
+        try:
+            paginator = self.s3_client.get_paginator('list_parts')
+            uploaded = {
+                str(part['PartNumber']): part['ETag']
+                for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=journal['upload_id'])
+                for part in page.get('Parts', [])}
+        except botocore.exceptions.ClientError:
+            # the upload was completed or aborted elsewhere
+            return None
+
+        journal['parts'] = {number: etag for number, etag in journal['parts'].items() if uploaded.get(number) == etag}
+
+        return journal
+
+    def save_journal(self, journal_file, journal):
+        """
+        Atomically writes the journal to disk
+        """
+        os.makedirs(self.journal_dir, exist_ok=True)
+        temp_file = '{}.tmp'.format(journal_file)
+
+        with open(temp_file, 'w') as journal_handle:
+            json.dump(journal, journal_handle)
+
+        os.replace(temp_file, journal_file)
+
+    def abort(self, journal):
+        """
+        Aborts an upload that can no longer be resumed so its parts are not left in S3
+        """
+        try:
+            self.s3_client.abort_multipart_upload(
+                Bucket=journal['bucket'], Key=journal['key'], UploadId=journal['upload_id'])
+        except (botocore.exceptions.ClientError, KeyError):
+            pass
+
+
+def get_upload_client():
+    """
+    Returns the S3 client uploads are sent with, which is shared like the
+    transfer client
+    """
+    if S3_ENDPOINT_URL:
+        return get_client('s3', 's3-upload', endpoint_url=S3_ENDPOINT_URL,
+                          config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+
+    return get_s3_transfer_client()
+
+
+def download_file_from_s3(bucket, key, file_name, logger=None, s3_client=None):
+    """
+    Downloads bucket/key to file_name with parallel ranged GETs and logs the
+    throughput of the download
+    """
+    s3_client = s3_client or get_s3_transfer_client()
+    start_time = time.monotonic()
+
+    s3_client.download_file(bucket, key, file_name, Config=DOWNLOAD_TRANSFER_CONFIG)
+
+    elapsed = max(time.monotonic() - start_time, 1e-6)
+    size = os.path.getsize(file_name)
+    write_to_logs("Step 1 - File Retrieval: Downloaded {} bytes of {} in {:.1f}s ({:.1f} MB/s)".format(
+        size, key, elapsed, size / elapsed / 2**20), logger)
+
+    return size
+
+
+def upload_file_to_s3(file_name, bucket, key, fingerprint=None):
+    """
+    Uploads a file to S3 with a resumable multipart upload
+    """
+    ResumableUploader(get_upload_client()).upload_file(file_name, bucket, key, fingerprint)
@@ -0,0 +1,290 @@
+"""
+Utilities for working with SQS messages
+"""
+import asyncio
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import botocore
+from src.utilities import write_to_logs
+
+# how long each heartbeat hides the message from other workers
+VISIBILITY_TIMEOUT = int(os.environ.get('UPS_VISIBILITY_TIMEOUT', '900'))
+
+# how long each receive waits for a message to arrive, 20 seconds is the SQS maximum
+RECEIVE_WAIT_SECONDS = int(os.environ.get('UPS_RECEIVE_WAIT_SECONDS', '20'))
+
+# longest pause between receives while the queue is empty
+MAX_IDLE_BACKOFF_SECONDS = int(os.environ.get('UPS_MAX_IDLE_BACKOFF_SECONDS', '60'))
+
+# SQS will not return more than 10 messages per receive call
+MAX_MESSAGES_PER_RECEIVE = 10
+
+# how long messages in progress get to finish once the worker is asked to
+# stop, which should be less than the ECS task's stop timeout
+SHUTDOWN_GRACE_SECONDS = int(os.environ.get('UPS_SHUTDOWN_GRACE_SECONDS', '25'))
+
+
+class LoopVisibilityHeartbeat:
+    """
+    Keeps a message hidden from other workers while it is being processed
+
+    A task of the asyncio event loop extends the message's visibility every
+    third of VISIBILITY_TIMEOUT until the message is deleted, released with
+    change_visibility or the heartbeat is stopped. Each extension is made in
+    the loop's default executor, so one loop keeps any number of messages
+    hidden without a thread per message. stop, delete and change_visibility
+    can be called from any thread. Other attributes are passed through to
+    the wrapped message, so the heartbeat can be used in its place.
+    """
+
+    def __init__(self, message, loop, logger=None, visibility_timeout=VISIBILITY_TIMEOUT, interval=None):
+        self.message = message
+        self.loop = loop
+        self.logger = logger
+        self.visibility_timeout = visibility_timeout
+        self.interval = interval if interval is not None else max(visibility_timeout // 3, 1)
+        self.stopped = threading.Event()
+        # held while extending so stop() never returns with an extension in flight
+        self.lock = threading.Lock()
+        self.task = None
+
+    def __getattr__(self, name):
+        return getattr(self.message, name)
+
+    def start(self):
+        """
+        Starts extending the message's visibility
+        """
+        self.task = asyncio.run_coroutine_threadsafe(self.run_async(), self.loop)
+
+        return self
+
+    async def run_async(self):
+        """
+        Extends the message's visibility until the heartbeat is stopped
+        """
+        while await self.loop.run_in_executor(None, self.extend):
+            await asyncio.sleep(self.interval)
+
+    def extend(self):
+        """
+        Extends the message's visibility unless the heartbeat has been
+        stopped, and returns whether it did
+        """
+        with self.lock:
+            if self.stopped.is_set():
+                return False
+
+            try:
+                self.message.change_visibility(VisibilityTimeout=self.visibility_timeout)
+            except botocore.exceptions.ClientError as exc:
+                # SQS refuses to extend a message past 12 hours from when it was received
+                write_to_logs("[ERROR] Failed to extend visibility of message {}: {}".format(
+                    self.message.message_id, exc), self.logger)
+                self.stopped.set()
+                return False
+
+        return True
+
+    def stop(self):
+        """
+        Stops extending the message's visibility
+        """
+        with self.lock:
+            self.stopped.set()
+
+        if self.task is not None:
+            self.task.cancel()
+
+    def change_visibility(self, **kwargs):
+        """
+        Stops the heartbeat and changes the message's visibility
+        """
+        self.stop()
+
+        return self.message.change_visibility(**kwargs)
+
+    def delete(self):
+        """
+        Stops the heartbeat and deletes the message
+        """
+        self.stop()
+
+        return self.message.delete()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class ReceiveScheduler:
+    """
+    Decides how long to pause between receives and keeps metrics on them
+
+    There is no pause while receives return messages. Each empty receive
+    doubles the pause, up to max_backoff seconds.
+    """
+
+    def __init__(self, max_backoff=MAX_IDLE_BACKOFF_SECONDS):
+        self.max_backoff = max_backoff
+        self.delay = 0
+        self.receives = 0
+        self.empty_receives = 0
+        self.messages = 0
+        self.receive_seconds = 0.0
+        self.max_message_age = 0.0
+
+    def record_receive(self, messages, receive_seconds):
+        """
+        Records the result of a receive and returns the pause before the next one
+        """
+        self.receives += 1
+        self.receive_seconds += receive_seconds
+        self.messages += len(messages)
+
+        if messages:
+            self.delay = 0
+            now = time.time()
+
+            for message in messages:
+                sent_timestamp = (message.attributes or {}).get('SentTimestamp')
+
+                if sent_timestamp is not None:
+                    self.max_message_age = max(self.max_message_age, now - int(sent_timestamp) / 1000)
+        else:
+            self.empty_receives += 1
+            self.delay = min(max(self.delay * 2, 1), self.max_backoff)
+
+        return self.delay
+
+    def summary(self):
+        """
+        Returns the receive metrics as a log line
+        """
+        return ("receives={} empty_receives={} messages={} mean_receive_seconds={:.2f} "
+                "max_message_age_seconds={:.1f}").format(
+            self.receives, self.empty_receives, self.messages,
+            self.receive_seconds / self.receives if self.receives else 0.0, self.max_message_age)
+
+
+async def poll_queue_async(queue, process_message, on_idle, max_in_flight, attribute_names, logger=None,
+                           scheduler=None, wait_seconds=RECEIVE_WAIT_SECONDS, stopping=None,
+                           grace_seconds=SHUTDOWN_GRACE_SECONDS, visibility_timeout=VISIBILITY_TIMEOUT):
+    """
+    Keeps up to max_in_flight messages in progress at a time as tasks of the
+    running event loop, only asking the queue for as many messages as there
+    are free slots
+
+    process_message is a coroutine function called with each message wrapped
+    in a LoopVisibilityHeartbeat, so a message in progress costs a task rather
+    than a thread. Receives and on_idle, which block, run in a thread. Once
+    stopping is set no more messages are received, the messages in progress
+    get grace_seconds to finish, and any that do not are cancelled and then
+    made visible again so another worker picks them up straight away.
+    process_message should handle the cancellation by making sure its work
+    can no longer delete the message, and re-raise it, or return normally if
+    the message was already dealt with.
+    """
+    loop = asyncio.get_running_loop()
+    scheduler = scheduler or ReceiveScheduler()
+    stopping = stopping or asyncio.Event()
+    stopped = loop.create_task(stopping.wait())
+    receiver = ThreadPoolExecutor(max_workers=1, thread_name_prefix='receive')
+    in_flight = {}
+
+    def finish(tasks):
+        for task in tasks:
+            in_flight.pop(task)
+
+            if not task.cancelled() and task.exception() is not None:
+                write_to_logs("[ERROR] Unhandled error processing message {}".format(task.exception()), logger)
+
+    try:
+        while not stopping.is_set():
+            free_slots = max_in_flight - len(in_flight)
+            delay = None
+
+            if free_slots > 0:
+                start_time = time.monotonic()
+                messages = await loop.run_in_executor(receiver, partial(
+                    queue.receive_messages,
+                    MaxNumberOfMessages=min(free_slots, MAX_MESSAGES_PER_RECEIVE),
+                    MessageAttributeNames=attribute_names,
+                    AttributeNames=['SentTimestamp'],
+                    WaitTimeSeconds=wait_seconds))
+                delay = scheduler.record_receive(messages, time.monotonic() - start_time)
+
+                write_to_logs("Step 1 - File Retrieval: Found {} messages ({})".format(
+                    len(messages), scheduler.summary()))
+
+                if stopping.is_set():
+                    # asked to stop during the long poll
+                    for message in messages:
+                        await loop.run_in_executor(None, partial(message.change_visibility, VisibilityTimeout=0))
+
+                    break
+
+                if not messages:
+                    await loop.run_in_executor(receiver, on_idle)
+
+                for message in messages:
+                    heartbeat = LoopVisibilityHeartbeat(message, loop, logger, visibility_timeout).start()
+                    in_flight[loop.create_task(process_message(heartbeat))] = heartbeat
+
+            if in_flight or delay:
+                # with every slot busy there is nothing to do until a message finishes
+                (done, _) = await asyncio.wait(
+                    list(in_flight) + [stopped], timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                finish(done - {stopped})
+
+        if in_flight:
+            write_to_logs("Shutting down: waiting up to {}s for {} messages in progress".format(
+                grace_seconds, len(in_flight)), logger)
+            (done, pending) = await asyncio.wait(list(in_flight), timeout=grace_seconds)
+            finish(done)
+
+            for task in pending:
+                task.cancel()
+
+            if pending:
+                await asyncio.wait(pending)
+
+            for task in pending:
+                if not task.cancelled():
+                    # the message was dealt with before it could be cancelled
+                    finish([task])
+                    continue
+
+                write_to_logs("Shutting down: releasing message {}".format(in_flight[task].message_id), logger)
+
+                try:
+                    await loop.run_in_executor(None, partial(in_flight[task].change_visibility, VisibilityTimeout=0))
+                except botocore.exceptions.ClientError as exc:
+                    write_to_logs("[ERROR] Failed to release message {}: {}".format(
+                        in_flight[task].message_id, exc), logger)
+    finally:
+        stopped.cancel()
+        receiver.shutdown(wait=False)
+
+    return scheduler
+
+
+def stop_on_signals(stopping, logger=None, signals=(signal.SIGTERM, signal.SIGINT)):
+    """
+    Sets the asyncio event stopping when the process gets one of signals,
+    such as the SIGTERM ECS sends before it kills a task
+    """
+    loop = asyncio.get_running_loop()
+
+    def on_signal(signum):
+        write_to_logs("Received {}, finishing the messages in progress".format(signal.Signals(signum).name), logger)
+        stopping.set()
+
+    for signum in signals:
+        loop.add_signal_handler(signum, on_signal, signum)
@@ -0,0 +1,67 @@
+"""
+File-like wrappers used to process files as they stream in from S3
+"""
+import hashlib
+import io
+from src.checksums import Checksums
+
+
+class HashingReader(io.RawIOBase):
+    """
+    Wraps a readable stream and updates checksums with every byte read from it
+
+    Wrap it in io.BufferedReader to get efficient small reads and peek()
+    """
+
+    def __init__(self, stream, part_size=None):
+        super().__init__()
+        self.stream = stream
+        self.checksums = Checksums(part_size)
+        self.bytes_read = 0
+
+    def readinto(self, buffer):
+        """
+        Reads from the wrapped stream into buffer, hashing the bytes read
+        """
+        data = self.stream.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        self.checksums.update(data)
+        self.bytes_read += size
+
+        return size
+
+    def readable(self):
+        return True
+
+    def hexdigest(self):
+        """
+        Returns the MD5 of everything read so far
+        """
+        return self.checksums.hexdigest()
+
+
+class HashingWriter:
+    """
+    Wraps a writable file and updates an MD5 with every byte written to it
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5_hash = hashlib.md5()
+        self.bytes_written = 0
+
+    def write(self, data):
+        """
+        Writes to the wrapped file, hashing the bytes written
+        """
+        self.md5_hash.update(data)
+        self.bytes_written += len(data)
+
+        return self.fileobj.write(data)
+
+    def hexdigest(self):
+        """
+        Returns the MD5 of everything written so far
+        """
+        return self.md5_hash.hexdigest()
@@ -0,0 +1,222 @@
+"""
+Utilities for writing bgzipped VCF files and building their tabix index in
+the same pass
+"""
+import struct
+from src.bgzf import BgzfWriter, ParallelBgzfWriter
+
+TBI_MAGIC = b'TBI\x01'
+TBI_FORMAT_VCF = 2
+
+# size of the windows in the tabix linear index
+LINEAR_INDEX_SHIFT = 14
+
+# bin htslib reads each reference's offset range and record counts from,
+# which it needs to iterate over a whole reference or the whole file
+META_BIN = 37450
+
+
+def reg2bin(beg, end):
+    """
+    Returns the UCSC bin for the 0-based, half-open region beg to end
+    """
+    end -= 1
+
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+
+    return 0
+
+
+def vcf_record_region(line):
+    """
+    Returns the chromosome and 0-based, half-open region covered by a VCF record
+    """
+    (chrom, pos, _, ref, rest) = line.split(b'\t', 4)
+    beg = int(pos) - 1
+    end = beg + (len(ref) or 1)
+
+    # only split out the INFO column for the rare records that might set END
+    if b'END=' in rest:
+        for item in rest.split(b'\t', 4)[3].split(b';'):
+            if item.startswith(b'END='):
+                end = max(end, int(item[4:]))
+                break
+
+    return chrom, beg, end
+
+
+class TabixIndexBuilder:
+    """
+    Collects the bins and linear index of a VCF as its records are written
+
+    Offsets are kept as uncompressed offsets until the index is written, when
+    they are converted to virtual offsets
+    """
+
+    def __init__(self):
+        self.names = []
+        self.bins = []
+        self.linear_indexes = []
+        self.extents = []
+        self.current_name = None
+        self.current_bins = None
+        self.current_linear_index = None
+        self.current_extent = None
+        self.last_position = 0
+
+    def add_record(self, chrom, beg, end, start_offset, end_offset):
+        """
+        Adds a record covering beg to end that starts at start_offset and ends
+        just before end_offset in the uncompressed file
+        """
+        if chrom != self.current_name:
+            if chrom in self.names:
+                raise ValueError("VCF is not sorted, {} appears in more than one block".format(
+                    chrom.decode('ascii', 'replace')))
+
+            self.current_name = chrom
+            self.current_bins = {}
+            self.current_linear_index = []
+            # first offset, last offset and number of records of the reference
+            self.current_extent = [start_offset, end_offset, 0]
+            self.names.append(chrom)
+            self.bins.append(self.current_bins)
+            self.linear_indexes.append(self.current_linear_index)
+            self.extents.append(self.current_extent)
+        elif beg < self.last_position:
+            raise ValueError("VCF is not sorted, position {} on {} is out of order".format(
+                beg + 1, chrom.decode('ascii', 'replace')))
+
+        self.last_position = beg
+        self.current_extent[1] = end_offset
+        self.current_extent[2] += 1
+
+        first_window = beg >> LINEAR_INDEX_SHIFT
+        last_window = (end - 1) >> LINEAR_INDEX_SHIFT
+
+        # most records fit in a single 16 KiB bin
+        bin_number = 4681 + first_window if first_window == last_window else reg2bin(beg, end)
+        chunks = self.current_bins.get(bin_number)
+
+        if chunks is None:
+            self.current_bins[bin_number] = [[start_offset, end_offset]]
+        elif chunks[-1][1] == start_offset:
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+
+        # records are sorted, so every window from this record's first window
+        # up to the end of the linear index has already been filled in
+        linear_index = self.current_linear_index
+        windows = len(linear_index)
+
+        if last_window >= windows:
+            if first_window > windows:
+                linear_index.extend([None] * (first_window - windows))
+                windows = first_window
+
+            linear_index.extend([start_offset] * (last_window + 1 - windows))
+
+    def write(self, fileobj, virtual_offset):
+        """
+        Writes the BGZF compressed index to fileobj, using virtual_offset to
+        convert uncompressed offsets
+        """
+        names = b''.join(name + b'\x00' for name in self.names)
+
+        with BgzfWriter(fileobj) as writer:
+            writer.write(TBI_MAGIC)
+            writer.write(struct.pack('<8i', len(self.names), TBI_FORMAT_VCF, 1, 2, 0, ord('#'), 0, len(names)))
+            writer.write(names)
+
+            for bins, linear_index, extent in zip(self.bins, self.linear_indexes, self.extents):
+                writer.write(struct.pack('<i', len(bins) + 1))
+
+                for bin_number in sorted(bins):
+                    chunks = bins[bin_number]
+                    writer.write(struct.pack('<Ii', bin_number, len(chunks)))
+
+                    for (start_offset, end_offset) in chunks:
+                        writer.write(struct.pack('<2Q', virtual_offset(start_offset), virtual_offset(end_offset)))
+
+                # the pseudo-bin holds two chunks: the reference's offset range,
+                # then its mapped and unmapped record counts
+                writer.write(struct.pack('<Ii', META_BIN, 2))
+                writer.write(struct.pack('<4Q', virtual_offset(extent[0]), virtual_offset(extent[1]), extent[2], 0))
+
+                # windows without a record of their own point at the previous window's offset
+                offsets = []
+                previous = 0
+
+                for offset in linear_index:
+                    previous = previous if offset is None else virtual_offset(offset)
+                    offsets.append(previous)
+
+                writer.write(struct.pack('<i', len(offsets)))
+                writer.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+
+            # records without coordinates, which a VCF never has
+            writer.write(struct.pack('<Q', 0))
+
+
+class VcfTabixWriter:
+    """
+    Writes a bgzipped VCF to file_name and its tabix index to file_name.tbi
+
+    Blocks are compressed across `threads` threads and the index is built from
+    the offsets of the lines as they are written, so compressing and indexing
+    take a single pass
+    """
+
+    def __init__(self, file_name, threads=1, level=6):
+        self.file_name = file_name
+        self.output = open(file_name, 'wb')
+        self.writer = ParallelBgzfWriter(self.output, threads, level)
+        self.index = TabixIndexBuilder()
+
+    def write(self, data):
+        """
+        Writes one or more complete VCF lines
+        """
+        offset = self.writer.tell()
+        self.writer.write(data)
+        add_record = self.index.add_record
+
+        for line in data.splitlines(True):
+            end_offset = offset + len(line)
+
+            # blank lines, such as a trailing empty line, are not records
+            if line[:1] != b'#' and line.strip():
+                (chrom, beg, end) = vcf_record_region(line)
+                add_record(chrom, beg, end, offset, end_offset)
+
+            offset = end_offset
+
+    def close(self):
+        """
+        Finishes the bgzipped VCF and writes the index
+        """
+        self.writer.close()
+        self.output.close()
+
+        with open('{}.tbi'.format(self.file_name), 'wb') as index_file:
+            self.index.write(index_file, self.writer.virtual_offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.writer.__exit__(exc_type, exc_value, traceback)
+            self.output.close()
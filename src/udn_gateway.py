@@ -1,32 +1,249 @@
 """
 Utilities for interacting with the UDN Gateway
 """
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from src.metrics import METRICS
+from src.utilities import silent_remove, write_to_logs
 
-from utilities import write_to_logs
+# completions waiting to be sent to the gateway, kept on disk so they are
+# sent after a restart
+GATEWAY_OUTBOX_DIR = '/scratch/gateway_outbox'
 
+# seconds to wait for each response from the gateway
+GATEWAY_TIMEOUT_SECONDS = float(os.environ.get('UPS_GATEWAY_TIMEOUT_SECONDS', '10'))
 
-def call_udngateway_mark_complete(file_id, secret, logger):
+# retries of a call that failed to connect or got a 5xx or 429, with exponential backoff
+GATEWAY_RETRIES = int(os.environ.get('UPS_GATEWAY_RETRIES', '5'))
+
+# seconds before completions whose retries all failed are tried again
+GATEWAY_RETRY_SECONDS = float(os.environ.get('UPS_GATEWAY_RETRY_SECONDS', '60'))
+
+# files marked complete in one call to the batch endpoint, 1 to call the
+# endpoint of each file instead
+GATEWAY_BATCH_SIZE = int(os.environ.get('UPS_GATEWAY_BATCH_SIZE', '1'))
+
+# seconds to wait at shutdown for the outbox to be sent, what is left is sent
+# after the restart
+GATEWAY_SHUTDOWN_SECONDS = float(os.environ.get('UPS_GATEWAY_SHUTDOWN_SECONDS', '5'))
+
+GATEWAY_BATCH_PATH = os.environ.get('UPS_GATEWAY_BATCH_PATH', '/api/dbgap/exported_files/complete')
+
+GATEWAY_POOL_CONNECTIONS = 4
+
+# responses that may succeed if the call is made again later, 401 and 403
+# included since the token may have been rotated
+RETRYABLE_STATUS_CODES = frozenset([401, 403, 408, 429, 500, 502, 503, 504])
+
+# responses meaning the token was rejected
+UNAUTHORIZED_STATUS_CODES = frozenset([401, 403])
+
+
+class GatewayClient:
     """
-    Call the UDN Gateway API to mark the file as complete
+    Marks exported files complete in the UDN Gateway in the background
+
+    mark_complete records the file in an outbox on disk and returns straight
+    away, so the worker can delete the message and move on while a thread
+    sends the completion. Calls share a connection pool and are retried with
+    backoff. A completion that still fails stays in the outbox and is tried
+    again after retry_seconds, and the outbox is sent again when the
+    container restarts. With a batch_size above 1, queued completions are
+    sent together to the gateway's batch endpoint.
+
+    get_secret returns the secret with the gateway URL and token, and is
+    called for each request so a rotated token is used. When the gateway
+    rejects the token, on_unauthorized is called before the completions are
+    retried, so a cached secret can be dropped and the rotated token fetched.
     """
-    try:
+
+    def __init__(self, get_secret, outbox_dir=GATEWAY_OUTBOX_DIR, batch_size=GATEWAY_BATCH_SIZE,
+                 retries=GATEWAY_RETRIES, backoff_factor=0.5, timeout=GATEWAY_TIMEOUT_SECONDS,
+                 retry_seconds=GATEWAY_RETRY_SECONDS, on_unauthorized=None, logger=None):
+        self.get_secret = get_secret
+        self.on_unauthorized = on_unauthorized
+        self.outbox_dir = outbox_dir
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self.logger = logger
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.condition = threading.Condition()
+        self.thread = None
+
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=['POST'], raise_on_status=False)
+        self.session = requests.Session()
+        self.session.verify = False
+        self.session.mount('http://', HTTPAdapter(GATEWAY_POOL_CONNECTIONS, GATEWAY_POOL_CONNECTIONS, retry))
+        self.session.mount('https://', HTTPAdapter(GATEWAY_POOL_CONNECTIONS, GATEWAY_POOL_CONNECTIONS, retry))
+
+    def start(self):
+        """
+        Queues the completions left in the outbox by an earlier run and starts
+        sending completions
+        """
+        os.makedirs(self.outbox_dir, exist_ok=True)
+
+        for name in sorted(os.listdir(self.outbox_dir)):
+            try:
+                with open(os.path.join(self.outbox_dir, name)) as outbox_file:
+                    file_id = json.load(outbox_file)['file_id']
+            except (OSError, ValueError, KeyError):
+                continue
+
+            write_to_logs("Step 4: Mark File Complete: Resending completion of file {}".format(file_id), self.logger)
+            self.enqueue(file_id)
+
+        self.thread = threading.Thread(target=self.run, daemon=True, name='gateway')
+        self.thread.start()
+
+        return self
+
+    def outbox_path(self, file_id):
+        """
+        Returns the path of the outbox entry of file_id
+        """
+        return os.path.join(self.outbox_dir, '{}.json'.format(hashlib.sha1(str(file_id).encode()).hexdigest()))
+
+    def mark_complete(self, file_id):
+        """
+        Records that file_id is complete and queues it to be sent to the gateway
+        """
+        os.makedirs(self.outbox_dir, exist_ok=True)
+        outbox_file = self.outbox_path(file_id)
+        temp_file = '{}.tmp'.format(outbox_file)
+
+        with open(temp_file, 'w') as outbox_handle:
+            json.dump({'file_id': file_id, 'time': time.time()}, outbox_handle)
+            outbox_handle.flush()
+            os.fsync(outbox_handle.fileno())
+
+        os.replace(temp_file, outbox_file)
+        self.enqueue(file_id)
+
+    def enqueue(self, file_id):
+        """
+        Queues file_id to be sent
+        """
+        with self.condition:
+            self.pending.add(file_id)
+
+        self.queue.put(file_id)
+
+    def run(self):
+        """
+        Sends queued completions, up to batch_size in a call
+        """
+        while True:
+            file_ids = [self.queue.get()]
+
+            while len(file_ids) < self.batch_size:
+                try:
+                    file_ids.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            file_ids = list(dict.fromkeys(file_ids))
+
+            try:
+                (done, retry) = self.send(file_ids)
+            except Exception as exc:
+                write_to_logs("Step 4: Mark File Complete: Failed to mark files {} complete with error {}".format(
+                    ', '.join(str(file_id) for file_id in file_ids), exc), self.logger)
+                (done, retry) = ([], file_ids)
+
+            for file_id in done:
+                silent_remove(self.outbox_path(file_id))
+
+            if retry:
+                timer = threading.Timer(self.retry_seconds, self.requeue, [retry])
+                timer.daemon = True
+                timer.start()
+
+            with self.condition:
+                self.pending.difference_update(done)
+                self.condition.notify_all()
+
+    def requeue(self, file_ids):
+        """
+        Queues completions that failed to be sent again
+        """
+        for file_id in file_ids:
+            self.queue.put(file_id)
+
+    def send(self, file_ids):
+        """
+        Marks file_ids complete, in one call if there is more than one and
+        batching is on, and returns the IDs that are done and those to retry
+        """
+        secret = self.get_secret()
         headers = {
             'Content-Type': 'application/json',
             'Authorization': 'Token {token}'.format(token=secret['udn_api_token'])
         }
 
-        url = '{}/api/dbgap/exported_files/{}/complete'.format(secret['udn_api_url'], file_id)
+        if self.batch_size > 1 and len(file_ids) > 1:
+            url = '{}{}'.format(secret['udn_api_url'], GATEWAY_BATCH_PATH)
+            status_code = self.post(url, headers, {'ids': file_ids})
+            results = {file_id: status_code for file_id in file_ids}
+            retry = []
+        else:
+            results = {}
+            retry = []
 
-        resp = requests.post(url, headers=headers, verify=False, timeout=5)
+            # one failed call must not send the files already marked complete again
+            for file_id in file_ids:
+                url = '{}/api/dbgap/exported_files/{}/complete'.format(secret['udn_api_url'], file_id)
 
-        if resp.status_code == 200:
-            msg = "Step 4: Mark File Complete: Successfully marked file {} complete".format(file_id)
-        else:
-            msg = "Step 4: Mark File Complete: Failed to mark file {} complete with status code {}".format(
-                file_id, resp.status_code)
+                try:
+                    results[file_id] = self.post(url, headers)
+                except Exception as error:
+                    write_to_logs("Step 4: Mark File Complete: Failed to mark file {} complete with error {}, "
+                                  "retrying in {}s".format(file_id, error, self.retry_seconds), self.logger)
+                    retry.append(file_id)
+
+        done = []
+
+        for (file_id, status_code) in results.items():
+            if status_code == 200:
+                msg = "Step 4: Mark File Complete: Successfully marked file {} complete".format(file_id)
+                done.append(file_id)
+            elif status_code in RETRYABLE_STATUS_CODES:
+                msg = ("Step 4: Mark File Complete: Failed to mark file {} complete with status code {}, "
+                       "retrying in {}s").format(file_id, status_code, self.retry_seconds)
+                retry.append(file_id)
+            else:
+                msg = "Step 4: Mark File Complete: Failed to mark file {} complete with status code {}".format(
+                    file_id, status_code)
+                done.append(file_id)
+
+            write_to_logs(msg, self.logger)
+
+        if self.on_unauthorized is not None and UNAUTHORIZED_STATUS_CODES.intersection(results.values()):
+            self.on_unauthorized()
+
+        return done, retry
+
+    def post(self, url, headers, body=None):
+        """
+        POSTs body to url and returns the status code
+        """
+        with METRICS.timer('gateway'):
+            return self.session.post(url, headers=headers, json=body, timeout=self.timeout).status_code
 
-        write_to_logs(msg, logger)
-    except Exception as exc:
-        msg = "Step 4: Mark File Complete: Failed to mark file {} complete with error {}".format(id, exc)
-        write_to_logs(msg, logger)
+    def wait(self, timeout=None):
+        """
+        Waits until every queued completion has been sent or given up on and
+        returns whether it did before the timeout
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending, timeout)
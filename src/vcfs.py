@@ -2,15 +2,21 @@
 Utilities for processing VCF files
 """
 import gzip
+import io
 import os
-import re
-import sys
-import uuid
-from subprocess import check_output
+import socket
+import time
 import pysam
-from src.archive import tar_and_remove_files
-from src.aws_utils import get_s3_client
-from src.utilities import write_to_logs
+from src.archive import RollingArchiveWriter
+from src.aspera import TRANSFER_MANAGER
+from src.aws_utils import get_s3_object_stream
+from src.checksums import verify_checksums
+from src.compute import COMPUTE_POOL
+from src.s3_transfers import upload_file_to_s3
+from src.streaming import HashingReader
+from src.tabix import VcfTabixWriter
+from src.utilities import silent_remove, write_to_logs
+from src.workspace import STALE_WORKSPACE_SECONDS
 
 # only these INFO annotations will be retained
 WHITELISTED_ANNOTATIONS = {
@@ -20,6 +26,35 @@ WHITELISTED_ANNOTATIONS = {
     'SOR', 'VQSLOD', 'culprit'
 }
 
+WHITELISTED_ANNOTATION_KEYS = frozenset(annotation.encode() for annotation in WHITELISTED_ANNOTATIONS)
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+STREAM_BUFFER_SIZE = 2**20
+
+# bytes of records trimmed at a time
+TRIM_BUFFER_SIZE = 4 * 2**20
+
+# distinct INFO items remembered by AnnotationLookup before it starts over
+ANNOTATION_LOOKUP_SIZE = 2**20
+
+# threads used to bgzip each VCF
+COMPRESSION_THREADS = int(os.environ.get('UPS_COMPRESSION_THREADS', os.cpu_count() or 1))
+
+# directory the VCFs have always been stored under inside the archive sent to dbGaP
+ARCNAME_DIR = 'scratch'
+
+# an archive is rolled over and uploaded in the background once it reaches this size
+VCF_ARCHIVE_MAX_BYTES = int(float(os.environ.get('UPS_VCF_ARCHIVE_MAX_GB', '250')) * 2**30)
+
+VCF_ARCHIVE_PREFIX = 'vcf_archive'
+
+# /scratch/vcf_archive_<hostname>.tar, shared by all workers in the container.
+# Containers on other hosts sharing /scratch each fill their own archive.
+# poll_process sets on_rollover to upload the archives that fill up
+VCF_ARCHIVE = RollingArchiveWriter('/scratch', '{}_{}'.format(VCF_ARCHIVE_PREFIX, socket.gethostname()),
+                                   VCF_ARCHIVE_MAX_BYTES, arcname_dir=ARCNAME_DIR)
+
 
 def process_header(line, new_ids=None):
     """
@@ -34,6 +69,9 @@ def process_header(line, new_ids=None):
     ):
         return None
 
+    if line.startswith('##INFO=<ID=') and line[len('##INFO=<ID='):].split(',', 1)[0] not in WHITELISTED_ANNOTATIONS:
+        return None
+
     if line.startswith('#CHROM') and new_ids is not None:
         fields = line.strip().split('\t')[:9]  # fixed headers
         fields.extend(new_ids)
@@ -42,6 +80,89 @@ def process_header(line, new_ids=None):
     return line
 
 
+class AnnotationLookup(dict):
+    """
+    Lookup table of whether each INFO item (KEY=value or a flag) is
+    whitelisted, filled in as new items are seen. Values such as AN=2 or
+    MQ=60.00 repeat across records, so most items cost a single dict lookup.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self[b'.'] = True
+
+    def __missing__(self, item):
+        if len(self) >= ANNOTATION_LOOKUP_SIZE:
+            self.clear()
+            self[b'.'] = True
+
+        is_whitelisted = self[item] = item.split(b'=', 1)[0] in WHITELISTED_ANNOTATION_KEYS
+
+        return is_whitelisted
+
+
+def trim_vcf_records(data, annotation_lookup):
+    """
+    Removes the INFO annotations which are not whitelisted from a buffer of
+    complete VCF records, only rebuilding the records that change
+    """
+    records = data.split(b'\n')
+    is_whitelisted = annotation_lookup.__getitem__
+
+    for index, record in enumerate(records):
+        fields = record.split(b'\t', 8)
+
+        if len(fields) > 7:
+            items = fields[7].split(b';')
+            # filter calls the lookup from C, and comparing lengths is
+            # cheaper than checking a list of flags
+            kept = list(filter(is_whitelisted, items))
+
+            if len(kept) != len(items):
+                fields[7] = b';'.join(kept) or b'.'
+                records[index] = b'\t'.join(fields)
+
+    return b'\n'.join(records)
+
+
+def trim_vcf_buffers(f_input, new_id):
+    """
+    Yields a trimmed copy of the VCF in the binary file f_input as large
+    buffers of complete lines, without decoding the records to text
+    """
+    header = []
+    line = f_input.readline()
+
+    while line.startswith(b'#'):
+        result = process_header(line.decode('utf-8', 'surrogateescape'), (new_id,))
+
+        if result is not None:
+            header.append(result.encode('utf-8', 'surrogateescape'))
+
+        line = f_input.readline()
+
+    yield b''.join(header)
+
+    annotation_lookup = AnnotationLookup()
+    pending = line
+
+    while True:
+        chunk = f_input.read(TRIM_BUFFER_SIZE)
+
+        if not chunk:
+            break
+
+        data = pending + chunk
+        end = data.rfind(b'\n') + 1
+        pending = data[end:]
+
+        if end:
+            yield trim_vcf_records(data[:end], annotation_lookup)
+
+    if pending:
+        yield trim_vcf_records(pending, annotation_lookup)
+
+
 def is_gzipped(file_path):
     """Check if the file is gzipped by reading its magic number."""
     with open(file_path, 'rb') as f:
@@ -49,89 +170,205 @@ def is_gzipped(file_path):
     return magic_number == b'\x1f\x8b'  
 
 
+def open_vcf(file_path):
+    """
+    Opens a VCF for binary reading, decompressing it if it is gzipped
+    """
+    if is_gzipped(file_path):
+        return gzip.open(file_path, 'rb')
+
+    return open(file_path, 'rb')
+
+
 def trim_vcf(from_file, to_file, new_id):
     """
     Trims unwanted INFO annotations from a VCF file, including the header.
     Also replaces sample ID.
     """
-    try:
-        try:
-            if is_gzipped(from_file):
-                f_input = gzip.open(from_file, 'rt')
-            else:
-                f_input = open(from_file)
-        except IOError as e:
-            print(f"Error opening file {from_file}: {e}")
-            f_input = None  # Handle the case where the file cannot be opened
-    finally:
-        with open(to_file, 'w') as f_output:
-            for line in f_input:
-                if line.startswith('#'):
-                    result = process_header(line, (new_id,))
-                    if result is not None:
-                        f_output.write(result)
-                else:
-                    f_output.write(line)
-
-        if not f_input.closed:
-            f_input.close()
-        if not f_output.closed:
-            f_output.close()
-
-
-def process_vcf(sample_id, upload_file_name, temp_file, logger):
+    with open_vcf(from_file) as f_input, open(to_file, 'wb') as f_output:
+        for buffer in trim_vcf_buffers(f_input, new_id):
+            f_output.write(buffer)
+
+
+def write_trimmed_vcf(f_input, output_file, new_id, threads=None):
+    """
+    Trims the VCF in the binary file f_input, then bgzips it to output_file
+    and writes the tabix index to output_file.tbi
+
+    With more than one thread, blocks are compressed across the threads and
+    the index is built in the same pass. With one, htslib compresses and
+    indexes the file, which is faster than doing either in Python.
+    """
+    threads = threads or COMPRESSION_THREADS
+
+    if threads > 1:
+        with VcfTabixWriter(output_file, threads) as vcf_output:
+            for buffer in trim_vcf_buffers(f_input, new_id):
+                vcf_output.write(buffer)
+    else:
+        with pysam.BGZFile(output_file, 'wb') as vcf_output:
+            for buffer in trim_vcf_buffers(f_input, new_id):
+                vcf_output.write(buffer)
+
+        pysam.tabix_index(output_file, preset='vcf', force=True)
+
+
+def trim_and_compress_vcf(input_path, output_file, new_id):
+    """
+    Trims, bgzips and indexes the VCF at input_path into output_file. Run in
+    a compute process.
+    """
+    with open_vcf(input_path) as f_input:
+        write_trimmed_vcf(f_input, output_file, new_id)
+
+
+def process_vcf(sample_id, upload_file_name, temp_file, logger, workspace):
     """
     manage the processing of VCF files
+
+    The VCF is trimmed, compressed and indexed in the compute pool.
+    Intermediate files are written to the workspace, the trimmed and indexed
+    VCF is then added to the shared VCF archive in /scratch
     """
+    backup_file = workspace.path('{}.bak'.format(upload_file_name))
+    output_file = workspace.path('{}.gz'.format(upload_file_name))
+
     write_to_logs("Step 2 - Processing File: Renaming VCF file to {}".format(upload_file_name))
-    os.rename(temp_file, "/scratch/{}.bak".format(upload_file_name))
+    os.rename(temp_file, backup_file)
 
     try:
         write_to_logs(
-            "Step 2 - Processing File: Replacing sample_id and removing extra info for VCF file {}".format(
-                upload_file_name))
-        trim_vcf('/scratch/{}.bak'.format(upload_file_name), '/scratch/{}'.format(upload_file_name), sample_id)
+            "Step 2 - Processing File: Replacing sample_id, removing extra info, compressing and indexing "
+            "VCF file {}".format(upload_file_name))
+
+        COMPUTE_POOL.run(trim_and_compress_vcf, backup_file, output_file, sample_id)
     except Exception as exc:
-        write_to_logs("[ERROR] Step 2 - Processing File: Failed to trim annotations for VCF file {} with error {}".format(
+        write_to_logs(
+            "[ERROR] Step 2 - Processing File: Failed to trim annotations for VCF file {} with error {}".format(
+                upload_file_name, exc), logger)
+        os.rename(backup_file, workspace.path(upload_file_name))
+
+        return False
+
+    files_to_tar = [output_file, '{}.tbi'.format(output_file)]
+
+    VCF_ARCHIVE.add(files_to_tar)
+
+    return True
+
+
+def process_vcf_from_s3(sample_id, upload_file_name, bucket, key, logger, workspace, expected=None):
+    """
+    manage the processing of a VCF while it streams in from S3
+
+    The object is decompressed (if needed), trimmed, bgzipped and indexed in a
+    single pass so the original is never stored on disk. If expected
+    checksums are given, the VCF is only archived if the streamed object
+    matches them
+    """
+    output_file = workspace.path('{}.gz'.format(upload_file_name))
+    source = HashingReader(get_s3_object_stream(bucket, key), expected and expected['part_size'])
+    buffered_source = io.BufferedReader(source, STREAM_BUFFER_SIZE)
+
+    try:
+        write_to_logs(
+            "Step 2 - Processing File: Streaming VCF from S3, replacing sample_id, removing extra info, "
+            "compressing and indexing {}".format(upload_file_name))
+
+        if buffered_source.peek(2)[:2] == GZIP_MAGIC:
+            f_input = gzip.GzipFile(fileobj=buffered_source)
+        else:
+            f_input = buffered_source
+
+        write_trimmed_vcf(f_input, output_file, sample_id)
+
+        if expected is not None:
+            # a gzipped VCF may end before the object does
+            buffered_source.read()
+            verify_checksums(source.checksums.result(), expected, upload_file_name)
+    except Exception as exc:
+        write_to_logs("[ERROR] Step 2 - Processing File: Failed to stream and trim VCF file {} with error {}".format(
             upload_file_name, exc), logger)
-        os.rename('/scratch/{}.bak'.format(upload_file_name), '/scratch/{}'.format(upload_file_name))
 
         return False
 
-    write_to_logs("Step 2 - Processing File: Compressing and indexing VCF {}".format(upload_file_name))
-    pysam.tabix_index('/scratch/{}'.format(upload_file_name), preset='vcf', force=True)
+    write_to_logs("Step 2 - Processing File: Streamed {} bytes with source MD5 {}".format(
+        source.bytes_read, source.hexdigest()))
+
+    files_to_tar = [output_file, '{}.tbi'.format(output_file)]
 
-    files_to_tar = ['/scratch/{}.gz'.format(upload_file_name), '/scratch/{}.gz.tbi'.format(upload_file_name)]
-    tar_and_remove_files('vcf_archive', '/scratch', files_to_tar, logger)
+    VCF_ARCHIVE.add(files_to_tar)
 
     return True
 
 
-def upload_vcf_archive(aspera_vcf_location_code, testing, testing_bucket, testing_folder):
-    if not os.path.exists('/scratch/vcf_archive.tar'):
-        return
+def upload_vcf_archive():
+    """
+    Uploads the current VCF archive, if there is one, in the background and
+    returns the future of the upload
+
+    The archive is rolled over first so workers can keep adding VCFs to a
+    fresh archive while this one uploads, with VCF_ARCHIVE.on_rollover, and
+    the caller does not wait for the upload. Rolled over archives whose
+    upload failed are uploaded again.
+    """
+    return VCF_ARCHIVE.roll_over_in_background()
+
+
+def adopt_stale_vcf_archives(logger=None, max_age=STALE_WORKSPACE_SECONDS):
+    """
+    Takes over the VCF archives of other hosts, or from before archives were
+    named after their host, that have not changed for max_age seconds, so
+    they are uploaded with this container's
+
+    Run once at startup. An archive whose writer still has it open is left
+    alone.
+    """
+    own_prefix = '{}_'.format(VCF_ARCHIVE.name)
+
+    for entry in os.scandir(VCF_ARCHIVE.directory):
+        if not (entry.name.startswith(VCF_ARCHIVE_PREFIX) and entry.name.endswith('.tar') and entry.is_file()):
+            continue
+
+        if entry.path == VCF_ARCHIVE.path or entry.name.startswith(own_prefix):
+            continue
+
+        if time.time() - entry.stat().st_mtime < max_age:
+            continue
+
+        try:
+            adopted = VCF_ARCHIVE.adopt(entry.path)
+        except BlockingIOError:
+            continue
+
+        write_to_logs("Step 3 - File Upload: Took over stale VCF archive {} as {}".format(entry.path, adopted), logger)
 
-    upload_file_name = 'vcf_archive_{}.tar'.format(uuid.uuid1())
-    os.rename('/scratch/vcf_archive.tar', '/scratch/{}'.format(upload_file_name))
+
+def upload_vcf_archive_file(archive_file, aspera_vcf_location_code, testing, testing_bucket, testing_folder,
+                            password=None):
+    """
+    Uploads a rolled over VCF archive and removes it
+
+    If the upload fails the archive is kept and the error raised, so it is
+    uploaded again the next time the VCF archive is.
+    """
+    upload_file_name = os.path.basename(archive_file)
 
     if testing:
         s3_filename = testing_folder + '/' + upload_file_name
-        write_to_logs("[TESTING] Step 3 - File Upload: Attempting to copy file {} to S3 bucket for storage under {}".format(
-            upload_file_name, s3_filename))
-        testing_s3 = get_s3_client()
-        testing_s3.meta.client.upload_file(
-            '/scratch/' + upload_file_name, testing_bucket, s3_filename)
+        write_to_logs(
+            "[TESTING] Step 3 - File Upload: Attempting to copy file {} to S3 bucket for storage under {}".format(
+                upload_file_name, s3_filename))
+        upload_file_to_s3(archive_file, testing_bucket, s3_filename)
     else:
         try:
             upload_location = "subasp@upload.ncbi.nlm.nih.gov:uploads/upload_requests/{}/".format(
                 aspera_vcf_location_code)
-            write_to_logs("Step 3 - File Upload: Attempting to upload file {} via Aspera to {}".format(
-                upload_file_name, upload_location))
-            upload_output = check_output(
-                ["/home/aspera/.aspera/connect/bin/ascp --file-crypt=encrypt -i /aspera/aspera_vcf.pk /scratch/" +
-                 upload_file_name + " " + upload_location], shell=True)
-            write_to_logs("Step 3 - File Upload: Aspera returned {}", format(upload_output))
-        except Exception:
-            write_to_logs(
-                "[ERROR] Step 3 - File Upload: Failed to send archive file via Aspera with error {}".format(
-                    sys.exc_info()[:2]))
+            TRANSFER_MANAGER.upload_files(
+                [archive_file], upload_location, '/aspera/aspera_vcf.pk', ['--file-crypt=encrypt'], password).result()
+        except Exception as exc:
+            raise Exception("Step 3 - File Upload: Failed to send archive file {} via Aspera: {}".format(
+                upload_file_name, exc)) from exc
+
+    write_to_logs("Step 3 - File Upload: Uploaded archive file {}, removing it".format(upload_file_name))
+    silent_remove(archive_file)
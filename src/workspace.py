@@ -0,0 +1,124 @@
+"""
+Per-message scratch directories
+"""
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+from src.utilities import write_to_logs
+
+SCRATCH_ROOT = '/scratch'
+WORKSPACE_PREFIX = 'job_'
+OWNER_FILE = '.owner'
+
+# a workspace of another host is removed once nothing in it has changed for
+# this long, since whether its process is still running cannot be checked
+STALE_WORKSPACE_SECONDS = float(os.environ.get('UPS_STALE_WORKSPACE_HOURS', '24')) * 3600
+
+
+class Workspace:
+    """
+    A directory under root that holds every intermediate file of one message
+
+    Nothing else writes to the directory, so any number of messages can be
+    processed at the same time in one container. The directory records the
+    host and process that created it so workspaces left behind by a crashed
+    worker can be removed when a container starts.
+    """
+
+    def __init__(self, root=SCRATCH_ROOT, prefix=WORKSPACE_PREFIX):
+        self.root = root
+        self.directory = tempfile.mkdtemp(prefix=prefix, dir=root)
+
+        with open(os.path.join(self.directory, OWNER_FILE), 'w') as owner_file:
+            json.dump({'hostname': socket.gethostname(), 'pid': os.getpid()}, owner_file)
+
+    def path(self, name):
+        """
+        Returns the path of name in the workspace
+        """
+        return os.path.join(self.directory, name)
+
+    def cleanup(self):
+        """
+        Removes the workspace and everything in it
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+
+def process_is_running(pid):
+    """
+    Returns whether a process with pid is running on this host
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def last_modified(directory):
+    """
+    Returns the latest modification time of directory or anything in it
+    """
+    latest = os.path.getmtime(directory)
+
+    for (path, _, file_names) in os.walk(directory):
+        for name in file_names:
+            try:
+                latest = max(latest, os.path.getmtime(os.path.join(path, name)))
+            except OSError:
+                pass
+
+    return latest
+
+
+def is_stale(directory, owner, max_age=STALE_WORKSPACE_SECONDS):
+    """
+    Returns whether the workspace in directory, created by owner, was left
+    behind by a process that is no longer running
+
+    A workspace of this host is stale once its process has exited, or if it
+    has this process's pid, which a restarted container reuses. Otherwise
+    whether its process is running cannot be checked, so it is stale once
+    nothing in it has changed for max_age seconds.
+    """
+    if owner.get('hostname') == socket.gethostname() and isinstance(owner.get('pid'), int):
+        return owner['pid'] == os.getpid() or not process_is_running(owner['pid'])
+
+    return time.time() - last_modified(directory) >= max_age
+
+
+def remove_stale_workspaces(root=SCRATCH_ROOT, prefix=WORKSPACE_PREFIX, logger=None, max_age=STALE_WORKSPACE_SECONDS):
+    """
+    Removes workspaces under root left behind by processes that are no longer
+    running, on this host or on others sharing the volume
+
+    Run once at startup, before any workspace of this process exists.
+    """
+    for name in os.listdir(root):
+        directory = os.path.join(root, name)
+
+        if not (name.startswith(prefix) and os.path.isdir(directory)):
+            continue
+
+        try:
+            with open(os.path.join(directory, OWNER_FILE)) as owner_file:
+                owner = json.load(owner_file)
+        except (OSError, ValueError):
+            owner = {}
+
+        if is_stale(directory, owner, max_age):
+            write_to_logs("Removing stale workspace {} of {}".format(directory, owner or 'an unknown owner'), logger)
+            shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,116 @@
+"""
+Collects the XML libraries of many BAMs into one submission
+"""
+import os
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from src.utilities import write_to_logs
+from src.workspace import SCRATCH_ROOT, Workspace
+from src.xml_utils import create_and_tar_batch_xml
+
+# BAMs described by one submission, 1 submits the XML with each BAM
+XML_BATCH_SIZE = int(os.environ.get('UPS_XML_BATCH_SIZE', '1'))
+
+# seconds a BAM waits for the rest of its batch before a smaller batch is sent
+XML_BATCH_WINDOW_SECONDS = float(os.environ.get('UPS_XML_BATCH_WINDOW_SECONDS', '600'))
+
+# prefix of the workspace each batch's XML is written in
+XML_BATCH_PREFIX = 'xml_batch_'
+
+
+class XmlBatch:
+    """
+    Gathers libraries until max_libraries have arrived or window_seconds
+    have passed since the first, then writes one experiment.xml and run.xml
+    with an EXPERIMENT and RUN for each library and a single submission.xml,
+    tars them and passes the tar to on_flush
+
+    add returns a future for each library that completes once on_flush has
+    sent its batch, or fails if writing or sending the batch fails. Batches
+    are written and sent in a background thread, one at a time.
+    """
+
+    def __init__(self, max_libraries=XML_BATCH_SIZE, window_seconds=XML_BATCH_WINDOW_SECONDS, on_flush=None,
+                 root=SCRATCH_ROOT, logger=None):
+        self.max_libraries = max_libraries
+        self.window_seconds = window_seconds
+        self.on_flush = on_flush
+        self.root = root
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.pending = []
+        self.timer = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='xml-batch')
+
+    def add(self, library):
+        """
+        Adds library to the current batch and returns a future that completes
+        when the batch has been sent
+        """
+        future = Future()
+
+        with self.lock:
+            self.pending.append((library, future))
+            write_to_logs("Step 3 - File Upload: Added XML for {} to batch ({} of {})".format(
+                library['upload_file_name'], len(self.pending), self.max_libraries), self.logger)
+
+            if len(self.pending) >= self.max_libraries:
+                self.submit_batch()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.window_seconds, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        return future
+
+    def flush(self):
+        """
+        Sends the current batch, however small, and returns a future that
+        completes when it has been sent
+        """
+        with self.lock:
+            return self.submit_batch()
+
+    def submit_batch(self):
+        """
+        Hands the current batch to the background thread, with the lock held
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        (batch, self.pending) = (self.pending, [])
+
+        return self.executor.submit(self.send, batch)
+
+    def send(self, batch):
+        """
+        Writes the XML of batch, passes the tar to on_flush and completes the
+        futures of its libraries
+        """
+        if not batch:
+            return
+
+        libraries = [library for (library, _) in batch]
+        workspace = Workspace(self.root, XML_BATCH_PREFIX)
+        error = None
+
+        try:
+            tar_file_name = create_and_tar_batch_xml(
+                libraries, '{}{}'.format(XML_BATCH_PREFIX, uuid.uuid1()), self.logger, workspace)
+            write_to_logs("Step 3 - File Upload: Sending XML for {} BAMs in {}".format(
+                len(libraries), os.path.basename(tar_file_name)), self.logger)
+            self.on_flush(tar_file_name)
+        except Exception as exc:
+            write_to_logs("[ERROR] Step 3 - File Upload: Failed to send XML batch with error {}".format(exc),
+                          self.logger)
+            error = exc
+        finally:
+            workspace.cleanup()
+
+        for (_, future) in batch:
+            if error is None:
+                future.set_result(os.path.basename(tar_file_name))
+            else:
+                future.set_exception(error)
@@ -2,7 +2,10 @@
 Utilities functions for creating XML files for dbGaP submission
 """
 import codecs
-import sys
+import copy
+import os
+import threading
+from functools import lru_cache
 from subprocess import call
 from lxml import etree
 from src.archive import tar_and_remove_files
@@ -32,11 +35,22 @@ SEQUENCING_TYPE = {
     4: 'RNA-Seq'
 }
 
+# directory the XML files have always been stored under inside the tar sent to dbGaP
+ARCNAME_DIR = 'scratch'
+
 XML_ACTIONS = [
     {'source': 'experiment.xml', 'schema': 'experiment'},
     {'source': 'run.xml', 'schema': 'run'}
 ]
 
+# directory holding the SRA schemas (SRA.experiment.xsd, SRA.run.xsd,
+# SRA.submission.xsd and the SRA.common.xsd they include). If set, XML is
+# validated against them before it is tarred
+XML_SCHEMA_DIR = os.environ.get('UPS_XML_SCHEMA_DIR')
+
+# lxml schemas are not safe to validate with from several threads at once
+XML_SCHEMA_LOCK = threading.Lock()
+
 XML_CONTACTS = [
     {'name': 'Cecilia Esteves', 'email': 'cecilia_esteves@hms.harvard.edu'},
     {'name': 'Mark Mangoba', 'email': 'mark_mangoba-agustin@hms.harvard.edu'},
@@ -79,37 +93,35 @@ def create_xml_library(
         raise Exception(error_message) from exc
 
 
-def xml_indent(elem, level=0):
+def xml_to_string(xml):
     """
-    Sets proper indent on xml
+    Properly formats XML as String
     """
-    try:
-        i = "\n" + level*"  "
-        if len(elem):
-            if not elem.text or not elem.text.strip():
-                elem.text = i + "  "
-            if not elem.tail or not elem.tail.strip():
-                elem.tail = i
-            for elem in elem:
-                xml_indent(elem, level + 1)
-            if not elem.tail or not elem.tail.strip():
-                elem.tail = i
-        else:
-            if level and (not elem.tail or not elem.tail.strip()):
-                elem.tail = i
-    except Exception as exc:
-        error_message = "[ERROR] Step 2 - Processing File: Failed to indent XML with error {}".format(exc)
-        write_to_logs(error_message)
-        raise Exception(error_message) from exc
+    return etree.tostring(xml.getroot(), encoding="utf-8", pretty_print=True)
 
 
-def xml_to_string(xml):
+@lru_cache(maxsize=None)
+def load_xml_schema(schema_dir, schema):
     """
-    Properly formats XML as String
+    Parses the SRA schema for schema ("experiment", "run" or "submission")
+    once and returns the validator
+    """
+    return etree.XMLSchema(etree.parse(os.path.join(schema_dir, 'SRA.{}.xsd'.format(schema))))
+
+
+def validate_xml(xml, schema, schema_dir=XML_SCHEMA_DIR):
+    """
+    Raises an exception if xml does not match the SRA schema for schema, or
+    does nothing if there is no schema_dir
     """
-    elem = xml.getroot()
-    xml_indent(elem)
-    return etree.tostring(elem, encoding="utf-8")
+    if schema_dir is None:
+        return
+
+    xml_schema = load_xml_schema(schema_dir, schema)
+
+    with XML_SCHEMA_LOCK:
+        if not xml_schema.validate(xml):
+            raise Exception("{} XML does not match its schema: {}".format(schema, xml_schema.error_log.last_error))
 
 
 def get_title_prefix(sequence_type, dna_source):
@@ -136,82 +148,16 @@ def make_read_length_list(read_lengths):
     return []
 
 
-def format_experiment_xml(library):
+def format_experiment_xml(libraries):
     """
-    Converts libraries into "experiment_set" ElementTree object
+    Converts libraries into "experiment_set" ElementTree object with an
+    EXPERIMENT for each library
     """
     try:
         xml_exp_set = etree.Element("EXPERIMENT_SET")
-        xml_exp = etree.SubElement(xml_exp_set, "EXPERIMENT")
-        xml_e_identifiers = etree.SubElement(xml_exp, "IDENTIFIERS")
-        xml_e_submitter_id = etree.SubElement(xml_e_identifiers, "SUBMITTER_ID")
-        xml_e_submitter_id.set("namespace", library['center'])
-        xml_e_submitter_id.text = library["sample_id"]
-        xml_title = etree.SubElement(xml_exp, "TITLE")
-        xml_title.text = library["title"]
-        xml_study_ref = etree.SubElement(xml_exp, "STUDY_REF")
-        xml_study_ref.set("accession", library["phs_accession"])
-        xml_design = etree.SubElement(xml_exp, "DESIGN")
-        xml_des_desc = etree.SubElement(xml_design, "DESIGN_DESCRIPTION")
-        xml_des_desc.text = library["design_description"]
-        xml_smp_desc = etree.SubElement(xml_design, "SAMPLE_DESCRIPTOR")
-        xml_smp_desc.set("refname", library["sample_id"])
-        xml_smp_desc.set("refcenter", library["phs_accession"])
-        xml_lib_desc = etree.SubElement(xml_design, "LIBRARY_DESCRIPTOR")
-        xml_lib_name = etree.SubElement(xml_lib_desc, "LIBRARY_NAME")
-        xml_lib_name.text = library["sample_id"]
-        xml_lib_strat = etree.SubElement(xml_lib_desc, "LIBRARY_STRATEGY")
-        xml_lib_strat.text = library["strategy"]
-        xml_lib_src = etree.SubElement(xml_lib_desc, "LIBRARY_SOURCE")
-        xml_lib_src.text = library["source"]
-        xml_lib_sel = etree.SubElement(xml_lib_desc, "LIBRARY_SELECTION")
-        xml_lib_sel.text = library["selection"]
-        xml_lib_layout = etree.SubElement(xml_lib_desc, "LIBRARY_LAYOUT")
-        etree.SubElement(xml_lib_layout, library["library_layout"])
-
-        if library["read_lengths"]:
-            xml_spot_desc = etree.SubElement(xml_design, "SPOT_DESCRIPTOR")
-            xml_decode_spec = etree.SubElement(xml_spot_desc, "SPOT_DECODE_SPEC")
-
-            if sum(library["read_lengths"]) > 0:
-                xml_spot_len = etree.SubElement(xml_decode_spec, "SPOT_LENGTH")
-                xml_spot_len.text = str(sum(library["read_lengths"]))
-
-            for i in range(0, len(library["read_lengths"])):
-                xml_read_spec = etree.SubElement(xml_decode_spec, "READ_SPEC")
-                xml_read_index = etree.SubElement(xml_read_spec, "READ_INDEX")
-                xml_read_index.text = str(i)
-                xml_read_class = etree.SubElement(xml_read_spec, "READ_CLASS")
-                xml_read_class.text = "Application Read"
-
-                if i == 0:
-                    xml_read_type = etree.SubElement(xml_read_spec, "READ_TYPE")
-                    xml_read_type.text = "Forward"
-                    xml_base_coord = etree.SubElement(xml_read_spec, "BASE_COORD")
-                    xml_base_coord.text = "1"
-                elif i == 1:
-                    xml_read_type = etree.SubElement(xml_read_spec, "READ_TYPE")
-                    xml_read_type.text = "Reverse"
-                    xml_base_coord = etree.SubElement(xml_read_spec, "BASE_COORD")
-                    xml_base_coord.text = str(library["read_lengths"][i - 1] + 1)
-                else:
-                    sys.exit(5)
-
-        xml_platform = etree.SubElement(xml_exp, "PLATFORM")
-        xml_mftr = etree.SubElement(xml_platform, library["platform"])
-        xml_model = etree.SubElement(xml_mftr, "INSTRUMENT_MODEL")
-        xml_model.text = library["instrument_model"]
-
-        if library["attributes"]:
-            xml_e_attributes = etree.SubElement(xml_exp, "EXPERIMENT_ATTRIBUTES")
-
-            for attribute in library["attributes"]:
-                xml_e_attribute = etree.SubElement(
-                    xml_e_attributes, "EXPERIMENT_ATTRIBUTE")
-                xml_tag = etree.SubElement(xml_e_attribute, "TAG")
-                xml_tag.text = attribute[0]
-                xml_value = etree.SubElement(xml_e_attribute, "VALUE")
-                xml_value.text = attribute[1]
+
+        for library in libraries:
+            add_experiment_xml(xml_exp_set, library)
 
         return etree.ElementTree(xml_exp_set)
     except Exception as exc:
@@ -220,47 +166,126 @@ def format_experiment_xml(library):
         raise Exception(error_message) from exc
 
 
-def format_run_xml(library):
+def add_experiment_xml(xml_exp_set, library):
+    """
+    Adds the EXPERIMENT of a library to xml_exp_set
+    """
+    xml_exp = copy.deepcopy(experiment_template(
+        library['center'], library['phs_accession'], library['design_description'], library['strategy'],
+        library['source'], library['selection'], library['library_layout'], library['platform'],
+        tuple(tuple(attribute) for attribute in library['attributes'])))
+
+    xml_exp.find('IDENTIFIERS/SUBMITTER_ID').text = library["sample_id"]
+    xml_exp.find('TITLE').text = library["title"]
+    xml_exp.find('DESIGN/SAMPLE_DESCRIPTOR').set("refname", library["sample_id"])
+    xml_exp.find('DESIGN/LIBRARY_DESCRIPTOR/LIBRARY_NAME').text = library["sample_id"]
+    xml_exp.find('PLATFORM/*/INSTRUMENT_MODEL').text = library["instrument_model"]
+
+    if library["read_lengths"]:
+        xml_exp.find('DESIGN').append(copy.deepcopy(spot_descriptor_template(tuple(library["read_lengths"]))))
+
+    xml_exp_set.append(xml_exp)
+
+
+@lru_cache(maxsize=None)
+def experiment_template(
+        center, phs_accession, design_description, strategy, source, selection, library_layout, platform, attributes):
+    """
+    Builds an EXPERIMENT with everything that is the same for every library
+    of a sequence type, leaving the sample and instrument to be filled in
+
+    The template is built once for each set of arguments and must be copied
+    before it is changed.
+    """
+    xml_exp = etree.Element("EXPERIMENT")
+    xml_e_identifiers = etree.SubElement(xml_exp, "IDENTIFIERS")
+    xml_e_submitter_id = etree.SubElement(xml_e_identifiers, "SUBMITTER_ID")
+    xml_e_submitter_id.set("namespace", center)
+    etree.SubElement(xml_exp, "TITLE")
+    xml_study_ref = etree.SubElement(xml_exp, "STUDY_REF")
+    xml_study_ref.set("accession", phs_accession)
+    xml_design = etree.SubElement(xml_exp, "DESIGN")
+    xml_des_desc = etree.SubElement(xml_design, "DESIGN_DESCRIPTION")
+    xml_des_desc.text = design_description
+    xml_smp_desc = etree.SubElement(xml_design, "SAMPLE_DESCRIPTOR")
+    xml_smp_desc.set("refname", "")
+    xml_smp_desc.set("refcenter", phs_accession)
+    xml_lib_desc = etree.SubElement(xml_design, "LIBRARY_DESCRIPTOR")
+    etree.SubElement(xml_lib_desc, "LIBRARY_NAME")
+    xml_lib_strat = etree.SubElement(xml_lib_desc, "LIBRARY_STRATEGY")
+    xml_lib_strat.text = strategy
+    xml_lib_src = etree.SubElement(xml_lib_desc, "LIBRARY_SOURCE")
+    xml_lib_src.text = source
+    xml_lib_sel = etree.SubElement(xml_lib_desc, "LIBRARY_SELECTION")
+    xml_lib_sel.text = selection
+    xml_lib_layout = etree.SubElement(xml_lib_desc, "LIBRARY_LAYOUT")
+    etree.SubElement(xml_lib_layout, library_layout)
+
+    xml_platform = etree.SubElement(xml_exp, "PLATFORM")
+    xml_mftr = etree.SubElement(xml_platform, platform)
+    etree.SubElement(xml_mftr, "INSTRUMENT_MODEL")
+
+    if attributes:
+        xml_e_attributes = etree.SubElement(xml_exp, "EXPERIMENT_ATTRIBUTES")
+
+        for attribute in attributes:
+            xml_e_attribute = etree.SubElement(
+                xml_e_attributes, "EXPERIMENT_ATTRIBUTE")
+            xml_tag = etree.SubElement(xml_e_attribute, "TAG")
+            xml_tag.text = attribute[0]
+            xml_value = etree.SubElement(xml_e_attribute, "VALUE")
+            xml_value.text = attribute[1]
+
+    return xml_exp
+
+
+@lru_cache(maxsize=None)
+def spot_descriptor_template(read_lengths):
+    """
+    Builds the SPOT_DESCRIPTOR for a tuple of read lengths, once for each
+    tuple. It must be copied before it is changed.
+    """
+    xml_spot_desc = etree.Element("SPOT_DESCRIPTOR")
+    xml_decode_spec = etree.SubElement(xml_spot_desc, "SPOT_DECODE_SPEC")
+
+    if sum(read_lengths) > 0:
+        xml_spot_len = etree.SubElement(xml_decode_spec, "SPOT_LENGTH")
+        xml_spot_len.text = str(sum(read_lengths))
+
+    for i in range(0, len(read_lengths)):
+        xml_read_spec = etree.SubElement(xml_decode_spec, "READ_SPEC")
+        xml_read_index = etree.SubElement(xml_read_spec, "READ_INDEX")
+        xml_read_index.text = str(i)
+        xml_read_class = etree.SubElement(xml_read_spec, "READ_CLASS")
+        xml_read_class.text = "Application Read"
+
+        if i == 0:
+            xml_read_type = etree.SubElement(xml_read_spec, "READ_TYPE")
+            xml_read_type.text = "Forward"
+            xml_base_coord = etree.SubElement(xml_read_spec, "BASE_COORD")
+            xml_base_coord.text = "1"
+        elif i == 1:
+            xml_read_type = etree.SubElement(xml_read_spec, "READ_TYPE")
+            xml_read_type.text = "Reverse"
+            xml_base_coord = etree.SubElement(xml_read_spec, "BASE_COORD")
+            xml_base_coord.text = str(read_lengths[i - 1] + 1)
+        else:
+            raise Exception("Step 2 - Processing File: Only paired reads are supported, got {} read lengths".format(
+                len(read_lengths)))
+
+    return xml_spot_desc
+
+
+def format_run_xml(libraries):
     """
-    Converts libraries into "run_set" ElementTree object
+    Converts libraries into "run_set" ElementTree object with a RUN for each
+    library
     """
     try:
         xml_run_set = etree.Element("RUN_SET")
-        xml_run = etree.SubElement(xml_run_set, "RUN")
-        xml_r_identifiers = etree.SubElement(xml_run, "IDENTIFIERS")
-        xml_r_submitter_id = etree.SubElement(xml_r_identifiers, "SUBMITTER_ID")
-        xml_r_submitter_id.set("namespace", library['center'])
-        xml_r_submitter_id.text = library["filename"]
-        xml_experiment_ref = etree.SubElement(xml_run, "EXPERIMENT_REF")
-        xml_e_identifiers = etree.SubElement(xml_experiment_ref, "IDENTIFIERS")
-        xml_e_submitter_id = etree.SubElement(xml_e_identifiers, "SUBMITTER_ID")
-        xml_e_submitter_id.set("namespace", library['center'])
-        xml_e_submitter_id.text = library["sample_id"]
-        xml_data_block = etree.SubElement(xml_run, "DATA_BLOCK")
-        xml_files = etree.SubElement(xml_data_block, "FILES")
-        xml_file = etree.SubElement(xml_files, "FILE")
-
-        xml_file.set("checksum", library['md5_checksum'])
-        xml_file.set("checksum_method", "MD5")
-        xml_file.set("filename", library['upload_file_name'])
-        xml_file.set("filetype", 'bam')
-
-        if library["reference"] is not None or library["latf_load"]:
-            xml_r_attributes = etree.SubElement(xml_run, "RUN_ATTRIBUTES")
-
-            if library["reference"] is not None:
-                xml_r_attribute = etree.SubElement(xml_r_attributes, "RUN_ATTRIBUTE")
-                xml_tag = etree.SubElement(xml_r_attribute, "TAG")
-                xml_tag.text = "assembly"
-                xml_value = etree.SubElement(xml_r_attribute, "VALUE")
-                xml_value.text = library["reference"]
-
-            if library["latf_load"]:
-                xml_r_attribute = etree.SubElement(xml_r_attributes, "RUN_ATTRIBUTE")
-                xml_tag = etree.SubElement(xml_r_attribute, "TAG")
-                xml_tag.text = "loader"
-                xml_value = etree.SubElement(xml_r_attribute, "VALUE")
-                xml_value.text = "latf-load"
+
+        for library in libraries:
+            add_run_xml(xml_run_set, library)
 
         return etree.ElementTree(xml_run_set)
     except Exception as exc:
@@ -269,64 +294,153 @@ def format_run_xml(library):
         raise Exception(error_message) from exc
 
 
-def format_submission_xml(library):
+def add_run_xml(xml_run_set, library):
     """
-    Converts a library into a "submission" ElementTree object
+    Adds the RUN of a library to xml_run_set
     """
-    try:
-        alias = '{}.{}'.format(library['phs_accession'], library['phs_accession_version'])
-        namespace_map = {'xsi': 'http://www.w3.org/2001/XMLSchema-instance'}
-        qname = etree.QName('http://www.w3.org/2001/XMLSchema-instance', 'noNamespaceSchemaLocation')
+    xml_run = copy.deepcopy(run_template(library['center'], library["reference"], library["latf_load"]))
+
+    xml_run.find('IDENTIFIERS/SUBMITTER_ID').text = library["filename"]
+    xml_run.find('EXPERIMENT_REF/IDENTIFIERS/SUBMITTER_ID').text = library["sample_id"]
+    xml_file = xml_run.find('DATA_BLOCK/FILES/FILE')
+    xml_file.set("checksum", library['md5_checksum'])
+    xml_file.set("filename", library['upload_file_name'])
 
-        xml_submission = etree.Element(
-            "SUBMISSION", {qname: 'http://www.ncbi.nlm.nih.gov/viewvc/v1/trunk/sra/doc/SRA/SRA.submission.xsd?view=co'},
-            nsmap=namespace_map)
-        xml_submission.set('alias', alias)
-        xml_submission.set('center_name', library['center'])
+    xml_run_set.append(xml_run)
 
-        xml_contacts = etree.SubElement(xml_submission, "CONTACTS")
 
-        for contact in XML_CONTACTS:
-            xml_contact = etree.SubElement(xml_contacts, "CONTACT")
-            xml_contact.set('name', contact['name'])
-            xml_contact.set('inform_on_error', contact['email'])
-            xml_contact.set('inform_on_status', contact['email'])
+@lru_cache(maxsize=None)
+def run_template(center, reference, latf_load):
+    """
+    Builds a RUN with everything that is the same for every BAM aligned to
+    reference, leaving the file and sample to be filled in
 
-        xml_actions = etree.SubElement(xml_submission, 'ACTIONS')
+    The template is built once for each set of arguments and must be copied
+    before it is changed.
+    """
+    xml_run = etree.Element("RUN")
+    xml_r_identifiers = etree.SubElement(xml_run, "IDENTIFIERS")
+    xml_r_submitter_id = etree.SubElement(xml_r_identifiers, "SUBMITTER_ID")
+    xml_r_submitter_id.set("namespace", center)
+    xml_experiment_ref = etree.SubElement(xml_run, "EXPERIMENT_REF")
+    xml_e_identifiers = etree.SubElement(xml_experiment_ref, "IDENTIFIERS")
+    xml_e_submitter_id = etree.SubElement(xml_e_identifiers, "SUBMITTER_ID")
+    xml_e_submitter_id.set("namespace", center)
+    xml_data_block = etree.SubElement(xml_run, "DATA_BLOCK")
+    xml_files = etree.SubElement(xml_data_block, "FILES")
+    xml_file = etree.SubElement(xml_files, "FILE")
+
+    # set in this order so the attributes filled in later keep their place
+    xml_file.set("checksum", "")
+    xml_file.set("checksum_method", "MD5")
+    xml_file.set("filename", "")
+    xml_file.set("filetype", 'bam')
+
+    if reference is not None or latf_load:
+        xml_r_attributes = etree.SubElement(xml_run, "RUN_ATTRIBUTES")
+
+        if reference is not None:
+            xml_r_attribute = etree.SubElement(xml_r_attributes, "RUN_ATTRIBUTE")
+            xml_tag = etree.SubElement(xml_r_attribute, "TAG")
+            xml_tag.text = "assembly"
+            xml_value = etree.SubElement(xml_r_attribute, "VALUE")
+            xml_value.text = reference
+
+        if latf_load:
+            xml_r_attribute = etree.SubElement(xml_r_attributes, "RUN_ATTRIBUTE")
+            xml_tag = etree.SubElement(xml_r_attribute, "TAG")
+            xml_tag.text = "loader"
+            xml_value = etree.SubElement(xml_r_attribute, "VALUE")
+            xml_value.text = "latf-load"
+
+    return xml_run
 
-        for action in XML_ACTIONS:
-            xml_action = etree.SubElement(xml_actions, 'ACTION')
-            xml_action_add = etree.SubElement(xml_action, 'ADD')
-            xml_action_add.set('source', action['source'])
-            xml_action_add.set('schema', action['schema'])
 
-        return etree.ElementTree(xml_submission)
+def format_submission_xml(library):
+    """
+    Converts a library into a "submission" ElementTree object
+    """
+    try:
+        return etree.ElementTree(copy.deepcopy(submission_template(
+            library['phs_accession'], library['phs_accession_version'], library['center'])))
     except Exception as exc:
         error_message = "[ERROR] Step 2 - Processing File: Failed to format submission XML with error {}".format(exc)
         write_to_logs(error_message)
         raise Exception(error_message) from exc
 
 
+@lru_cache(maxsize=None)
+def submission_template(phs_accession, phs_accession_version, center):
+    """
+    Builds the SUBMISSION, which is the same for every submission to a study
+    version, once. It must be copied before it is changed.
+    """
+    alias = '{}.{}'.format(phs_accession, phs_accession_version)
+    namespace_map = {'xsi': 'http://www.w3.org/2001/XMLSchema-instance'}
+    qname = etree.QName('http://www.w3.org/2001/XMLSchema-instance', 'noNamespaceSchemaLocation')
+
+    xml_submission = etree.Element(
+        "SUBMISSION", {qname: 'http://www.ncbi.nlm.nih.gov/viewvc/v1/trunk/sra/doc/SRA/SRA.submission.xsd?view=co'},
+        nsmap=namespace_map)
+    xml_submission.set('alias', alias)
+    xml_submission.set('center_name', center)
+
+    xml_contacts = etree.SubElement(xml_submission, "CONTACTS")
+
+    for contact in XML_CONTACTS:
+        xml_contact = etree.SubElement(xml_contacts, "CONTACT")
+        xml_contact.set('name', contact['name'])
+        xml_contact.set('inform_on_error', contact['email'])
+        xml_contact.set('inform_on_status', contact['email'])
+
+    xml_actions = etree.SubElement(xml_submission, 'ACTIONS')
+
+    for action in XML_ACTIONS:
+        xml_action = etree.SubElement(xml_actions, 'ACTION')
+        xml_action_add = etree.SubElement(xml_action, 'ADD')
+        xml_action_add.set('source', action['source'])
+        xml_action_add.set('schema', action['schema'])
+
+    return xml_submission
+
+
 def create_and_tar_xml(
     dna_source, fileservice_uuid, instrument_model, md5_checksum, read_lengths, reference_genome, sample_id, secret,
-        sequence_type, upload_file_name, logger):
+        sequence_type, upload_file_name, logger, workspace):
     """
-    Creates the XML files for the BAM file and
+    Creates the XML files for the BAM file and tars them in the workspace
     """
     write_to_logs("Step 2 - Processing File: Creating XML for {}".format(upload_file_name))
 
-    temp_experiment_file = '/scratch/experiment.xml'
-    temp_run_file = "/scratch/run.xml"
-    temp_submission_file = '/scratch/submission.xml'
+    library = create_xml_library(
+        dna_source, fileservice_uuid, instrument_model, md5_checksum, read_lengths, reference_genome, sample_id,
+        secret, sequence_type, upload_file_name)
+
+    return create_and_tar_batch_xml([library], upload_file_name, logger, workspace)
+
+
+def create_and_tar_batch_xml(libraries, tar_name, logger, workspace):
+    """
+    Creates one experiment.xml and run.xml describing all the libraries and a
+    single submission.xml adding them, and tars them in the workspace as
+    tar_name.tar
+    """
+    temp_experiment_file = workspace.path('experiment.xml')
+    temp_run_file = workspace.path('run.xml')
+    temp_submission_file = workspace.path('submission.xml')
 
     try:
-        library = create_xml_library(
-            dna_source, fileservice_uuid, instrument_model, md5_checksum, read_lengths, reference_genome, sample_id,
-            secret, sequence_type, upload_file_name)
+        experiment_tree = format_experiment_xml(libraries)
+        run_tree = format_run_xml(libraries)
+        submission_tree = format_submission_xml(libraries[0])
 
-        experiment_xml = xml_to_string(format_experiment_xml(library))
-        run_xml = xml_to_string(format_run_xml(library))
-        submission_xml = xml_to_string(format_submission_xml(library))
+        validate_xml(experiment_tree, 'experiment')
+        validate_xml(run_tree, 'run')
+        validate_xml(submission_tree, 'submission')
+
+        experiment_xml = xml_to_string(experiment_tree)
+        run_xml = xml_to_string(run_tree)
+        submission_xml = xml_to_string(submission_tree)
 
         with codecs.open(temp_experiment_file, "w", "utf-8") as experiment_file_handle:
             experiment_file_handle.write(codecs.decode(experiment_xml, "utf-8"))
@@ -339,11 +453,12 @@ def create_and_tar_xml(
 
     except Exception as exc:
         error_message = "[ERROR] Step 2 - Processing File: Failed creation of XML files for {} with error {}".format(
-            upload_file_name, exc)
+            tar_name, exc)
         write_to_logs(error_message, logger)
         raise Exception(error_message) from exc
 
-    xml_files_to_tar = ['/scratch/experiment.xml', '/scratch/run.xml', '/scratch/submission.xml']
-    tar_file_name = tar_and_remove_files(upload_file_name, '/scratch', xml_files_to_tar, logger)
+    xml_files_to_tar = [temp_experiment_file, temp_run_file, temp_submission_file]
+    tar_file_name = tar_and_remove_files(
+        tar_name, workspace.directory, xml_files_to_tar, logger, arcname_dir=ARCNAME_DIR)
 
-    return tar_file_name
\ No newline at end of file
+    return tar_file_name
@@ -0,0 +1,113 @@
+"""
+Tests for the admission control
+"""
+import threading
+import time
+from collections import namedtuple
+from unittest import TestCase
+from unittest.mock import patch
+from src.admission import FOOTPRINT_OVERHEAD_BYTES, DiskBudget, ScratchSpaceError, estimate_scratch_footprint
+
+DiskUsage = namedtuple('DiskUsage', ['total', 'used', 'free'])
+
+
+class TestAdmission(TestCase):
+    """
+    Tests for the admission control
+    """
+    def setUp(self):
+        patcher = patch('src.admission.shutil.disk_usage', return_value=DiskUsage(1000, 0, 1000))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_estimate_scratch_footprint(self):
+        """
+        Test that a downloaded BAM needs room for two copies and a streamed one for one
+        """
+        self.assertEqual(estimate_scratch_footprint('BAM', 100), 200 + FOOTPRINT_OVERHEAD_BYTES)
+        self.assertEqual(estimate_scratch_footprint('BAM', 100, streaming=True), 100 + FOOTPRINT_OVERHEAD_BYTES)
+
+    def test_reserve_waits_for_release(self):
+        """
+        Test that a reservation that does not fit waits until another is released
+        """
+        budget = DiskBudget('/scratch', budget_bytes=500, reserve_bytes=0)
+        budget.reserve(400, 'first.bam')
+        reserved = threading.Event()
+
+        def reserve_second():
+            budget.reserve(300, 'second.bam')
+            reserved.set()
+
+        threading.Thread(target=reserve_second, daemon=True).start()
+        time.sleep(0.1)
+        self.assertFalse(reserved.is_set())
+
+        budget.release(400, 'first.bam')
+        self.assertTrue(reserved.wait(5))
+        self.assertEqual(budget.reserved, 300)
+
+    def test_reserve_rejects_files_that_never_fit(self):
+        """
+        Test that:
+            * a file larger than the budget is rejected instead of waiting forever
+            * a file that fits the budget waits for free space even with nothing else reserved
+        """
+        budget = DiskBudget('/scratch', budget_bytes=5000, reserve_bytes=100)
+
+        with self.assertRaises(ScratchSpaceError):
+            budget.reserve(6000, 'huge.bam')
+
+        self.assertEqual(budget.reserved, 0)
+
+        with patch('src.admission.ADMISSION_POLL_INTERVAL', 0.05):
+            reserved = threading.Event()
+
+            def reserve_large():
+                budget.reserve(950, 'large.bam')
+                reserved.set()
+
+            threading.Thread(target=reserve_large, daemon=True).start()
+            self.assertFalse(reserved.wait(0.2))
+
+            with patch('src.admission.shutil.disk_usage', return_value=DiskUsage(2000, 0, 2000)):
+                self.assertTrue(reserved.wait(5))
+
+        self.assertEqual(budget.reserved, 950)
+
+    def test_reserve_evicts_under_pressure(self):
+        """
+        Test that a reservation that does not fit asks the evict functions for
+        what it is short by, and goes ahead once they free it
+        """
+        used = [400]
+        requests = []
+
+        def evict(needed_bytes):
+            requests.append(needed_bytes)
+            used[0] -= needed_bytes
+
+        budget = DiskBudget('/scratch', budget_bytes=500, reserve_bytes=0, usage_functions=[lambda: used[0]],
+                            evict_functions=[evict])
+
+        budget.reserve(50, 'small.bam')
+        budget.reserve(200, 'large.bam')
+
+        self.assertEqual(requests, [150])
+        self.assertEqual((budget.reserved, used[0]), (250, 250))
+
+    def test_usage_counts_against_budget(self):
+        """
+        Test that space used by the cache and archives counts against the
+        budget, and is added back to a budget taken from the free space
+        """
+        used = [300]
+        budget = DiskBudget('/scratch', budget_bytes=500, reserve_bytes=0, usage_functions=[lambda: used[0]])
+
+        budget.reserve(200, 'first.bam')
+
+        self.assertFalse(budget.fits(100))
+        used[0] = 200
+        self.assertTrue(budget.fits(100))
+
+        self.assertEqual(DiskBudget('/scratch', reserve_bytes=100, usage_functions=[lambda: 300]).budget_bytes, 1200)
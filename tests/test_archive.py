@@ -1,11 +1,15 @@
 """
 Tests for the Archive functions
 """
+import errno
+import os
 from os.path import exists
 import tarfile
+import tempfile
+import threading
 from unittest import TestCase
 from unittest.mock import patch
-from src.archive import tar_and_remove_files
+from src.archive import RollingArchiveWriter, TarWriter, tar_and_remove_files
 from src.utilities import silent_remove
 
 
@@ -49,3 +53,239 @@ class TestArchive(TestCase):
 
         self.assertTrue(exists('./testfile1.txt'))
         self.assertTrue(exists('./testfile2.txt'))
+
+    @patch('src.utilities.write_to_logs')
+    def test_rolling_archive_writer(self, _):
+        """
+        Test that:
+            * files are stored under arcname_dir and removed
+            * a full archive is rolled over and handed to on_rollover
+            * the next file starts a new archive
+            * an archive that is not full can be rolled over and uploaded in
+              the background
+            * disk usage covers the open archive and rolled over ones
+            * an archive whose upload failed is uploaded again with the next one
+        """
+        rolled_over = []
+        uploaded = threading.Event()
+        failures = [Exception('upload failed')]
+
+        def on_rollover(archive_file):
+            rolled_over.append(archive_file)
+            uploaded.set()
+
+            # the first upload fails, and every later one removes its archive
+            if failures:
+                raise failures.pop()
+
+            os.remove(archive_file)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = RollingArchiveWriter(temp_dir, 'vcf_archive', 4096, on_rollover, arcname_dir='scratch')
+            file_names = []
+
+            for index in range(3):
+                file_names.append(os.path.join(temp_dir, 'sample{}.vcf.gz'.format(index)))
+
+                with open(file_names[-1], 'wb') as vcf_file:
+                    vcf_file.write(b'x' * 2000)
+
+            writer.add(file_names[:2])
+            self.assertTrue(uploaded.wait(5))
+            self.assertFalse(exists(writer.path))
+
+            writer.add(file_names[2:])
+            self.assertLess(writer.size, 4096)
+            self.assertFalse(any(exists(name) for name in file_names))
+            self.assertEqual(writer.disk_usage(), writer.size + os.path.getsize(rolled_over[0]))
+
+            with tarfile.open(rolled_over[0]) as archive:
+                self.assertEqual(archive.getnames(), ['scratch/sample0.vcf.gz', 'scratch/sample1.vcf.gz'])
+
+            writer.roll_over_in_background().result(5)
+
+            self.assertEqual(rolled_over[1], rolled_over[0])
+            self.assertEqual(writer.rolled_over_archives(), [])
+            self.assertEqual(writer.disk_usage(), 0)
+            self.assertIsNone(writer.roll_over_in_background())
+            self.assertIsNone(writer.roll_over())
+            self.assertEqual(len(rolled_over), 3)
+
+    def write_sample_files(self, directory):
+        """
+        Returns the paths of files of awkward sizes in directory
+        """
+        file_names = []
+
+        for size in (0, 1, 511, 512, 513, 3 * 2**20 + 7):
+            file_names.append(os.path.join(directory, 'sample_{}.vcf.gz'.format(size)))
+
+            with open(file_names[-1], 'wb') as sample_file:
+                sample_file.write(os.urandom(size))
+
+        return file_names
+
+    def assert_tar_contents(self, tar_file_name, file_names):
+        """
+        Asserts that the tar holds exactly file_names under their base names
+        """
+        with tarfile.open(tar_file_name) as archive:
+            self.assertEqual(archive.getnames(), [os.path.basename(name) for name in file_names])
+
+            for name in file_names:
+                with open(name, 'rb') as original:
+                    self.assertEqual(archive.extractfile(os.path.basename(name)).read(), original.read())
+
+    def test_tar_writer(self):
+        """
+        Test that:
+            * the tar matches the files, whatever their size
+            * an existing tar is appended to
+            * the offset is where the next member goes
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_names = self.write_sample_files(temp_dir)
+            tar_file_name = os.path.join(temp_dir, 'test.tar')
+
+            with TarWriter(tar_file_name) as tar:
+                for name in file_names[:3]:
+                    tar.add(name, arcname=os.path.basename(name))
+
+            with TarWriter(tar_file_name) as tar:
+                for name in file_names[3:]:
+                    tar.add(name, arcname=os.path.basename(name))
+
+                offset = tar.offset
+
+            self.assert_tar_contents(tar_file_name, file_names)
+            self.assertEqual(os.path.getsize(tar_file_name) % tarfile.RECORDSIZE, 0)
+
+            with tarfile.open(tar_file_name) as archive:
+                archive.getmembers()
+                self.assertEqual(archive.offset, offset)
+
+    def test_tar_writer_fallback(self):
+        """
+        Test that files are copied through user space when the kernel cannot
+        copy them
+        """
+        def unsupported(*_):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_names = self.write_sample_files(temp_dir)
+            tar_file_name = os.path.join(temp_dir, 'test.tar')
+
+            with patch('os.copy_file_range', unsupported), patch('os.sendfile', unsupported):
+                with TarWriter(tar_file_name) as tar:
+                    for name in file_names:
+                        tar.add(name, arcname=os.path.basename(name))
+
+            self.assert_tar_contents(tar_file_name, file_names)
+
+    def test_tar_writer_failed_add(self):
+        """
+        Test that a file that fails part way through is cut off and the next
+        file is written where it started
+        """
+        def fail_part_way(source_fd, destination_fd, size):
+            os.write(destination_fd, b'x' * 100)
+            raise OSError(errno.EIO, 'Input/output error')
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_names = self.write_sample_files(temp_dir)
+            tar_file_name = os.path.join(temp_dir, 'test.tar')
+
+            with TarWriter(tar_file_name) as tar:
+                tar.add(file_names[1], arcname=os.path.basename(file_names[1]))
+                offset = tar.offset
+
+                with patch('src.archive.copy_file_payload', fail_part_way), self.assertRaises(OSError):
+                    tar.add(file_names[2], arcname=os.path.basename(file_names[2]))
+
+                self.assertEqual(tar.offset, offset)
+                self.assertEqual(os.path.getsize(tar_file_name), offset)
+                tar.add(file_names[3], arcname=os.path.basename(file_names[3]))
+
+            self.assert_tar_contents(tar_file_name, [file_names[1], file_names[3]])
+
+    @patch('src.utilities.write_to_logs')
+    def test_rolling_archive_writer_threads(self, _):
+        """
+        Test that workers adding at the same time never add to a full
+        archive, each archive is rolled over once, and every file ends up in
+        exactly one archive
+        """
+        rolled_over = []
+        names = []
+        member_counts = []
+
+        def on_rollover(archive_file):
+            rolled_over.append(archive_file)
+
+            with tarfile.open(archive_file) as archive:
+                names.extend(archive.getnames())
+                member_counts.append(len(archive.getnames()))
+
+            os.remove(archive_file)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = RollingArchiveWriter(temp_dir, 'vcf_archive', 4096, on_rollover)
+            file_names = []
+
+            for index in range(40):
+                file_names.append(os.path.join(temp_dir, 'sample{}.vcf.gz'.format(index)))
+
+                with open(file_names[-1], 'wb') as vcf_file:
+                    vcf_file.write(b'x' * 1500)
+
+            def add_pairs(names):
+                for index in range(0, len(names), 2):
+                    writer.add(names[index:index + 2])
+
+            threads = [threading.Thread(target=add_pairs, args=(file_names[index::4],)) for index in range(4)]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            writer.roll_over_in_background()
+            writer.executor.shutdown()
+
+            # each pair of files fills an archive
+            self.assertLessEqual(max(member_counts), 2)
+            self.assertEqual(sorted(names), sorted(name.lstrip('/') for name in file_names))
+            self.assertEqual(len(rolled_over), len(set(rolled_over)))
+
+    @patch('src.utilities.write_to_logs')
+    def test_tar_writer_lock(self, _):
+        """
+        Test that:
+            * a tar open in one writer cannot be opened by another without waiting
+            * an archive left by another writer is closed and renamed once it is free
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_names = self.write_sample_files(temp_dir)
+            tar_file_name = os.path.join(temp_dir, 'vcf_archive_other.tar')
+            writer = RollingArchiveWriter(temp_dir, 'vcf_archive_this', 2**20)
+
+            with TarWriter(tar_file_name) as tar:
+                tar.add(file_names[0], arcname='first')
+
+                with self.assertRaises(BlockingIOError):
+                    TarWriter(tar_file_name, wait=False)
+
+                with self.assertRaises(BlockingIOError):
+                    writer.adopt(tar_file_name)
+
+                tar.add(file_names[1], arcname='second')
+
+            adopted = writer.adopt(tar_file_name)
+
+            self.assertFalse(exists(tar_file_name))
+            self.assertEqual(writer.rolled_over_archives(), [adopted])
+
+            with tarfile.open(adopted) as archive:
+                self.assertEqual(archive.getnames(), ['first', 'second'])
@@ -0,0 +1,254 @@
+"""
+Tests for the Aspera functions
+"""
+import asyncio
+import os
+import stat
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import CancelledError, Future
+from unittest import TestCase
+from unittest.mock import patch
+from src import vcfs
+from src.aspera import TRANSFER_MANAGER, AsperaTransferManager, gather, parse_progress
+
+# stands in for ascp: reports progress like ascp does, records when it ran,
+# its pid and its Aspera password, fails for files named fail.* and hangs for
+# files named slow.*
+FAKE_ASCP = '''#!{python}
+import os, sys, time
+file_name = sys.argv[-2]
+log = open(os.path.join(os.path.dirname(file_name), 'calls.log'), 'a')
+log.write('start {{}} {{}} {{}}\\n'.format(time.monotonic(), os.path.basename(file_name), ' '.join(sys.argv[1:])))
+log.flush()
+open(file_name + '.pass', 'w').write(os.environ.get('ASPERA_SCP_FILEPASS', ''))
+open(file_name + '.pid.tmp', 'w').write(str(os.getpid()))
+os.rename(file_name + '.pid.tmp', file_name + '.pid')
+if os.path.basename(file_name).startswith('slow'):
+    time.sleep(30)
+for percent in (10, 55, 100):
+    sys.stdout.write('{{}}    {{}}%  {{}}MB  800Mb/s    00:0{{}} ETA\\r'.format(
+        os.path.basename(file_name), percent, percent, 3 - percent // 50))
+    sys.stdout.flush()
+    time.sleep(0.1)
+if os.path.basename(file_name).startswith('fail'):
+    print('\\nSession Stop  (Error: Server aborted session)')
+    sys.exit(1)
+print('\\nCompleted: 100K bytes transferred in 1 seconds')
+log.write('end {{}} {{}}\\n'.format(time.monotonic(), os.path.basename(file_name)))
+'''
+
+
+class TestAspera(TestCase):
+    """
+    Tests for the Aspera functions
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.ascp = os.path.join(self.temp_dir.name, 'ascp')
+
+        with open(self.ascp, 'w') as ascp:
+            ascp.write(FAKE_ASCP.format(python=sys.executable))
+
+        os.chmod(self.ascp, os.stat(self.ascp).st_mode | stat.S_IEXEC)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def make_file(self, name):
+        """
+        Returns the path of a new file to upload
+        """
+        path = os.path.join(self.temp_dir.name, name)
+
+        with open(path, 'wb') as new_file:
+            new_file.write(b'x' * 100)
+
+        return path
+
+    def read_calls(self):
+        """
+        Returns the lines the fake ascp logged
+        """
+        with open(os.path.join(self.temp_dir.name, 'calls.log')) as calls:
+            return [line.split() for line in calls]
+
+    def test_parse_progress(self):
+        """
+        Test that progress lines are parsed and other output is ignored
+        """
+        self.assertEqual(parse_progress(b'participant.bam   45%  450MB  1.2Gb/s  00:12 ETA'),
+                         {'percent': 45, 'transferred': '450MB', 'rate_mbps': 1200.0, 'eta': '00:12'})
+        self.assertIsNone(parse_progress(b'Completed: 100K bytes transferred in 1 seconds'))
+
+    def test_upload_files(self):
+        """
+        Test that:
+            * files upload in concurrent sessions
+            * each session gets an equal share of the bandwidth
+            * the last progress line of each file is returned
+        """
+        manager = AsperaTransferManager(self.ascp, bandwidth_mbps=5000, max_sessions=2)
+        file_names = [self.make_file('uuid.bam'), self.make_file('uuid.bam.tar')]
+
+        results = manager.upload_files(file_names, 'user@host:code', '/aspera/aspera.pk', ['-Q']).result(timeout=30)
+
+        self.assertEqual([result['percent'] for result in results], [100, 100])
+
+        calls = self.read_calls()
+        starts = [float(call[1]) for call in calls if call[0] == 'start']
+        ends = [float(call[1]) for call in calls if call[0] == 'end']
+
+        self.assertLess(max(starts), min(ends))
+        self.assertIn('-l 2500m', ' '.join(calls[0]))
+
+    def test_password_passed_to_session(self):
+        """
+        Test that the password reaches each ascp session, on a thread or on
+        the loop, without being set in this process's environment
+        """
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        try:
+            manager = AsperaTransferManager(self.ascp, max_sessions=2)
+
+            for (name, password, manager.loop) in (('thread.bam', 'secret1', None), ('loop.bam', 'secret2', loop)):
+                file_name = self.make_file(name)
+                manager.upload_files([file_name], 'user@host:code', '/aspera/aspera.pk', password=password).result(
+                    timeout=30)
+
+                with open(file_name + '.pass') as password_file:
+                    self.assertEqual(password_file.read(), password)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+        self.assertNotIn('ASPERA_SCP_FILEPASS', os.environ)
+
+    def test_failed_upload(self):
+        """
+        Test that a failing session fails the upload with ascp's output
+        """
+        manager = AsperaTransferManager(self.ascp, max_sessions=2)
+        upload = manager.upload_files(
+            [self.make_file('uuid.bam'), self.make_file('fail.tar')], 'user@host:code', '/aspera/aspera.pk')
+
+        with self.assertRaisesRegex(Exception, 'Server aborted session'):
+            upload.result(timeout=30)
+
+    def test_upload_files_on_loop(self):
+        """
+        Test that sessions run as subprocesses of the event loop, at the same
+        time, when the manager has a loop
+        """
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        try:
+            manager = AsperaTransferManager(self.ascp, max_sessions=2)
+            manager.loop = loop
+            file_names = [self.make_file('uuid.bam'), self.make_file('uuid.bam.tar')]
+
+            results = manager.upload_files(file_names, 'user@host:code', '/aspera/aspera.pk').result(timeout=30)
+
+            self.assertEqual([result['percent'] for result in results], [100, 100])
+
+            calls = self.read_calls()
+            self.assertLess(max(float(call[1]) for call in calls if call[0] == 'start'),
+                            min(float(call[1]) for call in calls if call[0] == 'end'))
+
+            with self.assertRaisesRegex(Exception, 'Server aborted session'):
+                manager.upload_files([self.make_file('fail.tar')], 'user@host:code', '/aspera/aspera.pk').result(
+                    timeout=30)
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+    def test_cancelled_upload_on_loop(self):
+        """
+        Test that cancelling an upload on the loop kills its ascp session
+        """
+        file_name = self.make_file('slow.bam')
+
+        async def run():
+            manager = AsperaTransferManager(self.ascp)
+            upload = asyncio.ensure_future(manager.run_async(file_name, 'user@host:code', '/aspera/aspera.pk'))
+
+            while not os.path.exists(file_name + '.pid'):
+                await asyncio.sleep(0.05)
+
+            upload.cancel()
+
+            with self.assertRaises(asyncio.CancelledError):
+                await upload
+
+        start_time = time.monotonic()
+        asyncio.run(run())
+
+        self.assertLess(time.monotonic() - start_time, 20)
+
+        with open(file_name + '.pid') as pid_file:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(int(pid_file.read()), 0)
+
+    def test_gather(self):
+        """
+        Test that:
+            * the combined future has every result, or the first exception
+            * it completes as cancelled when any session was cancelled
+        """
+        futures = [Future(), Future()]
+        combined = gather(futures)
+        futures[1].set_result(2)
+        futures[0].set_result(1)
+        self.assertEqual(combined.result(timeout=1), [1, 2])
+
+        futures = [Future(), Future()]
+        combined = gather(futures)
+        futures[0].set_result(1)
+        futures[1].set_exception(ValueError('failed'))
+        self.assertIsInstance(combined.exception(timeout=1), ValueError)
+
+        futures = [Future(), Future()]
+        combined = gather(futures)
+        futures[0].set_result(1)
+        futures[1].cancel()
+        self.assertTrue(combined.done())
+
+        with self.assertRaises(CancelledError):
+            combined.result(timeout=1)
+
+    @patch('src.vcfs.write_to_logs')
+    @patch('src.aspera.write_to_logs')
+    def test_vcf_archive_upload_uses_shared_manager(self, *_):
+        """
+        Test that a VCF archive uploaded from the archive's own thread goes
+        through the shared manager and runs on the loop set on it
+        """
+        self.assertIs(vcfs.TRANSFER_MANAGER, TRANSFER_MANAGER)
+
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        try:
+            with patch.object(TRANSFER_MANAGER, 'ascp_path', self.ascp), patch.object(TRANSFER_MANAGER, 'loop', loop), \
+                    patch.object(TRANSFER_MANAGER, 'run', side_effect=AssertionError('ran outside the loop')):
+                archive_file = self.make_file('vcf_archive_1.tar')
+                uploader = threading.Thread(
+                    target=vcfs.upload_vcf_archive_file, args=(archive_file, 'code', False, None, None))
+                uploader.start()
+                uploader.join(30)
+
+            self.assertEqual([call[0] for call in self.read_calls()], ['start', 'end'])
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
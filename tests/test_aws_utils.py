@@ -0,0 +1,169 @@
+"""
+Tests for the AWS client and secret functions
+"""
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+import botocore.exceptions
+from src import aws_utils
+from src.aws_utils import SecretCache, get_client, write_aspera_secrets_to_disk
+
+# how long each stubbed Secrets Manager call takes
+SECRET_LATENCY = 0.2
+
+
+class FakeSecrets:
+    """
+    Returns a version of each secret after a delay, counting the calls
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def fetch(self, secret_id):
+        """
+        Returns the current value and version of secret_id
+        """
+        time.sleep(SECRET_LATENCY)
+
+        with self.lock:
+            self.calls.append(secret_id)
+            version = self.versions.get(secret_id, 1)
+
+        return '{}-v{}'.format(secret_id, version).encode(), str(version)
+
+    def get_secret_value(self, SecretId):
+        """
+        Stands in for the Secrets Manager client
+        """
+        (value, version) = self.fetch(SecretId)
+
+        return {'SecretBinary': value, 'VersionId': version}
+
+
+class TestAwsUtils(TestCase):
+    """
+    Tests for the AWS client and secret functions
+    """
+    def setUp(self):
+        self.fake_secrets = FakeSecrets()
+
+    @patch.object(aws_utils, '_SESSION', None)
+    @patch.dict(aws_utils._CLIENTS, clear=True)
+    def test_startup(self):
+        """
+        Test that the startup secrets are fetched at the same time through one
+        shared client, which is created on first use
+        """
+        session = MagicMock()
+        session.client.return_value = self.fake_secrets
+
+        with patch('src.aws_utils.boto3.session.Session', return_value=session) as create_session, \
+                patch.object(aws_utils, 'SECRET_CACHE', SecretCache()):
+            self.assertFalse(create_session.called)
+
+            start_time = time.monotonic()
+            secrets = aws_utils.SECRET_CACHE.get_many(aws_utils.STARTUP_SECRET_IDS)
+            elapsed = time.monotonic() - start_time
+
+            self.assertLess(elapsed, SECRET_LATENCY * 2)
+            self.assertEqual(secrets['ups-prod'], b'ups-prod-v1')
+            self.assertEqual(create_session.call_count, 1)
+            self.assertEqual(session.client.call_count, 1)
+            self.assertIs(get_client('secretsmanager'), self.fake_secrets)
+
+    def test_secret_cache(self):
+        """
+        Test that:
+            * a secret is fetched once while it is fresh, even by threads asking at once
+            * an expired secret is fetched again
+            * a rotated secret gets a new entry
+        """
+        cache = SecretCache(ttl_seconds=60, fetch=self.fake_secrets.fetch)
+        threads = [threading.Thread(target=cache.get, args=('ups-prod',)) for _ in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.fake_secrets.calls, ['ups-prod'])
+
+        entry = cache.get_entry('ups-prod')
+        cache.ttl_seconds = 0
+
+        self.assertIs(cache.get_entry('ups-prod'), entry)
+        self.assertEqual(len(self.fake_secrets.calls), 2)
+
+        self.fake_secrets.versions['ups-prod'] = 2
+
+        self.assertEqual(cache.get('ups-prod'), b'ups-prod-v2')
+        self.assertIsNot(cache.get_entry('ups-prod'), entry)
+
+    @patch('src.aws_utils.write_to_logs')
+    def test_secret_cache_refresh_fails(self, _):
+        """
+        Test that:
+            * a secret that was never fetched raises when the fetch fails
+            * an expired secret keeps its value when fetching it again fails,
+              and is only fetched again once retry_seconds have passed
+        """
+        failing = MagicMock(side_effect=Exception('Secrets Manager is unavailable'))
+        cache = SecretCache(ttl_seconds=60, fetch=failing, retry_seconds=60)
+
+        with self.assertRaisesRegex(Exception, 'unavailable'):
+            cache.get('ups-prod')
+
+        cache.fetch = self.fake_secrets.fetch
+        self.assertEqual(cache.get('ups-prod'), b'ups-prod-v1')
+
+        cache.ttl_seconds = 0
+        cache.fetch = failing
+
+        self.assertEqual(cache.get('ups-prod'), b'ups-prod-v1')
+        self.assertEqual(failing.call_count, 2)
+
+        cache.ttl_seconds = 30
+        self.assertEqual(cache.get('ups-prod'), b'ups-prod-v1')
+        self.assertEqual(failing.call_count, 2)
+
+    def test_fetch_secret_raises(self):
+        """
+        Test that a secret that cannot be fetched raises rather than exiting
+        """
+        client = MagicMock()
+        client.get_secret_value.side_effect = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'InternalServiceError', 'Message': 'try again'}}, 'GetSecretValue')
+
+        with patch('src.aws_utils.get_secrets_client', return_value=client):
+            with self.assertRaisesRegex(Exception, 'ups-prod could not be retrieved'):
+                aws_utils.fetch_secret('ups-prod')
+
+    def test_write_aspera_secrets_to_disk(self):
+        """
+        Test that the Aspera keys are only rewritten once they are rotated
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            key_files = {secret_id: os.path.join(temp_dir, os.path.basename(key_file))
+                         for (secret_id, key_file) in aws_utils.ASPERA_KEY_FILES.items()}
+            cache = SecretCache(ttl_seconds=0, fetch=self.fake_secrets.fetch)
+
+            with patch.dict(aws_utils.ASPERA_KEY_FILES, key_files), patch.object(aws_utils, 'SECRET_CACHE', cache):
+                write_aspera_secrets_to_disk()
+                os.utime(key_files['ups-prod-aspera-key'], (0, 0))
+
+                write_aspera_secrets_to_disk()
+
+                self.assertEqual(os.path.getmtime(key_files['ups-prod-aspera-key']), 0)
+
+                self.fake_secrets.versions['ups-prod-aspera-key'] = 2
+                write_aspera_secrets_to_disk()
+
+                with open(key_files['ups-prod-aspera-key'], 'rb') as key_file:
+                    self.assertEqual(key_file.read(), b'ups-prod-aspera-key-v2')
@@ -0,0 +1,114 @@
+"""
+Tests for the BAM functions
+"""
+import gzip
+import hashlib
+import io
+import os
+import struct
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from src.bams import encode_bam_header, parse_bam_header, process_bam, process_bam_from_s3, reheader_bam
+from src.bgzf import BgzfWriter
+from src.compute import ComputePool
+from src.workspace import Workspace
+
+HEADER_TEXT = '\n'.join([
+    '@HD\tVN:1.0\tSO:coordinate',
+    '@SQ\tSN:chr1\tLN:1000',
+    '@RG\tID:lane1.secret\tSM:participant\tPL:ILLUMINA\tLB:lib1',
+    '@PG\tID:bwa\tCL:bwa mem /home/someone/participant.fq',
+]) + '\n'
+
+REFERENCES = struct.pack('<i', 1) + struct.pack('<i', 5) + b'chr1\x00' + struct.pack('<i', 1000)
+
+
+def make_bam(body, eof=True):
+    """
+    Returns a fake BAM with the test header followed by body
+    """
+    output = io.BytesIO()
+    writer = BgzfWriter(output)
+    writer.write(encode_bam_header(HEADER_TEXT, REFERENCES))
+    writer.write(body)
+
+    if eof:
+        writer.close()
+    else:
+        writer.flush()
+
+    return output.getvalue()
+
+
+class TestBams(TestCase):
+    """
+    Tests for the BAM functions
+    """
+    def test_reheader_bam(self):
+        """
+        Test that:
+            * the read groups and program lines are rewritten
+            * the alignment data is unchanged
+            * the returned MD5 matches the output
+        """
+        body = b''.join(struct.pack('<i', i) * 8 for i in range(50000))
+        output = io.BytesIO()
+
+        md5_checksum = reheader_bam(io.BytesIO(make_bam(body)), output, 'NEW_SAMPLE')
+
+        self.assertEqual(md5_checksum, hashlib.md5(output.getvalue()).hexdigest())
+
+        data = gzip.decompress(output.getvalue())
+        (text, references, header_length) = parse_bam_header(data)
+
+        self.assertEqual(text, '@HD\tVN:1.0\tSO:coordinate\n@SQ\tSN:chr1\tLN:1000\n@RG\tID:0\tPL:ILLUMINA\tSM:NEW_SAMPLE\n')
+        self.assertEqual(references, REFERENCES)
+        self.assertEqual(data[header_length:], body)
+
+    def test_reheader_bam_requires_eof_marker(self):
+        """
+        Test that a BAM missing its EOF marker is rejected
+        """
+        with self.assertRaises(ValueError):
+            reheader_bam(io.BytesIO(make_bam(b'x' * 1000, eof=False)), io.BytesIO(), 'NEW_SAMPLE')
+
+    @patch('src.bams.write_to_logs')
+    def test_streaming_matches_download(self, _):
+        """
+        Test that:
+            * a BAM streamed from S3 is reheadered to the same bytes, with the
+              same MD5, as the downloaded copy run through the compute pool
+            * a streamed BAM that does not match its expected checksums is rejected
+        """
+        bam = make_bam(b''.join(struct.pack('<i', i) * 8 for i in range(50000)))
+        expected = {'size': len(bam), 'etag': hashlib.md5(bam).hexdigest(), 'part_size': None}
+
+        with tempfile.TemporaryDirectory() as temp_dir, patch('src.bams.COMPUTE_POOL', ComputePool(1)), \
+                patch('src.bams.get_s3_object_stream', side_effect=lambda *_: io.BytesIO(bam)) as get_stream:
+            outputs = []
+
+            with Workspace(temp_dir) as workspace:
+                with open(workspace.path('md5'), 'wb') as temp_file:
+                    temp_file.write(bam)
+
+                md5_checksum = process_bam('NEW_SAMPLE', 'sample.bam', workspace.path('md5'), None, workspace)
+
+                with open(workspace.path('sample.bam'), 'rb') as output_file:
+                    outputs.append((md5_checksum, output_file.read()))
+
+            with Workspace(temp_dir) as workspace:
+                md5_checksum = process_bam_from_s3('NEW_SAMPLE', 'sample.bam', 'bucket', 'key', None, workspace,
+                                                   expected)
+
+                with open(workspace.path('sample.bam'), 'rb') as output_file:
+                    outputs.append((md5_checksum, output_file.read()))
+
+                get_stream.assert_called_once_with('bucket', 'key')
+
+                with self.assertRaisesRegex(Exception, 'does not match S3'):
+                    process_bam_from_s3('NEW_SAMPLE', 'sample.bam', 'bucket', 'key', None, workspace,
+                                        dict(expected, size=len(bam) + 1))
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0][0], hashlib.md5(outputs[0][1]).hexdigest())
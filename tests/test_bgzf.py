@@ -0,0 +1,33 @@
+"""
+Tests for the BGZF functions
+"""
+import gzip
+import io
+from unittest import TestCase
+from src.bgzf import BGZF_BLOCK_DATA_SIZE, BGZF_EOF, BgzfWriter, block_data, iter_blocks
+
+
+class TestBgzf(TestCase):
+    """
+    Tests for the BGZF functions
+    """
+    def test_writer_round_trip(self):
+        """
+        Test that:
+            * the output is readable as a regular gzip file
+            * every block is within the BGZF size limit
+            * the file ends with the EOF block
+        """
+        data = b''.join(b'line %d\tsome text\n' % i for i in range(20000))
+        output = io.BytesIO()
+
+        with BgzfWriter(output) as writer:
+            writer.write(data)
+
+        self.assertEqual(gzip.decompress(output.getvalue()), data)
+        self.assertTrue(output.getvalue().endswith(BGZF_EOF))
+
+        blocks = list(iter_blocks(io.BytesIO(output.getvalue())))
+        self.assertGreater(len(blocks), 2)
+        self.assertTrue(all(len(block_data(block)) <= BGZF_BLOCK_DATA_SIZE for block in blocks))
+        self.assertEqual(b''.join(block_data(block) for block in blocks), data)
@@ -0,0 +1,83 @@
+"""
+Tests for the output cache
+"""
+import os
+import tempfile
+from unittest import TestCase
+from src.cache import OutputCache, cache_key
+
+
+class TestCache(TestCase):
+    """
+    Tests for the output cache
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.temp_dir.name, 'cache')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def make_file(self, name, size):
+        """
+        Returns the path of a new file of size bytes
+        """
+        path = os.path.join(self.temp_dir.name, name)
+
+        with open(path, 'wb') as new_file:
+            new_file.write(b'x' * size)
+
+        return path
+
+    def test_put_and_get(self):
+        """
+        Test that:
+            * files are moved into the cache with their names and metadata
+            * a different ETag misses
+            * removed entries miss
+            * the cache's size covers its entries
+        """
+        cache = OutputCache(self.cache_dir, 2**20)
+        key = cache_key('bucket', 'participant.bam', '"etag"', 'SAMPLE')
+        bam_file = self.make_file('uuid.bam', 100)
+
+        self.assertEqual(cache.size(), 0)
+
+        cache.put(key, {'bam': bam_file}, {'md5_checksum': 'abc'})
+        cache.release(key)
+
+        self.assertFalse(os.path.exists(bam_file))
+        self.assertGreater(cache.size(), 100)
+
+        entry = cache.get(key)
+        self.assertEqual(entry['md5_checksum'], 'abc')
+        self.assertEqual(os.path.basename(entry['files']['bam']), 'uuid.bam')
+        self.assertEqual(os.path.getsize(entry['files']['bam']), 100)
+
+        self.assertIsNone(cache.get(cache_key('bucket', 'participant.bam', '"other"', 'SAMPLE')))
+
+        cache.remove(key)
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(cache.size(), 0)
+
+    def test_eviction(self):
+        """
+        Test that the least recently used entries are evicted first and entries
+        in use are never evicted
+        """
+        cache = OutputCache(self.cache_dir, 250)
+
+        cache.put('old', {'bam': self.make_file('old.bam', 100)})
+        cache.release('old')
+        cache.put('in_use', {'bam': self.make_file('in_use.bam', 100)})
+        cache.put('new', {'bam': self.make_file('new.bam', 100)})
+
+        self.assertIsNone(cache.get('old'))
+        self.assertIsNotNone(cache.get('in_use'))
+        self.assertIsNotNone(cache.get('new'))
+
+        cache.release('new')
+        cache.evict(50)
+
+        self.assertIsNone(cache.get('new'))
+        self.assertIsNotNone(cache.get('in_use'))
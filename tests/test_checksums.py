@@ -0,0 +1,142 @@
+"""
+Tests for the checksum functions
+"""
+import base64
+import hashlib
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from src.checksums import Checksums, expected_checksums, file_checksums, verify_checksums, verify_file
+
+
+def multipart_etag(data, part_size):
+    """
+    Returns the ETag S3 gives data uploaded in parts of part_size
+    """
+    digests = [hashlib.md5(data[start:start + part_size]).digest() for start in range(0, len(data), part_size)]
+
+    return '{}-{}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+class TestChecksums(TestCase):
+    """
+    Tests for the checksum functions
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.data = os.urandom(3 * 2**20 + 123)
+        self.file_name = os.path.join(self.temp_dir.name, 'sample.bam')
+
+        with open(self.file_name, 'wb') as sample_file:
+            sample_file.write(self.data)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_checksums_in_pieces(self):
+        """
+        Test that the checksums do not depend on how the data is split
+        """
+        checksums = Checksums(2**20)
+
+        for start in range(0, len(self.data), 100000):
+            checksums.update(self.data[start:start + 100000])
+
+        self.assertEqual(checksums.result(), {
+            'size': len(self.data),
+            'md5': hashlib.md5(self.data).hexdigest(),
+            'sha256': hashlib.sha256(self.data).hexdigest(),
+            'etag': multipart_etag(self.data, 2**20)
+        })
+
+    def test_file_checksums(self):
+        """
+        Test that a file's checksums match hashlib's, with and without parts
+        """
+        self.assertEqual(file_checksums(self.file_name, buffer_size=2**16)['etag'], hashlib.md5(self.data).hexdigest())
+
+        checksums = file_checksums(self.file_name, 2**20, buffer_size=3 * 2**18)
+
+        self.assertEqual(checksums['etag'], multipart_etag(self.data, 2**20))
+        self.assertEqual(checksums['sha256'], hashlib.sha256(self.data).hexdigest())
+
+    def test_expected_checksums(self):
+        """
+        Test that:
+            * a multipart ETag comes with the size of the first part
+            * a KMS encrypted object's ETag is not used
+            * a full-object SHA-256 is used
+        """
+        metadata = {
+            'ContentLength': len(self.data),
+            'ETag': '"{}"'.format(multipart_etag(self.data, 2**20)),
+            'ChecksumSHA256': base64.b64encode(hashlib.sha256(self.data).digest()).decode()
+        }
+
+        with patch('src.checksums.get_s3_object_part_size', return_value=2**20):
+            expected = expected_checksums('bucket', 'key', metadata)
+
+        self.assertEqual(expected['part_size'], 2**20)
+        self.assertEqual(expected['sha256'], hashlib.sha256(self.data).hexdigest())
+        verify_checksums(file_checksums(self.file_name, expected['part_size']), expected, 'sample.bam')
+
+        metadata['ServerSideEncryption'] = 'aws:kms'
+        self.assertNotIn('etag', expected_checksums('bucket', 'key', metadata))
+
+    @patch('src.checksums.write_to_logs')
+    def test_expected_checksums_uneven_parts(self, _):
+        """
+        Test that:
+            * an object uploaded in parts of different sizes has each part's size looked up and verifies
+            * an ETag whose parts do not add up to the object is not checked
+        """
+        part_sizes = [2**20, 2**21, len(self.data) - 3 * 2**20]
+        digests = []
+        start = 0
+
+        for part_size in part_sizes:
+            digests.append(hashlib.md5(self.data[start:start + part_size]).digest())
+            start += part_size
+
+        metadata = {
+            'ContentLength': len(self.data),
+            'ETag': '"{}-3"'.format(hashlib.md5(b''.join(digests)).hexdigest())
+        }
+
+        with patch('src.checksums.get_s3_object_part_size',
+                   side_effect=lambda bucket, key, part_number=1: part_sizes[part_number - 1]) as get_part_size:
+            expected = expected_checksums('bucket', 'key', metadata)
+
+        self.assertEqual(get_part_size.call_count, 3)
+        self.assertEqual(expected['part_size'], part_sizes)
+        verify_checksums(file_checksums(self.file_name, expected['part_size']), expected, 'sample.bam')
+
+        checksums = Checksums(expected['part_size'])
+
+        for start in range(0, len(self.data), 1000000):
+            checksums.update(self.data[start:start + 1000000])
+
+        self.assertEqual(checksums.etag(), expected['etag'])
+
+        with patch('src.checksums.get_s3_object_part_size', side_effect=[2**20, 2**20, 2**20]):
+            expected = expected_checksums('bucket', 'key', metadata)
+
+        self.assertNotIn('etag', expected)
+        verify_checksums(file_checksums(self.file_name, expected['part_size']), expected, 'sample.bam')
+
+    @patch('src.checksums.write_to_logs')
+    def test_verify_file(self, _):
+        """
+        Test that a download that differs from S3 fails
+        """
+        expected = {'size': len(self.data), 'part_size': None, 'etag': hashlib.md5(self.data).hexdigest()}
+
+        self.assertEqual(verify_file(self.file_name, expected, 'sample.bam')['size'], len(self.data))
+
+        with open(self.file_name, 'r+b') as sample_file:
+            sample_file.seek(2**20)
+            sample_file.write(b'corrupt')
+
+        with self.assertRaisesRegex(Exception, 'sample.bam does not match S3: its etag'):
+            verify_file(self.file_name, expected, 'sample.bam')
@@ -0,0 +1,113 @@
+"""
+Tests for the compute pool
+"""
+import glob
+import os
+import re
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+from src import bams, vcfs
+from src.compute import COMPUTE_POOL, ComputePool
+
+
+def get_pid():
+    """
+    Returns the pid of the process it runs in
+    """
+    return os.getpid()
+
+
+def get_parent_pid():
+    """
+    Returns the pid of the parent of the process it runs in
+    """
+    return os.getppid()
+
+
+def read_file(path):
+    """
+    Returns the contents of the file at path
+    """
+    with open(path) as input_file:
+        return input_file.read()
+
+
+def die():
+    """
+    Kills the process it runs in
+    """
+    os._exit(1)
+
+
+class TestCompute(TestCase):
+    """
+    Tests for the compute pool
+    """
+    def test_runs_in_worker_process(self):
+        """
+        Test that functions run in another process and exceptions come back
+        """
+        pool = ComputePool(2).start()
+
+        self.assertNotEqual(pool.run(get_pid), os.getpid())
+
+        with self.assertRaises(FileNotFoundError):
+            pool.run(read_file, '/nonexistent/file')
+
+    def test_runs_in_thread_without_processes(self):
+        """
+        Test that functions run in the calling process when there are no
+        worker processes
+        """
+        self.assertEqual(ComputePool(0).start().run(get_pid), os.getpid())
+
+    @patch('src.compute.write_to_logs')
+    def test_worker_dies(self, _):
+        """
+        Test that a dying worker fails its call and the pool is replaced
+        """
+        pool = ComputePool(1)
+
+        with self.assertRaisesRegex(Exception, 'Worker process died running die'):
+            pool.run(die)
+
+        self.assertNotEqual(pool.run(get_pid), os.getpid())
+
+    @patch('src.compute.write_to_logs')
+    def test_workers_not_forked_from_caller(self, _):
+        """
+        Test that workers started while other threads run, including after
+        a worker dies, are not children of the calling process
+        """
+        release = threading.Event()
+        thread = threading.Thread(target=release.wait)
+        thread.start()
+
+        try:
+            pool = ComputePool(1).start()
+            self.assertNotEqual(pool.run(get_parent_pid), os.getpid())
+
+            with self.assertRaises(Exception):
+                pool.run(die)
+
+            self.assertNotEqual(pool.run(get_parent_pid), os.getpid())
+        finally:
+            release.set()
+            thread.join()
+
+    def test_one_shared_pool(self):
+        """
+        Test that every module uses the same pool, which needs the package's
+        modules to import each other through src
+        """
+        self.assertIs(bams.COMPUTE_POOL, COMPUTE_POOL)
+        self.assertIs(vcfs.COMPUTE_POOL, COMPUTE_POOL)
+
+        paths = glob.glob(os.path.join(os.path.dirname(__file__), '..', 'src', '*.py'))
+        modules = {os.path.splitext(os.path.basename(path))[0] for path in paths}
+        flat_import = re.compile(r'^\s*(?:from|import)\s+({})\b'.format('|'.join(modules)), re.MULTILINE)
+
+        for path in paths:
+            with open(path) as source:
+                self.assertIsNone(flat_import.search(source.read()), path)
@@ -0,0 +1,84 @@
+"""
+Tests for the metrics
+"""
+import json
+import os
+import tempfile
+import urllib.request
+from unittest import TestCase
+from unittest.mock import patch
+from src.metrics import Metrics, MessageSummary
+
+
+@patch('src.metrics.write_to_logs')
+class TestMetrics(TestCase):
+    """
+    Tests for the metrics
+    """
+    def test_timer(self, write_to_logs):
+        """
+        Test that a timed step is logged as JSON, added to the summary and
+        aggregated by its labels, and that a failed step is recorded as an error
+        """
+        metrics = Metrics()
+        summary = MessageSummary('sample.bam')
+
+        with metrics.timer('download', summary, file_type='BAM') as timing:
+            timing['bytes'] = 2**20
+
+        with self.assertRaises(ValueError):
+            with metrics.timer('download', summary, file_type='BAM'):
+                raise ValueError()
+
+        record = json.loads(write_to_logs.call_args_list[0][0][0])
+        self.assertEqual(record['event'], 'timing')
+        self.assertEqual(record['step'], 'download')
+        self.assertEqual(record['file'], 'sample.bam')
+        self.assertEqual(record['bytes'], 2**20)
+        self.assertIn('mb_per_second', record)
+        self.assertEqual(json.loads(write_to_logs.call_args_list[1][0][0])['outcome'], 'error')
+
+        self.assertEqual(summary.steps['download']['bytes'], 2**20)
+
+        text = metrics.prometheus_text()
+        self.assertIn('ups_download_count{file_type="BAM",outcome="ok"} 1', text)
+        self.assertIn('ups_download_count{file_type="BAM",outcome="error"} 1', text)
+        self.assertIn('ups_download_bytes_total{file_type="BAM",outcome="ok"} 1048576', text)
+
+    def test_summarize(self, write_to_logs):
+        """
+        Test that a message summary is logged, counted and written to the metrics file
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            metrics_file = os.path.join(temp_dir, 'ups.prom')
+            metrics = Metrics(metrics_file=metrics_file)
+            summary = MessageSummary('sample.vcf')
+            summary.file_type = 'VCF'
+            summary.add('process', 1.5, 100)
+
+            metrics.summarize(summary, 'complete')
+
+            record = json.loads(write_to_logs.call_args[0][0])
+            self.assertEqual(record['event'], 'message_summary')
+            self.assertEqual(record['outcome'], 'complete')
+            self.assertEqual(record['steps'], {'process': {'seconds': 1.5, 'bytes': 100}})
+
+            with open(metrics_file) as prometheus_file:
+                self.assertIn('ups_messages_total{file_type="VCF",outcome="complete"} 1', prometheus_file.read())
+
+    def test_serve(self, _):
+        """
+        Test that the metrics are served on /metrics
+        """
+        metrics = Metrics()
+        metrics.increment('messages', outcome='failed')
+        server = metrics.serve(0, '127.0.0.1')
+
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+
+            with urllib.request.urlopen(url) as response:
+                self.assertIn(b'ups_messages_total{outcome="failed"} 1', response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
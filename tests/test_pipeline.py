@@ -0,0 +1,150 @@
+"""
+Tests for the pipeline
+"""
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from unittest import TestCase
+from unittest.mock import patch
+from src.pipeline import Pipeline, Stage
+
+DiskUsage = namedtuple('DiskUsage', ['total', 'used', 'free'])
+
+
+def slow_stage(name):
+    """
+    Returns a stage function that takes 0.1 seconds and records that it ran
+    """
+    def run(item):
+        time.sleep(0.1)
+        item.append(name)
+
+    return run
+
+
+class TestPipeline(TestCase):
+    """
+    Tests for the pipeline
+    """
+    def test_stages_overlap(self):
+        """
+        Test that:
+            * every item passes through every stage in order
+            * items are in different stages at the same time
+        """
+        pipeline = Pipeline([Stage(name, slow_stage(name)) for name in ('download', 'process', 'upload')])
+        start_time = time.monotonic()
+
+        futures = [pipeline.submit([]) for _ in range(5)]
+        results = [future.result(timeout=10) for future in futures]
+
+        self.assertEqual(results, [['download', 'process', 'upload']] * 5)
+        # running the stages one file at a time would take 1.5 seconds
+        self.assertLess(time.monotonic() - start_time, 1.2)
+        self.assertIn('upload: items=5', pipeline.summary())
+
+    def test_failed_item(self):
+        """
+        Test that an item that raises skips the later stages and its future
+        gets the exception
+        """
+        def fail(item):
+            raise Exception('bad file')
+
+        pipeline = Pipeline([Stage('process', fail), Stage('upload', slow_stage('upload'))])
+        item = []
+
+        with self.assertRaisesRegex(Exception, 'bad file'):
+            pipeline.submit(item).result(timeout=10)
+
+        self.assertEqual(item, [])
+
+    def test_cancelled_item(self):
+        """
+        Test that cancelling an item's future lets the stage it is in finish
+        and skips the stages after it
+        """
+        started = threading.Event()
+        release = threading.Event()
+
+        def wait_for_release(item):
+            started.set()
+            release.wait(10)
+            item.append('process')
+
+        pipeline = Pipeline([Stage('process', wait_for_release), Stage('upload', slow_stage('upload'))])
+        item = []
+        future = pipeline.submit(item)
+
+        self.assertTrue(started.wait(10))
+        self.assertTrue(future.cancel())
+        release.set()
+
+        # the next item only gets through once the cancelled one has left
+        self.assertEqual(pipeline.submit(['next']).result(timeout=10), ['next', 'process', 'upload'])
+        self.assertEqual(item, ['process'])
+
+    def test_exiting_item(self):
+        """
+        Test that an item that exits fails its future and the worker carries
+        on with the next item
+        """
+        def exit_on_first(item):
+            if not item:
+                raise SystemExit(5)
+
+        pipeline = Pipeline([Stage('process', exit_on_first)])
+
+        with self.assertRaises(SystemExit):
+            pipeline.submit([]).result(timeout=10)
+
+        self.assertEqual(pipeline.submit(['ok']).result(timeout=10), ['ok'])
+
+    def test_waits_for_free_space(self):
+        """
+        Test that a stage does not start an item until there is enough free space
+        """
+        usage = [DiskUsage(100, 95, 5), DiskUsage(100, 50, 50)]
+
+        with patch('src.pipeline.shutil.disk_usage', side_effect=lambda path: usage.pop(0)) as disk_usage, \
+                patch('src.pipeline.FREE_SPACE_POLL_INTERVAL', 0.01):
+            pipeline = Pipeline([Stage('download', slow_stage('download'), min_free_bytes=10)])
+            self.assertEqual(pipeline.submit([]).result(timeout=10), ['download'])
+
+        self.assertEqual(disk_usage.call_count, 2)
+
+    def test_stage_returning_future(self):
+        """
+        Test that:
+            * an item whose stage returns a future waits for it without
+              holding up the stage's worker
+            * a failed future fails the item
+        """
+        waiting = []
+
+        def wait(item):
+            waiting.append(Future())
+            item.append('wait')
+
+            return waiting[-1]
+
+        pipeline = Pipeline([Stage('wait', wait), Stage('complete', slow_stage('complete'))])
+        futures = [pipeline.submit([]) for _ in range(2)]
+
+        for _ in range(100):
+            if len(waiting) == 2:
+                break
+
+            time.sleep(0.01)
+
+        self.assertEqual(len(waiting), 2)
+        self.assertFalse(futures[0].done())
+
+        waiting[0].set_result(None)
+        waiting[1].set_exception(Exception('batch failed'))
+
+        self.assertEqual(futures[0].result(timeout=10), ['wait', 'complete'])
+
+        with self.assertRaisesRegex(Exception, 'batch failed'):
+            futures[1].result(timeout=10)
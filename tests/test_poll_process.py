@@ -0,0 +1,213 @@
+"""
+Tests for the main workflow
+"""
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from src import poll_process
+from src.admission import DiskBudget
+from src.cache import OutputCache
+from src.compute import ComputePool
+from tests.test_bams import make_bam
+
+ATTRIBUTES = {
+    'dna_data': 'WGS|GRCh38',
+    'exportfile_id': '7',
+    'file_type': 'BAM',
+    'file_url': 's3://bucket/participants/sample.bam',
+    'fileservice_uuid': 'file-uuid',
+    'instrument_model': 'Illumina HiSeq 2500',
+    'read_lengths': '150',
+    'sample_id': 'NEW_SAMPLE',
+    'sequence_type': '1',
+    'udn_id': 'UDN123'
+}
+
+
+def make_message(attributes=ATTRIBUTES):
+    """
+    Returns a fake SQS message with the attributes given
+    """
+    return Mock(message_id='message-id', message_attributes={
+        name: {'StringValue': value, 'DataType': 'String'} for (name, value) in attributes.items()})
+
+
+class TestPollProcess(TestCase):
+    """
+    Tests for the main workflow, with S3, Aspera and the UDN Gateway faked
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.bam = make_bam(os.urandom(400000))
+        self.cache = OutputCache(os.path.join(self.temp_dir.name, 'cache'))
+        self.budget = DiskBudget(self.temp_dir.name, budget_bytes=2**30, reserve_bytes=0,
+                                 usage_functions=[self.cache.size], evict_functions=[self.cache.evict])
+        self.send_files = Mock()
+        self.gateway = Mock()
+        self.download_file_from_s3 = Mock(side_effect=self.download)
+
+        patches = [
+            patch.object(poll_process, 'SCRATCH_ROOT', self.temp_dir.name),
+            patch.object(poll_process, 'OUTPUT_CACHE', self.cache),
+            patch.object(poll_process, 'DISK_BUDGET', self.budget),
+            patch.object(poll_process, 'GATEWAY', self.gateway),
+            patch.object(poll_process, 'VERIFY_DOWNLOADS', False),
+            patch.object(poll_process, 'STREAMING_INGEST', False),
+            patch.object(poll_process, 'BATCH_XML', False),
+            patch.object(poll_process, 'get_s3_object_metadata',
+                         return_value={'ContentLength': len(self.bam), 'ETag': '"etag"'}),
+            patch.object(poll_process, 'download_file_from_s3', self.download_file_from_s3),
+            patch.object(poll_process, 'get_secret_from_secrets_manager', return_value={}),
+            patch.object(poll_process, 'create_and_tar_xml', side_effect=self.create_and_tar_xml),
+            patch.object(poll_process, 'send_files', self.send_files),
+            patch('src.bams.COMPUTE_POOL', ComputePool(0)),
+            patch('src.admission.FOOTPRINT_OVERHEAD_BYTES', 0)
+        ]
+        patches.extend(patch('{}.write_to_logs'.format(module))
+                       for module in ('src.poll_process', 'src.admission', 'src.bams', 'src.cache', 'src.pipeline'))
+
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        poll_process.PIPELINE = poll_process.create_pipeline()
+        self.addCleanup(setattr, poll_process, 'PIPELINE', None)
+
+    def download(self, bucket, key, file_name, logger=None):
+        """
+        Writes the fake BAM where the download would
+        """
+        self.assertEqual((bucket, key), ('bucket', 'participants/sample.bam'))
+
+        with open(file_name, 'wb') as temp_file:
+            temp_file.write(self.bam)
+
+    @staticmethod
+    def create_and_tar_xml(*args):
+        """
+        Writes a fake XML tar into the workspace, its last argument
+        """
+        tar_file_name = args[-1].path('file-uuid.tar')
+
+        with open(tar_file_name, 'wb') as tar_file:
+            tar_file.write(b'x' * 1024)
+
+        return tar_file_name
+
+    def workspaces(self):
+        """
+        Returns the workspaces left in scratch
+        """
+        return [name for name in os.listdir(self.temp_dir.name) if name.startswith('job_')]
+
+    def test_bam_message(self):
+        """
+        Test that:
+            * the BAM is downloaded, reheadered and sent with its XML
+            * once the output is cached only the rest of the reservation is held
+            * the file is marked complete and the message deleted
+            * the cache entry, workspace and reservation are released
+        """
+        reserved = []
+
+        def send_files(file_names, fingerprints=None, summary=None):
+            self.assertEqual([os.path.basename(name) for name in file_names], ['file-uuid.bam', 'file-uuid.tar'])
+            self.assertTrue(all(os.path.exists(name) for name in file_names))
+            reserved.append(self.budget.reserved + sum(os.path.getsize(name) for name in file_names))
+
+        self.send_files.side_effect = send_files
+        message = make_message()
+
+        asyncio.run(poll_process.process_message(message))
+
+        # what is still reserved and the cached output add up to the estimated footprint
+        self.assertEqual(reserved, [2 * len(self.bam)])
+        self.gateway.mark_complete.assert_called_once_with('7')
+        message.delete.assert_called_once_with()
+        message.change_visibility.assert_not_called()
+        message.stop.assert_called_once_with()
+        self.assertEqual((self.budget.reserved, self.cache.size()), (0, 0))
+        self.assertEqual(self.workspaces(), [])
+
+    def test_failed_upload_is_retried_from_cache(self):
+        """
+        Test that a message whose upload fails is released with its output
+        kept, and its redelivery skips straight to the upload
+        """
+        self.send_files.side_effect = [Exception('Session Stop'), None]
+        message = make_message()
+
+        asyncio.run(poll_process.process_message(message))
+
+        message.change_visibility.assert_called_once_with(VisibilityTimeout=0)
+        message.delete.assert_not_called()
+        self.gateway.mark_complete.assert_not_called()
+        self.assertEqual(self.budget.reserved, 0)
+        self.assertGreater(self.cache.size(), len(self.bam) // 2)
+
+        message = make_message()
+        asyncio.run(poll_process.process_message(message))
+
+        self.assertEqual(self.download_file_from_s3.call_count, 1)
+        self.assertEqual(self.send_files.call_count, 2)
+        message.delete.assert_called_once_with()
+        self.assertEqual((self.budget.reserved, self.cache.size()), (0, 0))
+        self.assertEqual(self.workspaces(), [])
+
+    def test_unfittable_and_invalid_messages(self):
+        """
+        Test that:
+            * a file larger than the scratch budget has its message hidden for longer
+            * a message missing attributes is released straight away
+        """
+        message = make_message()
+
+        with patch.object(self.budget, 'budget_bytes', len(self.bam)):
+            asyncio.run(poll_process.process_message(message))
+
+        message.change_visibility.assert_called_once_with(
+            VisibilityTimeout=poll_process.UNFITTABLE_VISIBILITY_TIMEOUT)
+        self.download_file_from_s3.assert_not_called()
+
+        message = make_message(dict(ATTRIBUTES, file_type='CRAM'))
+        asyncio.run(poll_process.process_message(message))
+
+        message.change_visibility.assert_called_once_with(VisibilityTimeout=0)
+        self.assertEqual(self.workspaces(), [])
+
+    def test_cancelled_at_shutdown(self):
+        """
+        Test that a message cancelled while its file uploads is never marked
+        complete or deleted, even once the upload finishes
+        """
+        uploading = threading.Event()
+        release = threading.Event()
+
+        def send_files(*_):
+            uploading.set()
+            release.wait(10)
+
+        self.send_files.side_effect = send_files
+        message = make_message()
+
+        async def run():
+            task = asyncio.ensure_future(poll_process.process_message(message))
+            await asyncio.get_running_loop().run_in_executor(None, uploading.wait, 10)
+            task.cancel()
+
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+        release.set()
+
+        # the upload stage hands the job on once it returns
+        time.sleep(0.2)
+
+        self.gateway.mark_complete.assert_not_called()
+        message.delete.assert_not_called()
@@ -0,0 +1,179 @@
+"""
+Tests for the S3 transfer functions
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+import botocore
+from src import aws_utils
+from src.s3_transfers import (
+    DOWNLOAD_TRANSFER_CONFIG, MIN_PART_SIZE, ResumableUploader, download_file_from_s3, get_upload_client)
+
+PART_SIZE = MIN_PART_SIZE
+
+
+class FakeS3Client:
+    """
+    An in memory stand-in for the multipart upload calls of an S3 client
+    """
+    def __init__(self, fail_on_part=None):
+        self.fail_on_part = fail_on_part
+        self.uploads = {}
+        self.objects = {}
+        self.uploaded_parts = []
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body.read()
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = 'upload-{}'.format(len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_on_part:
+            raise ConnectionError('connection reset')
+
+        etag = '"{}"'.format(hashlib.md5(Body).hexdigest())
+
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = (etag, Body)
+            self.uploaded_parts.append(PartNumber)
+
+        return {'ETag': etag}
+
+    def get_paginator(self, operation_name):
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Key, UploadId):
+                if UploadId not in client.uploads:
+                    raise botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchUpload'}}, operation_name)
+
+                yield {'Parts': [{'PartNumber': number, 'ETag': etag}
+                                 for (number, (etag, _)) in sorted(client.uploads[UploadId].items())]}
+
+        return Paginator()
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b''.join(
+            parts[part['PartNumber']][1] for part in MultipartUpload['Parts']
+            if parts[part['PartNumber']][0] == part['ETag'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+    def download_file(self, Bucket, Key, Filename, Config):
+        self.download_config = Config
+
+        with open(Filename, 'wb') as download_file:
+            download_file.write(self.objects[(Bucket, Key)])
+
+
+class TestS3Transfers(TestCase):
+    """
+    Tests for the S3 transfer functions
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.journal_dir = os.path.join(self.temp_dir.name, 'journal')
+        self.upload_file = os.path.join(self.temp_dir.name, 'upload.bam')
+        self.data = os.urandom(PART_SIZE * 3 + 1000)
+
+        with open(self.upload_file, 'wb') as upload_file:
+            upload_file.write(self.data)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_upload_file(self):
+        """
+        Test that a file larger than a part is uploaded in parts and the journal
+        is removed once the upload completes
+        """
+        client = FakeS3Client()
+        ResumableUploader(client, self.journal_dir, PART_SIZE, 2).upload_file(self.upload_file, 'bucket', 'key')
+
+        self.assertEqual(client.objects[('bucket', 'key')], self.data)
+        self.assertEqual(sorted(client.uploaded_parts), [1, 2, 3, 4])
+        self.assertEqual(os.listdir(self.journal_dir), [])
+
+    def test_resume_upload(self):
+        """
+        Test that:
+            * a failed upload leaves a journal behind
+            * retrying the upload only sends the parts that were not uploaded
+        """
+        client = FakeS3Client(fail_on_part=3)
+        uploader = ResumableUploader(client, self.journal_dir, PART_SIZE, 1)
+
+        with self.assertRaises(ConnectionError):
+            uploader.upload_file(self.upload_file, 'bucket', 'key', 'md5')
+
+        self.assertEqual(len(os.listdir(self.journal_dir)), 1)
+        self.assertEqual(client.uploaded_parts[:2], [1, 2])
+        first_attempt = len(client.uploaded_parts)
+
+        client.fail_on_part = None
+        uploader.upload_file(self.upload_file, 'bucket', 'key', 'md5')
+
+        self.assertEqual(client.objects[('bucket', 'key')], self.data)
+        self.assertEqual(sorted(client.uploaded_parts), [1, 2, 3, 4])
+        self.assertNotIn(1, client.uploaded_parts[first_attempt:])
+
+    def test_changed_file_restarts_upload(self):
+        """
+        Test that a journal for different file contents is discarded and its
+        upload aborted
+        """
+        client = FakeS3Client(fail_on_part=2)
+        uploader = ResumableUploader(client, self.journal_dir, PART_SIZE, 1)
+
+        with self.assertRaises(ConnectionError):
+            uploader.upload_file(self.upload_file, 'bucket', 'key', 'old-md5')
+
+        first_attempt = len(client.uploaded_parts)
+        client.fail_on_part = None
+        uploader.upload_file(self.upload_file, 'bucket', 'key', 'new-md5')
+
+        self.assertEqual(client.objects[('bucket', 'key')], self.data)
+        self.assertEqual(client.uploaded_parts[first_attempt:], [1, 2, 3, 4])
+        self.assertEqual(client.uploads, {})
+
+    def test_download_file(self):
+        """
+        Test that downloads use the shared transfer config and return the size
+        of the file
+        """
+        client = FakeS3Client()
+        client.objects[('bucket', 'key')] = self.data
+        download_file = os.path.join(self.temp_dir.name, 'download.bam')
+
+        self.assertEqual(download_file_from_s3('bucket', 'key', download_file, s3_client=client), len(self.data))
+        self.assertIs(client.download_config, DOWNLOAD_TRANSFER_CONFIG)
+
+        with open(download_file, 'rb') as downloaded:
+            self.assertEqual(downloaded.read(), self.data)
+
+    @patch.object(aws_utils, '_SESSION', None)
+    @patch.dict(aws_utils._CLIENTS, clear=True)
+    @patch('src.s3_transfers.S3_ENDPOINT_URL', 'http://localhost:9000')
+    def test_get_upload_client(self):
+        """
+        Test that the client for another endpoint is created once and kept
+        apart from the shared transfer client
+        """
+        session = MagicMock()
+        session.client.side_effect = lambda *args, **kwargs: MagicMock()
+
+        with patch('src.aws_utils.boto3.session.Session', return_value=session):
+            client = get_upload_client()
+
+            self.assertIs(get_upload_client(), client)
+            self.assertIsNot(aws_utils.get_s3_transfer_client(), client)
+            self.assertEqual(session.client.call_args_list[0][1]['endpoint_url'], 'http://localhost:9000')
@@ -0,0 +1,176 @@
+"""
+Tests for the SQS functions
+"""
+import asyncio
+import threading
+import time
+from unittest import TestCase
+from src.sqs_utils import LoopVisibilityHeartbeat, ReceiveScheduler, poll_queue_async
+
+
+class FakeMessage:
+    """
+    Records the calls made to an SQS message
+    """
+    def __init__(self):
+        self.message_id = 'message-1'
+        self.message_attributes = {'file_type': {'StringValue': 'BAM'}}
+        self.attributes = {'SentTimestamp': str(int(time.time() * 1000))}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def change_visibility(self, VisibilityTimeout):
+        with self.lock:
+            self.calls.append(('change_visibility', VisibilityTimeout))
+
+    def delete(self):
+        with self.lock:
+            self.calls.append(('delete',))
+
+
+class FakeQueue:
+    """
+    Hands out batches of messages, then returns nothing
+    """
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.receive_calls = []
+
+    def receive_messages(self, **kwargs):
+        self.receive_calls.append(kwargs)
+
+        return self.batches.pop(0) if self.batches else []
+
+
+class TestSqsUtils(TestCase):
+    """
+    Tests for the SQS functions
+    """
+    def test_heartbeat(self):
+        """
+        Test that:
+            * the visibility is extended repeatedly while the message is in progress
+            * message attributes are passed through
+            * no extension follows the message being released
+        """
+        message = FakeMessage()
+
+        async def run():
+            with LoopVisibilityHeartbeat(
+                    message, asyncio.get_running_loop(), visibility_timeout=30, interval=0.01) as heartbeat:
+                self.assertEqual(heartbeat.message_attributes, message.message_attributes)
+                await asyncio.sleep(0.1)
+                heartbeat.change_visibility(VisibilityTimeout=0)
+                await asyncio.sleep(0.05)
+
+        asyncio.run(run())
+
+        self.assertGreater(message.calls.count(('change_visibility', 30)), 1)
+        self.assertEqual(message.calls[-1], ('change_visibility', 0))
+
+    def test_receive_scheduler(self):
+        """
+        Test that the pause doubles with each empty receive up to the maximum
+        and is reset when messages arrive
+        """
+        scheduler = ReceiveScheduler(max_backoff=4)
+
+        self.assertEqual([scheduler.record_receive([], 0.1) for _ in range(4)], [1, 2, 4, 4])
+        self.assertEqual(scheduler.record_receive([FakeMessage()], 0.1), 0)
+        self.assertEqual((scheduler.receives, scheduler.empty_receives, scheduler.messages), (5, 4, 1))
+
+    def test_loop_heartbeat(self):
+        """
+        Test that a heartbeat on an event loop extends the visibility
+        repeatedly and stops when the message is deleted from another thread
+        """
+        message = FakeMessage()
+
+        async def run():
+            heartbeat = LoopVisibilityHeartbeat(
+                message, asyncio.get_running_loop(), visibility_timeout=30, interval=0.01).start()
+            await asyncio.sleep(0.1)
+            await asyncio.get_running_loop().run_in_executor(None, heartbeat.delete)
+            await asyncio.sleep(0.05)
+
+        asyncio.run(run())
+
+        self.assertGreater(message.calls.count(('change_visibility', 30)), 1)
+        self.assertEqual(message.calls[-1], ('delete',))
+
+    def test_poll_queue_async(self):
+        """
+        Test that:
+            * every message is processed as a task with a heartbeat
+            * the idle callback runs after an empty receive
+            * receives long poll and never ask for more messages than there are free slots
+        """
+        messages = [FakeMessage() for _ in range(3)]
+        queue = FakeQueue([messages[:2], messages[2:]])
+        processed = []
+        idle_calls = []
+
+        async def run():
+            stopping = asyncio.Event()
+
+            async def process_message(heartbeat):
+                processed.append(heartbeat.message)
+                await asyncio.sleep(0.01)
+                heartbeat.delete()
+
+            def on_idle():
+                idle_calls.append(1)
+
+                if len(idle_calls) == 2:
+                    stopping.set()
+
+            return await poll_queue_async(
+                queue, process_message, on_idle, 2, ['file_type'], scheduler=ReceiveScheduler(max_backoff=0),
+                wait_seconds=5, stopping=stopping)
+
+        scheduler = asyncio.run(run())
+
+        self.assertEqual(processed, messages)
+        self.assertEqual(scheduler.empty_receives, 2)
+        self.assertTrue(all(message.calls[-1] == ('delete',) for message in messages))
+        self.assertTrue(all(call['WaitTimeSeconds'] == 5 and call['MaxNumberOfMessages'] <= 2
+                            for call in queue.receive_calls))
+
+    def test_poll_queue_async_shutdown(self):
+        """
+        Test that once stopping is set:
+            * a message that finishes within the grace period is left to finish
+            * one that does not is cancelled before it is released
+            * one whose cancellation finds it already dealt with is not released
+        """
+        messages = [FakeMessage() for _ in range(3)]
+        queue = FakeQueue([messages])
+
+        async def run():
+            stopping = asyncio.Event()
+
+            async def process_message(heartbeat):
+                stopping.set()
+
+                try:
+                    await asyncio.sleep(0.05 if heartbeat.message is messages[0] else 10)
+                except asyncio.CancelledError:
+                    heartbeat.message.calls.append(('cancelled',))
+
+                    if heartbeat.message is messages[1]:
+                        raise
+
+                heartbeat.delete()
+
+            await poll_queue_async(
+                queue, process_message, lambda: None, 3, ['file_type'], scheduler=ReceiveScheduler(max_backoff=0),
+                wait_seconds=5, stopping=stopping, grace_seconds=0.5)
+
+        start_time = time.monotonic()
+        asyncio.run(run())
+
+        self.assertLess(time.monotonic() - start_time, 5)
+        self.assertEqual(messages[0].calls[-1], ('delete',))
+        self.assertEqual(messages[1].calls[-2:], [('cancelled',), ('change_visibility', 0)])
+        self.assertEqual(messages[2].calls[-2:], [('cancelled',), ('delete',)])
+        self.assertEqual(len(queue.receive_calls), 1)
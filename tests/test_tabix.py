@@ -0,0 +1,135 @@
+"""
+Tests for the tabix functions
+"""
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+from unittest import TestCase
+import pysam
+from src.tabix import META_BIN, VcfTabixWriter, reg2bin, vcf_record_region
+
+HEADER = b'##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+
+
+def read_index(index_file_name):
+    """
+    Parse a tabix index into its names, the bins and linear index of each reference, and what follows them
+    """
+    with gzip.open(index_file_name, 'rb') as index_file:
+        index = index_file.read()
+
+    (reference_count,) = struct.unpack_from('<i', index, 4)
+    (names_length,) = struct.unpack_from('<i', index, 32)
+    names = index[36:36 + names_length]
+    offset = 36 + names_length
+    references = []
+
+    for _ in range(reference_count):
+        (bin_count,) = struct.unpack_from('<i', index, offset)
+        offset += 4
+        bins = {}
+
+        for _ in range(bin_count):
+            (bin_number, chunk_count) = struct.unpack_from('<Ii', index, offset)
+            bins[bin_number] = struct.unpack_from('<{}Q'.format(2 * chunk_count), index, offset + 8)
+            offset += 8 + 16 * chunk_count
+
+        (interval_count,) = struct.unpack_from('<i', index, offset)
+        linear_index = struct.unpack_from('<{}Q'.format(interval_count), index, offset + 4)
+        offset += 4 + 8 * interval_count
+        references.append((bins, linear_index))
+
+    return names, references, index[offset:]
+
+
+class TestTabix(TestCase):
+    """
+    Tests for the tabix functions
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.vcf_file = os.path.join(self.temp_dir.name, 'test.vcf.gz')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_vcf_record_region(self):
+        """
+        Test that the region covers REF, or the END annotation when there is one
+        """
+        self.assertEqual(vcf_record_region(b'1\t100\t.\tACG\tA\t.\tPASS\tDP=3\n'), (b'1', 99, 102))
+        self.assertEqual(vcf_record_region(b'1\t100\t.\tA\t<DEL>\t.\tPASS\tDP=3;END=500\n'), (b'1', 99, 500))
+
+    def test_reg2bin(self):
+        """
+        Test the bins at the smallest and largest levels
+        """
+        self.assertEqual(reg2bin(0, 1), 4681)
+        self.assertEqual(reg2bin(16384, 16385), 4682)
+        self.assertEqual(reg2bin(0, 2**29), 0)
+
+    def test_writer(self):
+        """
+        Test that:
+            * the output decompresses to the lines written
+            * the index lists each chromosome and has a bin for every record
+            * blank lines are not indexed
+            * records out of order are rejected
+        """
+        records = b''.join(b'%s\t%d\t.\tA\tG\t.\tPASS\t.\n' % (chrom, pos)
+                           for chrom in (b'chr1', b'chr2') for pos in range(1, 200000, 50))
+
+        with VcfTabixWriter(self.vcf_file, threads=2) as writer:
+            writer.write(HEADER)
+            writer.write(records)
+
+        with gzip.open(self.vcf_file, 'rb') as vcf:
+            self.assertEqual(vcf.read(), HEADER + records)
+
+        with gzip.open(self.vcf_file + '.tbi', 'rb') as index_file:
+            index = index_file.read()
+
+        self.assertEqual(index[:4], b'TBI\x01')
+        (reference_count, index_format, _, _, _, meta, _, names_length) = struct.unpack_from('<8i', index, 4)
+        self.assertEqual((reference_count, index_format, meta), (2, 2, ord('#')))
+        self.assertEqual(index[36:36 + names_length], b'chr1\x00chr2\x00')
+        (bin_count,) = struct.unpack_from('<i', index, 36 + names_length)
+        self.assertEqual(bin_count, len(range(0, 200000, 2**14)) + 1)
+
+        with VcfTabixWriter(self.vcf_file) as writer:
+            writer.write(HEADER + b'chr1\t10\t.\tA\tG\t.\tPASS\t.\n\n')
+
+        with self.assertRaises(ValueError):
+            with VcfTabixWriter(self.vcf_file) as writer:
+                writer.write(HEADER + b'chr1\t10\t.\tA\tG\t.\tPASS\t.\nchr1\t5\t.\tA\tG\t.\tPASS\t.\n')
+
+    def test_matches_htslib_index(self):
+        """
+        Test that:
+            * the index has the same bins, pseudo-bin and linear index as htslib's for the same file
+            * both indexes return the same records with and without a region
+        """
+        records = b''.join(b'%s\t%d\t.\tA\tG\t.\tPASS\t%s\n' % (chrom, pos, b'X' * (pos % 300 + 1))
+                           for chrom in (b'chr1', b'chr2') for pos in range(1, 300000, 37))
+
+        with VcfTabixWriter(self.vcf_file, threads=2) as writer:
+            writer.write(HEADER)
+            writer.write(records)
+
+        htslib_file = os.path.join(self.temp_dir.name, 'htslib.vcf.gz')
+        shutil.copyfile(self.vcf_file, htslib_file)
+        pysam.tabix_index(htslib_file, preset='vcf', force=True)
+
+        (names, references, trailer) = read_index(self.vcf_file + '.tbi')
+        self.assertEqual((names, references, trailer), read_index(htslib_file + '.tbi'))
+        self.assertEqual(references[0][0][META_BIN][2:], (len(range(1, 300000, 37)), 0))
+        self.assertEqual(trailer, struct.pack('<Q', 0))
+
+        with pysam.TabixFile(self.vcf_file) as ours, pysam.TabixFile(htslib_file) as theirs:
+            self.assertEqual(len(list(ours.fetch())), 2 * len(range(1, 300000, 37)))
+            self.assertEqual(list(ours.fetch()), list(theirs.fetch()))
+
+            for region in ('chr1', 'chr2:1000-1000', 'chr1:16000-17000', 'chr2:250000-400000'):
+                self.assertEqual(list(ours.fetch(region=region)), list(theirs.fetch(region=region)))
@@ -0,0 +1,167 @@
+"""
+Tests for the UDN Gateway client
+"""
+import json
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+from unittest.mock import patch
+from src.udn_gateway import GATEWAY_BATCH_PATH, GatewayClient
+
+
+class StubGateway:
+    """
+    A local HTTP server that records the completion calls made to it and
+    answers with the queued status codes, then 200
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.statuses = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """
+            Records each POST and answers it
+            """
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                stub.requests.append({
+                    'path': self.path,
+                    'authorization': self.headers.get('Authorization'),
+                    'body': json.loads(body) if body else None
+                })
+                self.send_response(stub.statuses.pop(0) if stub.statuses else 200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *_):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def close(self):
+        """
+        Stops the server
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@patch('src.udn_gateway.write_to_logs')
+@patch('src.metrics.write_to_logs')
+class TestUdnGateway(TestCase):
+    """
+    Tests for the UDN Gateway client
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.stub = StubGateway()
+        self.secret = {'udn_api_url': self.stub.url, 'udn_api_token': 'token'}
+
+    def tearDown(self):
+        self.stub.close()
+        self.temp_dir.cleanup()
+
+    def client(self, **kwargs):
+        """
+        Returns a client for the stub that retries quickly
+        """
+        kwargs.setdefault('batch_size', 1)
+
+        return GatewayClient(lambda: self.secret, self.temp_dir.name, backoff_factor=0, retry_seconds=0.05, **kwargs)
+
+    def test_mark_complete(self, *_):
+        """
+        Test that a completion is sent with the token after 5xx responses and
+        a rejected token are retried, and is then removed from the outbox
+        """
+        self.stub.statuses = [503, 503, 401]
+        client = self.client(retries=2).start()
+
+        client.mark_complete(42)
+
+        self.assertTrue(client.wait(10))
+        self.assertEqual([request['path'] for request in self.stub.requests],
+                         ['/api/dbgap/exported_files/42/complete'] * 4)
+        self.assertEqual(self.stub.requests[-1]['authorization'], 'Token token')
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+    def test_rejected_token_is_refetched(self, *_):
+        """
+        Test that a rejected token calls on_unauthorized before the completion
+        is retried with the token get_secret then returns
+        """
+        self.stub.statuses = [403]
+
+        def rotate():
+            self.secret = dict(self.secret, udn_api_token='rotated')
+
+        client = GatewayClient(lambda: self.secret, self.temp_dir.name, batch_size=1, backoff_factor=0,
+                               retry_seconds=0.05, on_unauthorized=rotate).start()
+
+        client.mark_complete(7)
+
+        self.assertTrue(client.wait(10))
+        self.assertEqual([request['authorization'] for request in self.stub.requests], ['Token token', 'Token rotated'])
+
+    def test_outbox_survives_restart(self, *_):
+        """
+        Test that completions recorded before a restart are sent by the next client
+        """
+        client = self.client()
+        client.mark_complete(1)
+        client.mark_complete(2)
+
+        self.assertEqual(len(os.listdir(self.temp_dir.name)), 2)
+        self.assertEqual(self.stub.requests, [])
+
+        restarted = self.client().start()
+
+        self.assertTrue(restarted.wait(10))
+        self.assertEqual(sorted(request['path'] for request in self.stub.requests),
+                         ['/api/dbgap/exported_files/1/complete', '/api/dbgap/exported_files/2/complete'])
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+    def test_batch(self, *_):
+        """
+        Test that queued completions are sent in one call to the batch endpoint
+        """
+        client = self.client(batch_size=10)
+
+        for file_id in range(3):
+            client.mark_complete(file_id)
+
+        client.start()
+
+        self.assertTrue(client.wait(10))
+        self.assertEqual(self.stub.requests, [
+            {'path': GATEWAY_BATCH_PATH, 'authorization': 'Token token', 'body': {'ids': [0, 1, 2]}}])
+
+    def test_failed_call_keeps_other_results(self, *_):
+        """
+        Test that:
+            * a call that raises only has its own file retried
+            * the files marked complete before and after it are done
+        """
+        client = self.client()
+        post = client.post
+        failures = [ConnectionError('Connection refused')]
+
+        def flaky_post(url, headers, body=None):
+            if url.endswith('/2/complete') and failures:
+                raise failures.pop()
+
+            return post(url, headers, body)
+
+        with patch.object(client, 'post', side_effect=flaky_post):
+            self.assertEqual(client.send([1, 2, 3]), ([1, 3], [2]))
+
+        self.assertEqual([request['path'] for request in self.stub.requests],
+                         ['/api/dbgap/exported_files/1/complete', '/api/dbgap/exported_files/3/complete'])
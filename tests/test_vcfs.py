@@ -0,0 +1,213 @@
+"""
+Tests for the VCF functions
+"""
+import gzip
+import io
+import os
+import tarfile
+import tempfile
+import time
+from concurrent.futures import Future
+from unittest import TestCase
+from unittest.mock import Mock, patch
+import pysam
+from src.archive import RollingArchiveWriter, TarWriter
+from src.compute import ComputePool
+from src.vcfs import (
+    AnnotationLookup, adopt_stale_vcf_archives, process_header, process_vcf, process_vcf_from_s3, trim_vcf,
+    trim_vcf_records, upload_vcf_archive_file, write_trimmed_vcf)
+from src.workspace import Workspace
+
+VCF = (
+    b'##fileformat=VCFv4.2\n'
+    b'##source=SomeCaller --input /home/someone/participant.bam\n'
+    b'##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count">\n'
+    b'##INFO=<ID=ExcessHet,Number=1,Type=Float,Description="Excess heterozygosity">\n'
+    b'##contig=<ID=1,length=1000>\n'
+    b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tparticipant\n'
+    b'1\t10\t.\tA\tG\t50\tPASS\tAC=1;ExcessHet=3.01;DP=10\tGT\t0/1\n'
+    b'1\t20\t.\tC\tT\t50\tPASS\tDB;ExcessHet=3.01\tGT\t0/1\n'
+    b'1\t30\t.\tG\tA\t50\tPASS\t.\tGT\t1/1\n'
+)
+
+
+class TestVcfs(TestCase):
+    """
+    Tests for the VCF functions
+    """
+    def test_process_header(self):
+        """
+        Test that extraneous and non-whitelisted INFO header lines are removed
+        and the sample ID is replaced
+        """
+        self.assertIsNone(process_header('##source=SomeCaller\n'))
+        self.assertIsNone(process_header('##INFO=<ID=ExcessHet,Number=1,Type=Float,Description="x">\n'))
+        self.assertEqual(process_header('##INFO=<ID=AC,Number=A,Type=Integer,Description="x">\n'),
+                         '##INFO=<ID=AC,Number=A,Type=Integer,Description="x">\n')
+        self.assertEqual(process_header('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\told\n', ('new',)),
+                         '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tnew\n')
+
+    def test_trim_vcf_records(self):
+        """
+        Test that non-whitelisted INFO annotations are removed and that a
+        record left with no annotations gets the missing value
+        """
+        records = (b'1\t10\t.\tA\tG\t50\tPASS\tAC=1;ExcessHet=3.01;DP=10\tGT\t0/1\n'
+                   b'1\t20\t.\tC\tT\t50\tPASS\tDB;ExcessHet=3.01\tGT\t0/1\n'
+                   b'1\t30\t.\tG\tA\t50\tPASS\tAC=2;NEGATIVE_TRAIN_SITE\tGT\t1/1\n')
+
+        self.assertEqual(trim_vcf_records(records, AnnotationLookup()),
+                         b'1\t10\t.\tA\tG\t50\tPASS\tAC=1;DP=10\tGT\t0/1\n'
+                         b'1\t20\t.\tC\tT\t50\tPASS\t.\tGT\t0/1\n'
+                         b'1\t30\t.\tG\tA\t50\tPASS\tAC=2;NEGATIVE_TRAIN_SITE\tGT\t1/1\n')
+
+    def test_trim_vcf(self):
+        """
+        Test trimming a gzipped VCF file
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            from_file = os.path.join(temp_dir, 'input.vcf.gz')
+            to_file = os.path.join(temp_dir, 'output.vcf')
+
+            with gzip.open(from_file, 'wb') as vcf:
+                vcf.write(VCF)
+
+            trim_vcf(from_file, to_file, 'NEW_SAMPLE')
+
+            with open(to_file, 'rb') as vcf:
+                self.assertEqual(vcf.read(), (
+                    b'##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count">\n'
+                    b'##contig=<ID=1,length=1000>\n'
+                    b'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNEW_SAMPLE\n'
+                    b'1\t10\t.\tA\tG\t50\tPASS\tAC=1;DP=10\tGT\t0/1\n'
+                    b'1\t20\t.\tC\tT\t50\tPASS\t.\tGT\t0/1\n'
+                    b'1\t30\t.\tG\tA\t50\tPASS\t.\tGT\t1/1\n'))
+
+    def test_write_trimmed_vcf(self):
+        """
+        Test that htslib with one thread and the parallel writer with more
+        write the same bgzipped VCF and an index that finds its records
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            contents = []
+
+            for threads in (1, 2):
+                output_file = os.path.join(temp_dir, 'output{}.vcf.gz'.format(threads))
+
+                with open(os.path.join(temp_dir, 'input.vcf'), 'wb') as vcf:
+                    vcf.write(VCF)
+
+                with open(os.path.join(temp_dir, 'input.vcf'), 'rb') as vcf:
+                    write_trimmed_vcf(vcf, output_file, 'NEW_SAMPLE', threads)
+
+                with gzip.open(output_file, 'rb') as vcf:
+                    contents.append(vcf.read())
+
+                with pysam.TabixFile(output_file) as tabix_file:
+                    self.assertEqual([record.split('\t')[1] for record in tabix_file.fetch('1', 15, 30)], ['20', '30'])
+
+            self.assertEqual(contents[0], contents[1])
+
+    @patch('src.vcfs.write_to_logs')
+    def test_upload_vcf_archive_file(self, _):
+        """
+        Test that a failed upload raises and keeps the archive, and a
+        successful one removes it
+        """
+        failed = Future()
+        failed.set_exception(Exception('Session Stop'))
+        succeeded = Future()
+        succeeded.set_result([0])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            archive_file = os.path.join(temp_dir, 'vcf_archive_1.tar')
+
+            with open(archive_file, 'wb') as archive:
+                archive.write(b'x' * 100)
+
+            with patch('src.vcfs.TRANSFER_MANAGER.upload_files', return_value=failed), \
+                    self.assertRaisesRegex(Exception, 'Session Stop'):
+                upload_vcf_archive_file(archive_file, 'code', False, None, None)
+
+            self.assertTrue(os.path.exists(archive_file))
+
+            with patch('src.vcfs.TRANSFER_MANAGER.upload_files', return_value=succeeded):
+                upload_vcf_archive_file(archive_file, 'code', False, None, None)
+
+            self.assertFalse(os.path.exists(archive_file))
+
+    @patch('src.vcfs.write_to_logs')
+    def test_adopt_stale_vcf_archives(self, _):
+        """
+        Test that archives of other hosts are taken over once stale and free,
+        and this host's own archives and recent ones are left alone
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = RollingArchiveWriter(temp_dir, 'vcf_archive_this', 2**20)
+            vcf_file = os.path.join(temp_dir, 'sample.vcf.gz')
+            names = ['vcf_archive.tar', 'vcf_archive_other.tar', 'vcf_archive_busy.tar', 'vcf_archive_recent.tar',
+                     'vcf_archive_this.tar', 'vcf_archive_this_1.tar']
+
+            for name in names:
+                with open(vcf_file, 'wb') as sample:
+                    sample.write(b'x' * 100)
+
+                with TarWriter(os.path.join(temp_dir, name)) as tar:
+                    tar.add(vcf_file, arcname=name)
+
+                if name != 'vcf_archive_recent.tar':
+                    os.utime(os.path.join(temp_dir, name), (time.time() - 7200, time.time() - 7200))
+
+            with patch('src.vcfs.VCF_ARCHIVE', writer), TarWriter(os.path.join(temp_dir, 'vcf_archive_busy.tar')):
+                adopt_stale_vcf_archives(max_age=3600)
+
+            self.assertEqual(sorted(entry for entry in os.listdir(temp_dir) if entry in names),
+                             ['vcf_archive_busy.tar', 'vcf_archive_recent.tar', 'vcf_archive_this.tar',
+                              'vcf_archive_this_1.tar'])
+            adopted = []
+
+            for path in writer.rolled_over_archives():
+                with tarfile.open(path) as archive:
+                    adopted.extend(archive.getnames())
+
+            self.assertEqual(sorted(adopted), ['vcf_archive.tar', 'vcf_archive_other.tar', 'vcf_archive_this_1.tar'])
+
+    @patch('src.vcfs.write_to_logs')
+    def test_streaming_matches_download(self, _):
+        """
+        Test that a plain or gzipped VCF streamed from S3 is archived as the
+        same bgzipped VCF and index as the downloaded copy run through the
+        compute pool
+        """
+        vcf = VCF + b''.join(b'1\t%d\t.\tA\tG\t50\tPASS\tAC=1;ExcessHet=3.01;DP=10\tGT\t0/1\n' % pos
+                             for pos in range(40, 400000, 7))
+        archived = []
+
+        def add(files_to_tar):
+            contents = []
+
+            for name in files_to_tar:
+                with open(name, 'rb') as archived_file:
+                    contents.append(archived_file.read())
+
+            archived.append(contents)
+
+        with tempfile.TemporaryDirectory() as temp_dir, patch('src.vcfs.COMPUTE_POOL', ComputePool(1)), \
+                patch('src.vcfs.VCF_ARCHIVE', Mock(add=add)):
+            for source in (vcf, gzip.compress(vcf)):
+                with Workspace(temp_dir) as workspace:
+                    with open(workspace.path('md5'), 'wb') as temp_file:
+                        temp_file.write(source)
+
+                    self.assertTrue(process_vcf('NEW_SAMPLE', 'sample.vcf', workspace.path('md5'), None, workspace))
+
+                with Workspace(temp_dir) as workspace, \
+                        patch('src.vcfs.get_s3_object_stream', return_value=io.BytesIO(source)):
+                    self.assertTrue(process_vcf_from_s3(
+                        'NEW_SAMPLE', 'sample.vcf', 'bucket', 'key', None, workspace,
+                        {'size': len(source), 'part_size': None}))
+
+        self.assertEqual(len(archived), 4)
+
+        for contents in archived[1:]:
+            self.assertEqual(contents, archived[0])
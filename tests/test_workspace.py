@@ -0,0 +1,82 @@
+"""
+Tests for the workspaces
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import TestCase
+from src.workspace import OWNER_FILE, Workspace, remove_stale_workspaces
+
+
+class TestWorkspace(TestCase):
+    """
+    Tests for the workspaces
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_workspaces_are_isolated(self):
+        """
+        Test that:
+            * each workspace has its own directory for the same file names
+            * cleanup removes the directory
+        """
+        with Workspace(self.temp_dir.name) as first, Workspace(self.temp_dir.name) as second:
+            self.assertNotEqual(first.path('md5'), second.path('md5'))
+            self.assertEqual(os.path.dirname(first.path('md5')), first.directory)
+
+            with open(first.path('md5'), 'w') as md5_file:
+                md5_file.write('data')
+
+        self.assertFalse(os.path.exists(first.directory))
+        self.assertFalse(os.path.exists(second.directory))
+
+    def set_owner(self, workspace, **owner):
+        """
+        Replaces the owner recorded in workspace
+        """
+        with open(os.path.join(workspace.directory, OWNER_FILE), 'r+') as owner_file:
+            recorded = json.load(owner_file)
+            recorded.update(owner)
+            owner_file.seek(0)
+            owner_file.truncate()
+            json.dump(recorded, owner_file)
+
+    def test_remove_stale_workspaces(self):
+        """
+        Test that:
+            * workspaces of this host are removed once their process has exited
+              or if they have this process's pid
+            * workspaces of running processes are kept
+            * workspaces of other hosts are removed once they are old enough
+        """
+        exited = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                                stdout=subprocess.PIPE, check=True)
+        own_pid = Workspace(self.temp_dir.name)
+        dead_pid = Workspace(self.temp_dir.name)
+        running = Workspace(self.temp_dir.name)
+        other_host = Workspace(self.temp_dir.name)
+        old_other_host = Workspace(self.temp_dir.name)
+
+        self.set_owner(dead_pid, pid=int(exited.stdout))
+        self.set_owner(running, pid=os.getppid())
+        self.set_owner(other_host, hostname='another-container', pid=1)
+        self.set_owner(old_other_host, hostname='another-container', pid=1)
+
+        old = time.time() - 7200
+        for path in (old_other_host.directory, os.path.join(old_other_host.directory, OWNER_FILE)):
+            os.utime(path, (old, old))
+
+        remove_stale_workspaces(self.temp_dir.name, max_age=3600)
+
+        self.assertFalse(os.path.exists(own_pid.directory))
+        self.assertFalse(os.path.exists(dead_pid.directory))
+        self.assertTrue(os.path.exists(running.directory))
+        self.assertTrue(os.path.exists(other_host.directory))
+        self.assertFalse(os.path.exists(old_other_host.directory))
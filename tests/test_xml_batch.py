@@ -0,0 +1,94 @@
+"""
+Tests for batching XML
+"""
+import os
+import tarfile
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from lxml import etree
+from src.xml_batch import XmlBatch
+from src.xml_utils import create_xml_library
+
+SECRET = {'accession': 'phs001232', 'accession_version': 'v4'}
+
+
+def make_library(index):
+    """
+    Returns the library of a made up BAM
+    """
+    return create_xml_library(
+        'blood', 'uuid{}'.format(index), 'Illumina HiSeq 2500', 'md5{}'.format(index), '100,100', 'hg19',
+        'sample{}'.format(index), SECRET, 2, 'uuid{}.bam'.format(index))
+
+
+@patch('src.xml_batch.write_to_logs')
+@patch('src.utilities.write_to_logs')
+@patch('src.xml_utils.write_to_logs')
+class TestXmlBatch(TestCase):
+    """
+    Tests for batching XML
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.sent = []
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def on_flush(self, tar_file_name):
+        """
+        Records the XML in the tar in place of sending it
+        """
+        with tarfile.open(tar_file_name) as tar:
+            self.sent.append({os.path.basename(name): etree.fromstring(tar.extractfile(name).read())
+                              for name in tar.getnames()})
+
+    def test_flush_by_count(self, *_):
+        """
+        Test that a full batch is sent as one experiment, run and submission
+        XML with an EXPERIMENT and RUN for each BAM
+        """
+        batch = XmlBatch(3, 60, self.on_flush, self.temp_dir.name)
+        futures = [batch.add(make_library(index)) for index in range(3)]
+
+        for future in futures:
+            future.result(timeout=10)
+
+        self.assertEqual(len(self.sent), 1)
+        experiment_set = self.sent[0]['experiment.xml']
+        run_set = self.sent[0]['run.xml']
+
+        self.assertEqual([element.text for element in experiment_set.iter('LIBRARY_NAME')],
+                         ['sample0', 'sample1', 'sample2'])
+        self.assertEqual([element.get('filename') for element in run_set.iter('FILE')],
+                         ['uuid0.bam', 'uuid1.bam', 'uuid2.bam'])
+        self.assertEqual(len(list(self.sent[0]['submission.xml'].iter('ACTION'))), 2)
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+    def test_flush_by_window(self, *_):
+        """
+        Test that a batch that does not fill up is sent once the window passes
+        """
+        batch = XmlBatch(10, 0.1, self.on_flush, self.temp_dir.name)
+        futures = [batch.add(make_library(index)) for index in range(2)]
+
+        for future in futures:
+            future.result(timeout=10)
+
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(len(list(self.sent[0]['run.xml'].iter('RUN'))), 2)
+
+    def test_failed_flush(self, *_):
+        """
+        Test that every BAM in a batch that fails to send gets the error
+        """
+        def fail(_):
+            raise Exception('Aspera failed')
+
+        batch = XmlBatch(2, 60, fail, self.temp_dir.name)
+        futures = [batch.add(make_library(index)) for index in range(2)]
+
+        for future in futures:
+            with self.assertRaisesRegex(Exception, 'Aspera failed'):
+                future.result(timeout=10)
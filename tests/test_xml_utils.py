@@ -0,0 +1,102 @@
+"""
+Tests for the XML functions
+"""
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from lxml import etree
+from src.xml_utils import (
+    create_xml_library, format_experiment_xml, format_run_xml, validate_xml, xml_to_string)
+
+SECRET = {'accession': 'phs001232', 'accession_version': 'v4'}
+
+# accepts a RUN_SET of RUNs with a FILE each
+RUN_SCHEMA = '''<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+  <xs:element name="RUN_SET">
+    <xs:complexType>
+      <xs:sequence>
+        <xs:element name="RUN" maxOccurs="unbounded">
+          <xs:complexType>
+            <xs:sequence>
+              <xs:any processContents="skip" maxOccurs="unbounded"/>
+            </xs:sequence>
+          </xs:complexType>
+        </xs:element>
+      </xs:sequence>
+    </xs:complexType>
+  </xs:element>
+</xs:schema>
+'''
+
+
+def canonical(xml):
+    """
+    Returns xml without the whitespace between elements, in canonical form
+    """
+    parser = etree.XMLParser(remove_blank_text=True)
+
+    return etree.tostring(etree.fromstring(xml, parser), method='c14n')
+
+
+@patch('src.xml_utils.write_to_logs')
+class TestXmlUtils(TestCase):
+    """
+    Tests for the XML functions
+    """
+    def make_library(self, sample_id, fileservice_uuid):
+        """
+        Returns the library of the BAM in tests/mocks
+        """
+        return create_xml_library(
+            'blood', fileservice_uuid, 'Illumina NovaSeq 5000', 'd41d8cd98f00b204e9800998ecf8427e', '100,100',
+            'GRCh37/hg19', sample_id, SECRET, 2, '{}.bam'.format(fileservice_uuid))
+
+    def read_mock(self, name):
+        """
+        Returns the contents of a file in tests/mocks
+        """
+        with open(os.path.join(os.path.dirname(__file__), 'mocks', name), 'rb') as mock:
+            return mock.read()
+
+    def test_matches_mocks(self, _):
+        """
+        Test that the experiment and run XML of a BAM match the mocks
+        """
+        library = self.make_library('e40d8f23-2f59-49b7-bb78-bf9fecc1beeb', 'b2b0c9ad-1292-43cd-aeed-6b492e67252d')
+
+        self.assertEqual(canonical(xml_to_string(format_experiment_xml([library]))),
+                         canonical(self.read_mock('experiment.xml')))
+        self.assertEqual(canonical(xml_to_string(format_run_xml([library]))), canonical(self.read_mock('run.xml')))
+
+    def test_templates_are_not_changed(self, _):
+        """
+        Test that filling in one library does not leak into the next
+        """
+        first = self.make_library('sample1', 'uuid1')
+        second = self.make_library('sample2', 'uuid2')
+        second['read_lengths'] = []
+
+        format_experiment_xml([first])
+        experiment_set = format_experiment_xml([second, first]).getroot()
+
+        self.assertEqual([element.text for element in experiment_set.iter('LIBRARY_NAME')], ['sample2', 'sample1'])
+        self.assertEqual(len(experiment_set[0].findall('DESIGN/SPOT_DESCRIPTOR')), 0)
+        self.assertEqual(len(experiment_set[1].findall('DESIGN/SPOT_DESCRIPTOR')), 1)
+
+    def test_validate_xml(self, _):
+        """
+        Test that XML is checked against the schema in the schema directory,
+        and not checked without one
+        """
+        with tempfile.TemporaryDirectory() as schema_dir:
+            with open(os.path.join(schema_dir, 'SRA.run.xsd'), 'w') as schema_file:
+                schema_file.write(RUN_SCHEMA)
+
+            run_set = format_run_xml([self.make_library('sample1', 'uuid1')])
+            validate_xml(run_set, 'run', schema_dir)
+
+            with self.assertRaisesRegex(Exception, 'run XML does not match its schema'):
+                validate_xml(etree.ElementTree(etree.Element('RUN_SET')), 'run', schema_dir)
+
+        validate_xml(etree.ElementTree(etree.Element('RUN_SET')), 'run', None)